@@ -22,6 +22,7 @@ import time
 import socket
 import six.moves.configparser
 import os
+import sys
 
 import gettext
 gettext.install("D-RATS")
@@ -29,6 +30,7 @@ gettext.install("D-RATS")
 from d_rats import dplatform
 from d_rats import transport
 from d_rats import comm
+from d_rats import debug
 from d_rats.debug import printlog
 
 if __name__ == "__main__":
@@ -49,6 +51,10 @@ if __name__ == "__main__":
     o.add_option("-L", "--log",
                  dest="logpath",
                  help="Use alternate log file directory")
+    o.add_option("-B", "--bench",
+                 dest="bench",
+                 type="int",
+                 help="Benchmark a local ratflector with this many clients")
     (opts, args) = o.parse_args()
 
     if opts.config:
@@ -343,6 +349,65 @@ class Repeater:
         if self.socket:
             self.socket.close()
 
+def bench_ratflector(clients=8, count=200, size=512):
+    from d_rats import ddt2
+
+    r = Repeater()
+    r.socket = r.listen_on(0)
+    port = r.socket.getsockname()[1]
+    r.repeat()
+
+    expect = clients * (clients - 1) * count
+    received = [0, 0]
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def handler(frame):
+        lock.acquire()
+        received[0] += 1
+        received[1] += len(frame.data)
+        if received[0] >= expect:
+            done.set()
+        lock.release()
+
+    # Keep the per-frame logging out of the measurement
+    with debug.quiet():
+        tports = []
+        for i in range(clients):
+            path = comm.SocketDataPath(("127.0.0.1", port,
+                                        "BENCH%i" % i, None))
+            path.connect()
+            tports.append(transport.Transporter(path,
+                                                inhandler=handler,
+                                                warmup_timeout=0))
+
+        # The repeater accepts one client per pass
+        while len(r.paths) < clients:
+            time.sleep(0.1)
+
+        start = time.time()
+        for j in range(count):
+            for i, t in enumerate(tports):
+                f = ddt2.DDT2EncodedFrame()
+                f.seq = j % 256
+                f.session = 2
+                f.s_station = "BENCH%i" % i
+                f.d_station = "CQCQCQ"
+                f.data = os.urandom(size)
+                t.send_frame(f)
+
+        done.wait(120)
+        elapsed = max(time.time() - start, 0.000001)
+
+        for t in tports:
+            t.disable()
+        r.stop()
+
+    printlog("Repeater  : %i clients: delivered %i/%i frames, %i KB in "
+             "%.2f sec (%.1f KB/sec)" % (clients, received[0], expect,
+                                         received[1] / 1024, elapsed,
+                                         received[1] / 1024 / elapsed))
+
 class RepeaterUI:
     def __init__(self):
         self.repeater = None
@@ -877,6 +942,9 @@ class RepeaterConsole(RepeaterUI):
 if __name__=="__main__":
     import sys
 
+    if opts.bench:
+        bench_ratflector(opts.bench)
+        sys.exit(0)
 
     if not opts.debug:
         if opts.logpath:
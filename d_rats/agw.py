@@ -8,6 +8,14 @@ from . import utils
 import sys
 import socket
 import threading
+from collections import deque
+
+AGW_HEADER = "BBBBBBBB10s10sII"
+AGW_HEADER_LEN = struct.calcsize(AGW_HEADER)
+
+# Nothing AGWPE sends comes close to this; anything bigger means we
+# have lost our place in the stream
+AGW_MAX_PAYLOAD = 65536
 
 class AGWFrame:
     kind = 0
@@ -23,7 +31,7 @@ class AGWFrame:
         self.payload = ""
 
     def packed(self):
-        p = struct.pack("BBBBBBBB10s10sII",
+        p = struct.pack(AGW_HEADER,
                         self.port,
                         self.res1, self.res2, self.res3,
                         self.kind,
@@ -36,7 +44,7 @@ class AGWFrame:
 
         return p + self.payload;
 
-    def unpack(self, data):
+    def unpack_header(self, data):
         self.port,\
             self.res1, self.res2, self.res3, \
             self.kind, \
@@ -45,9 +53,14 @@ class AGWFrame:
             self.res5, \
             self.call_from, self.call_to, \
             self.len, \
-            self.res6 = struct.unpack("BBBBBBBB10s10sII", data[:36]);
+            self.res6 = struct.unpack_from(AGW_HEADER, data)
 
-        self.payload = data[36:]
+        return self.len
+
+    def unpack(self, data):
+        self.unpack_header(data)
+
+        self.payload = data[AGW_HEADER_LEN:]
         if len(self.payload) != self.len:
             raise Exception("Expecting payload of %i, got %i" % \
                                 (self.len, len(self.payload)))
@@ -109,63 +122,163 @@ AGW_FRAMES = {
 
 class AGWConnection:
     def __init__(self, addr, port, timeout=0):
-        self.__lock = threading.Lock()
+        self.__lock = threading.Lock() # Held by whoever is reading
+        self.__cond = threading.Condition()
 
         self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if timeout:
             self._s.settimeout(timeout)
+        self._timeout = timeout or 1
         self._s.connect((addr, port))
-        self._buf = ""
+
+        # A frame we have only read part of (the socket timed out)
+        self._hdr = bytearray(AGW_HEADER_LEN)
+        self._hdr_got = 0
+        self._payload = bytearray(4096)
+        self._payload_len = None
+        self._payload_got = 0
+
         self._framebuf = {}
         for i in AGW_FRAMES.keys():
-            self._framebuf[ord(i)] = []
+            self._framebuf[ord(i)] = deque()
 
     def _detect_frame(self, data):
         kind = data[4]
-        return AGW_FRAMES[kind]()
+        if not isinstance(kind, int):
+            kind = ord(kind)
+        cls = AGW_FRAMES.get(chr(kind), None)
+        if cls:
+            return cls()
+
+        f = AGWFrame()
+        f.kind = kind
+        return f
 
     def send_frame(self, f):
         self._s.send(f.packed())
 
+    def __fill(self, buf, got, count):
+        # Read into @buf until it holds @count bytes, or the socket
+        # times out.  Returns how many bytes it holds.
+        view = memoryview(buf)
+        while got < count:
+            try:
+                n = self._s.recv_into(view[got:count])
+            except socket.timeout:
+                break
+
+            if n == 0: # Socket closed
+                self.close()
+                raise IOError("AGWPE closed the connection")
+            got += n
+
+        return got
+
     def __recv_frame(self):
-        try:
-            c = self._s.recv(1)
-        except socket.timeout:
+        if self._payload_len is None:
+            self._hdr_got = self.__fill(self._hdr, self._hdr_got,
+                                        AGW_HEADER_LEN)
+            if self._hdr_got < AGW_HEADER_LEN:
+                return None
+
+            length = struct.unpack_from("I", self._hdr, 28)[0]
+            if length > AGW_MAX_PAYLOAD:
+                self.close()
+                raise IOError("AGWPE frame length %i is invalid" % length)
+            if length > len(self._payload):
+                self._payload = bytearray(length)
+            self._payload_len = length
+            self._payload_got = 0
+
+        self._payload_got = self.__fill(self._payload, self._payload_got,
+                                        self._payload_len)
+        if self._payload_got < self._payload_len:
             return None
-        
-        if len(c) == 0: # Socket closed
-            self.close()
 
-        self._buf += c
-        if len(self._buf) >= 36:
-            f = self._detect_frame(self._buf)
-            try:
-                f.unpack(self._buf)
-                self._buf = ""
-            except Exception as e:
-                return None
-            return f
+        f = self._detect_frame(self._hdr)
+        f.unpack_header(self._hdr)
+        f.payload = bytes(self._payload[:self._payload_len])
 
-        return None
+        self._hdr_got = 0
+        self._payload_len = None
 
-    def recv_frame_type(self, kind, poll=False):
-        while True:
-            buffered = self._framebuf.get(ord(kind), [])
+        return f
+
+    def __take(self, kind):
+        self.__cond.acquire()
+        try:
+            buffered = self._framebuf.get(kind)
             if buffered:
-                return buffered.pop()
+                return buffered.popleft()
+            return None
+        finally:
+            self.__cond.release()
+
+    def __stash(self, f):
+        self.__cond.acquire()
+        try:
+            if f.kind in self._framebuf:
+                self._framebuf[f.kind].append(f)
+            else:
+                printlog("Agw","       : Dropping unexpected %s frame" % chr(f.kind))
+            self.__cond.notify_all()
+        finally:
+            self.__cond.release()
+
+    def recv_frame_type(self, kind, poll=False):
+        """Return the next frame of @kind, or None.
+
+        With @poll, wait until one arrives.  Frames of other kinds
+        read meanwhile are kept for whoever asks for them.
+        """
+        kind = ord(kind)
 
-            self.__lock.acquire()
-            f = self.__recv_frame()
-            self.__lock.release()
+        while True:
+            f = self.__take(kind)
             if f:
-                printlog("Agw","       : Got %s frame while waiting for %s" % (chr(f.kind), kind))
-                self._framebuf[f.kind].insert(0, f)
-            elif not poll:
-                return None
-        
+                return f
+
+            if self.__lock.acquire(False):
+                try:
+                    # The last reader may have stashed one for us
+                    f = self.__take(kind) or self.__recv_frame()
+                    if f and f.kind != kind:
+                        # Stash it before anyone else can read, so
+                        # frames of a kind stay in order
+                        printlog("Agw","       : Got %s frame while waiting for %s" % (chr(f.kind), chr(kind)))
+                        self.__stash(f)
+                        f = None
+                        continue
+                finally:
+                    self.__lock.release()
+                    # Somebody waiting may want to take over reading
+                    self.__cond.acquire()
+                    self.__cond.notify_all()
+                    self.__cond.release()
+
+                if f:
+                    return f
+                elif not poll:
+                    return None
+            else:
+                # Someone else is reading, and will hand us our frame
+                self.__cond.acquire()
+                if not self._framebuf.get(kind):
+                    self.__cond.wait(self._timeout)
+                self.__cond.release()
+
+                if not poll:
+                    return self.__take(kind)
+
+    def has_frames(self, kind):
+        return bool(self._framebuf.get(ord(kind)))
+
     def close(self):
         self._s.close()
 
+    def fileno(self):
+        return self._s.fileno()
+
     def enable_raw(self):
         kf = AGWFrame_k()
         self.send_frame(kf)
@@ -351,7 +464,7 @@ def receive_data(conn, blocking=False):
     if f:
         return f.get_payload()
     else:
-        return ""
+        return b""
 
 def test(conn):
     f = AGWFrame_K()
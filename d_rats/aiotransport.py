@@ -0,0 +1,386 @@
+#!/usr/bin/python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio implementation of the Transporter contract.  One event loop,
+# running in a single thread, drives every port and stateful session
+# that uses it, instead of one thread per port and per session.
+#
+# This is a library option for Python 3 programs only: select it with
+# SessionManager(..., engine="asyncio") or set_comm(..., engine=
+# "asyncio").  The D-RATS application itself runs on Python 2 and
+# always uses the threaded Transporter, so this module is never
+# imported there, and "python3 -m d_rats.aiotransport" is the way to
+# exercise it.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+#importing printlog() wrapper
+from .debug import printlog
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import utils
+from . import comm
+from . import transport
+
+class AsyncEngine(object):
+    """The shared event loop, plus a small pool for blocking work"""
+
+    def __init__(self, workers=4):
+        self.loop = asyncio.new_event_loop()
+        # Session steps get their own pool, so they can never starve
+        # the port I/O in the loop's default executor
+        self.pool = ThreadPoolExecutor(workers)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        return threading.current_thread() == self.thread
+
+    def call(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+
+    _engine_lock.acquire()
+    if _engine is None:
+        _engine = AsyncEngine()
+    _engine_lock.release()
+
+    return _engine
+
+class AsyncTransporter(transport.Transporter):
+    def _start(self, authfn):
+        self._wake_r = self._wake_w = None
+        self.thread = None
+
+        self._engine = get_engine()
+        self._connected = False
+        self._reader_fd = None
+        self._sender = None
+        self._poller = None
+        self._compat_timer = None
+
+        self._task = self._engine.submit(self._run(authfn))
+
+    async def _run(self, authfn):
+        loop = asyncio.get_event_loop()
+
+        # Connecting and authenticating are blocking conversations
+        ok = await loop.run_in_executor(None, self._connect, authfn)
+        if not ok or not self.enabled:
+            return
+
+        self._connected = True
+        self._watch()
+        self._kick()
+
+    def _watch(self):
+        try:
+            fd = self.pipe.fileno()
+        except Exception:
+            fd = None
+
+        if fd is None or fd < 0:
+            # Not selectable, so read it from the executor instead
+            self._poller = asyncio.ensure_future(self._poll())
+        else:
+            self._reader_fd = fd
+            self._engine.loop.add_reader(fd, self._readable)
+
+    def _unwatch(self):
+        if self._reader_fd is not None:
+            self._engine.loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    async def _poll(self):
+        loop = asyncio.get_event_loop()
+        while self.enabled:
+            try:
+                await loop.run_in_executor(None, self.get_input)
+            except Exception as e:
+                printlog("Transport"," : Exception while getting input: %s" % e)
+                utils.log_exception()
+                self._fail()
+                break
+
+            self._process_input()
+            self._schedule_compat()
+
+    def _readable(self):
+        try:
+            chunk = self.pipe.read_all_waiting()
+        except comm.DataPathIOError as e:
+            # Let the blocking retry/reconnect logic run off the loop
+            printlog("Transport"," : Data path IO error: %s" % e)
+            self._unwatch()
+            asyncio.ensure_future(self._recover())
+            return
+        except Exception as e:
+            printlog("Transport"," : Exception while getting input: %s" % e)
+            utils.log_exception()
+            self._fail()
+            return
+
+        if chunk:
+            self.inbuf += chunk
+            self.last_recv = time.time()
+
+        self._process_input()
+        self._schedule_compat()
+
+    async def _recover(self):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.get_input)
+        except Exception as e:
+            printlog("Transport"," : Exception while getting input: %s" % e)
+            self._fail()
+            return
+
+        self._process_input()
+        if self.enabled:
+            self._watch()
+
+    def _schedule_compat(self):
+        # Make sure unconverted data gets flushed even if nothing
+        # else arrives
+        if not self.inbuf or self._compat_timer:
+            return
+
+        def flush():
+            self._compat_timer = None
+            self._process_input()
+            self._schedule_compat()
+
+        self._compat_timer = self._engine.loop.call_later(
+            self.compat_delay + 0.1, flush)
+
+    def _fail(self):
+        self.enabled = False
+        self._unwatch()
+
+    def _kick(self):
+        if not self._connected or not self.enabled:
+            return
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.ensure_future(self._send_frames())
+
+    async def _send_frames(self):
+        loop = asyncio.get_event_loop()
+        delayed = False
+
+        while self.enabled:
+            f = self.outq.dequeue()
+            if not f:
+                break
+
+            self._apply_caps(f)
+
+            hold = self._tx_wait(f)
+            if hold:
+                # Requeue, so whatever is at the head then goes first
+                self.outq.requeue(f)
+                self._tx_hold = time.time() + hold
+                printlog("Transport"," : Holding transmit for %.1f sec" % hold)
+                await asyncio.sleep(hold)
+                continue
+
+            if not delayed:
+                delay = self._xmit_delay(f)
+                if delay:
+                    printlog("Transport"," : Waiting %.1f sec before transmitting" % delay)
+                    await asyncio.sleep(delay)
+                delayed = True
+
+            frames = self._gather_frames(f)
+            try:
+                await loop.run_in_executor(None, self._send_batch, frames)
+            except Exception as e:
+                printlog("Transport"," : Exception while sending frames: %s" % e)
+                self._fail()
+                break
+
+    def _wakeup(self):
+        self._engine.call(self._kick)
+
+    def send_frames(self):
+        self._wakeup()
+
+    async def _shutdown(self):
+        self._unwatch()
+        for task in [self._sender, self._poller]:
+            if task and not task.done():
+                task.cancel()
+        if self._compat_timer:
+            self._compat_timer.cancel()
+            self._compat_timer = None
+
+    def disable(self):
+        self.inhandler = None
+        self.enabled = False
+
+        if self._engine.in_loop():
+            asyncio.ensure_future(self._shutdown())
+        else:
+            self._engine.submit(self._shutdown()).result(10)
+
+class AsyncSessionDriver(object):
+    """Runs StatefulSession.step() for each session from a coroutine.
+
+    Steps run in the engine's pool; waiting between steps, including
+    for their frames to be sent, costs no thread at all.
+    """
+
+    def __init__(self, engine=None):
+        self._engine = engine or get_engine()
+        self._wakers = {}
+        self._tasks = {}
+        self._local = threading.local()
+
+    def add(self, session):
+        self._engine.call(self._add, session)
+
+    def _add(self, session):
+        waker = asyncio.Event()
+        self._wakers[session] = waker
+        self._tasks[session] = asyncio.ensure_future(self._run(session,
+                                                               waker))
+
+    def wake(self, session):
+        self._engine.call(self._wake, session)
+
+    def _wake(self, session):
+        waker = self._wakers.get(session)
+        if waker:
+            waker.set()
+
+    def _step(self, session):
+        self._local.session = session
+        try:
+            return session.step()
+        finally:
+            self._local.session = None
+
+    async def _run(self, session, waker):
+        loop = asyncio.get_event_loop()
+
+        try:
+            while session.enabled:
+                waker.clear()
+                timeout, idle = await loop.run_in_executor(self._engine.pool,
+                                                           self._step,
+                                                           session)
+                if timeout == 0 or not session.enabled:
+                    continue
+
+                try:
+                    await asyncio.wait_for(waker.wait(), timeout)
+                except asyncio.TimeoutError:
+                    if idle:
+                        await loop.run_in_executor(self._engine.pool,
+                                                   session.expire)
+        except Exception as e:
+            printlog("Transport"," : Session %s failed: %s" % (session.name, e))
+            utils.log_exception()
+        finally:
+            self._wakers.pop(session, None)
+            self._tasks.pop(session, None)
+
+    async def _join(self, session):
+        task = self._tasks.get(session)
+        if task:
+            await asyncio.wait([task])
+
+    def remove(self, session):
+        self.wake(session)
+
+        # Like joining a worker thread, unless the caller is the
+        # session's own step or the loop itself
+        if self._engine.in_loop() or \
+                getattr(self._local, "session", None) is session:
+            return
+
+        self._engine.submit(self._join(session)).result()
+
+def test_session_manager():
+    """Run a stateful session between two SessionManagers on the engine"""
+    try:
+        _
+    except NameError:
+        import gettext
+        gettext.install("D-RATS")
+
+    # As sessionmgr imports it, when this runs as __main__
+    from . import aiotransport, sessionmgr
+    from .sessions import stateful
+
+    path_a, path_b = comm.simulated_pair()
+    sm_a = sessionmgr.SessionManager(path_a, "SIMA", engine="asyncio")
+    sm_b = sessionmgr.SessionManager(path_b, "SIMB", engine="asyncio")
+    assert isinstance(sm_a.tport, aiotransport.AsyncTransporter)
+    assert isinstance(sm_a.session_driver, aiotransport.AsyncSessionDriver)
+
+    payload = b"0123456789" * 200
+    got = []
+    done = threading.Event()
+
+    def reader(session):
+        got.append(session.read_exactly(len(payload)))
+        done.set()
+
+    def new_session(data, reason, session):
+        if reason == "new,in":
+            t = threading.Thread(target=reader, args=(session,))
+            t.setDaemon(True)
+            t.start()
+
+    sm_b.register_session_cb(new_session, None)
+
+    try:
+        session = sm_a.start_session("test", dest="SIMB",
+                                     cls=stateful.StatefulSession)
+        session.write(payload)
+        done.wait(60)
+        assert got and got[0] == payload, "Session data did not arrive"
+
+        sm_a.stop_session(session)
+    finally:
+        sm_a.shutdown(True)
+        sm_b.shutdown(True)
+        path_a.disconnect()
+        path_b.disconnect()
+
+    printlog("Transport"," : asyncio SessionManager test passed")
+
+if __name__ == "__main__":
+    test_session_manager()
@@ -8,6 +8,13 @@ import socket
 import time
 import struct
 import select
+import binascii
+import errno
+import os
+import threading
+import random
+import math
+import six
 
 from . import utils
 from . import agw
@@ -23,6 +30,8 @@ class DataPathIOError(DataPathError):
 
 ASCII_XON = chr(17)
 ASCII_XOFF = chr(19)
+_ASCII_XON = struct.pack("B", 17)
+_ASCII_XOFF = struct.pack("B", 19)
 
 FEND  = 0xC0
 FESC  = 0xDB
@@ -31,20 +40,15 @@ TFESC = 0xDD
 
 TNC_DEBUG = True
 
-def kiss_escape_frame(frame):
-    escaped = ""
-
-    for char in frame:
-        if ord(char) == FEND:
-            escaped += chr(FESC)
-            escaped += chr(TFEND)
-        elif ord(char) == FESC:
-            escaped += chr(FESC)
-            escaped += chr(TFESC)
-        else:
-            escaped += char
+_KISS_FEND = struct.pack("B", FEND)
+_KISS_FESC = struct.pack("B", FESC)
+_KISS_ESC_FEND = struct.pack("BB", FESC, TFEND)
+_KISS_ESC_FESC = struct.pack("BB", FESC, TFESC)
 
-    return escaped
+def kiss_escape_frame(frame):
+    # FESC first, so the escapes we add for FEND aren't escaped again
+    return frame.replace(_KISS_FESC, _KISS_ESC_FESC).replace(_KISS_FEND,
+                                                             _KISS_ESC_FEND)
 
 def kiss_send_frame(frame, port=0):
     cmd = (port & 0x0F) << 4
@@ -58,53 +62,73 @@ def kiss_send_frame(frame, port=0):
 
     return buf
 
-def kiss_buf_has_frame(buf):
-    return buf.count(chr(FEND)) >=2
+class KISSDecoder(object):
+    """Incremental KISS decoder.
 
-def kiss_recv_frame(buf):
-    if not buf:
-        return "", ""
+    feed() takes data as it arrives from the TNC and returns the
+    payloads (without the command byte) of any frames it completed.
+    Escapes are only undone once a whole frame is in, so they can be
+    split across reads.
+    """
 
-    data = ""
-    inframe = False
+    MAX_FRAME = 65536
 
-    _buf = ""
-    _lst = "0" # Make sure we don't choke trying to ord() this
-    for char in buf:
-        if ord(char) == FEND:
-            if not inframe:
-                inframe = True
-            else:
-                data += _buf[1:]
-                _buf = ""
-                inframe = False
-        elif ord(char) == FESC:
-            pass # Ignore this and wait for the next character
-        elif ord(_lst) == FESC:
-            if ord(char) == TFEND:
-                _buf += chr(FEND)
-            elif ord(char) == TFESC:
-                _buf += chr(FESC)
-            else:
-                printlog("Comm","        : [TNC] Bad escape of 0x%x" % ord(char))
-                break
-        elif inframe:
-            _buf += char
-        else:
-            printlog("Comm","        : [TNC] Out-of-frame garbage: 0x%x" % ord(char))
-        _lst = char
+    def __init__(self):
+        self._frame = bytearray()
+        self._synced = False # Seen a FEND yet?
 
-    if TNC_DEBUG:
-        printlog("Comm","        : [TNC] Data:")
-        utils.hexprintlog(data)
+    def _unescape(self, raw):
+        # Every FESC must start one of the two valid escapes
+        if raw.count(_KISS_FESC) != \
+                raw.count(_KISS_ESC_FEND) + raw.count(_KISS_ESC_FESC):
+            printlog("Comm","        : [TNC] Bad escape in frame, dropping")
+            return None
+
+        return raw.replace(_KISS_ESC_FEND, _KISS_FEND).replace(_KISS_ESC_FESC,
+                                                               _KISS_FESC)
+
+    def feed(self, data):
+        frames = []
+
+        parts = bytearray(data).split(_KISS_FEND)
+        if not self._synced:
+            if len(parts) == 1:
+                if parts[0]:
+                    printlog("Comm","        : [TNC] Out-of-frame garbage (%i b)" % len(parts[0]))
+                return frames
+            if parts[0]:
+                printlog("Comm","        : [TNC] Out-of-frame garbage (%i b)" % len(parts[0]))
+            parts[0] = bytearray()
+            self._synced = True
+
+        self._frame += parts[0]
+        for part in parts[1:]:
+            # A FEND ends the current frame and starts the next one
+            raw = self._frame
+            self._frame = part
+
+            if len(raw) < 2:
+                continue # Back-to-back FENDs or a bare command byte
+
+            frame = self._unescape(bytes(raw[1:]))
+            if frame is None:
+                continue
 
-    if not inframe and _buf:
-        # There was not a partial frame started at the end of the data
-        printlog("Comm","        : [TNC] Dumping non-frame data trailer")
-        utils.hexprintlog(_buf)
-        _buf = ""
+            if TNC_DEBUG:
+                printlog("Comm","        : [TNC] Data:")
+                utils.hexprintlog(frame)
 
-    return data, _buf
+            frames.append(frame)
+
+        if len(self._frame) > self.MAX_FRAME:
+            printlog("Comm","        : [TNC] Frame too long, resyncing")
+            self._frame = bytearray()
+            self._synced = False
+
+        return frames
+
+    def pending(self):
+        return len(self._frame)
 
 class TNCSerial(serial.Serial):
     def __init__(self, **kwargs):
@@ -115,7 +139,7 @@ class TNCSerial(serial.Serial):
             self.__tncport = 0
         serial.Serial.__init__(self, **kwargs)
 
-        self.__buffer = ""
+        self.__decoder = KISSDecoder()
         self.__tstamp = 0
 
     def reconnect(self):
@@ -124,25 +148,65 @@ class TNCSerial(serial.Serial):
     def write(self, data):
         serial.Serial.write(self, kiss_send_frame(data, self.__tncport))
 
-    def read(self, size):
-        if self.__buffer:
-            printlog("Comm","        : Buffer is %i before read" % len(self.__buffer))
-        self.__buffer += serial.Serial.read(self, 1024)
+    def read_frames(self, size):
+        # Take everything the port has waiting, and only block (up to
+        # the timeout) if the caller wants at least @size bytes
+        waiting = self.inWaiting()
+        if not (waiting or size):
+            return []
 
-        framedata = ""
-        if kiss_buf_has_frame(self.__buffer):
-            framedata, self.__buffer = kiss_recv_frame(self.__buffer)
-        elif len(self.__buffer) > 0:
-            printlog("Comm","     : [TNC] Buffer partially-filled (%i b)" % len(self.__buffer))
+        chunk = serial.Serial.read(self, max(size, waiting))
+        frames = self.__decoder.feed(chunk)
 
-        return framedata
+        if not frames and self.__decoder.pending():
+            printlog("Comm","     : [TNC] Buffer partially-filled (%i b)" % self.__decoder.pending())
+
+        return frames
+
+    def read(self, size):
+        return b"".join(self.read_frames(size))
 
 
 class SWFSerial(serial.Serial):
+    """Serial port with software (XON/XOFF) flow control.
+
+    A reader thread takes everything the radio sends, tracking XON and
+    XOFF in an event and keeping the rest for read().  Writes go out in
+    chunks and only wait while the radio has us XOFF'd.  With a
+    chunk_size of 0, the chunk size is tuned to the radio's buffer:
+    it doubles while chunks go through cleanly, halves on XOFF, and
+    then only creeps back up from there.
+    """
+
     __swf_debug = False
 
+    MIN_CHUNK = 8
+    MAX_CHUNK = 4096
+
     def __init__(self, **kwargs):
         printlog("Comm","        : Software XON/XOFF control initialized")
+
+        self.chunk_size = kwargs.pop("chunk_size", 0)
+        self.xoff_limit = 15
+
+        # Set up before the Serial constructor, which may open() us
+        self.__xon = threading.Event()
+        self.__xon.set()
+        self.__rcond = threading.Condition()
+        self.__rbuf = bytearray()
+        self.__reader = None
+        self.__reading = False
+        self.__read_error = None
+        self.__wake_r = self.__wake_w = None
+        self.__chunk = self.chunk_size or 64
+        self.__ceiling = self.MAX_CHUNK # Doubling stops here after XOFF
+        self.__xoff_start = 0
+        self.__stats = {
+            "xoff_count" : 0,
+            "xoff_time" : 0.0,
+            "bytes_written" : 0,
+            }
+
         try:
             serial.Serial.__init__(self, **kwargs)
         except TypeError as e:
@@ -153,65 +217,188 @@ class SWFSerial(serial.Serial):
                 printlog("Comm      : Unknown TypeError from Serial.__init__: %s" % e)
                 raise e
 
-        self.state = True
-        self.xoff_limit = 15
+    def open(self):
+        serial.Serial.open(self)
+
+        if os.name == "posix" and self.__wake_r is None:
+            # Lets select() see data that the reader has buffered
+            import fcntl
+            self.__wake_r, self.__wake_w = os.pipe()
+            for fd in (self.__wake_r, self.__wake_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.__read_error = None
+        self.__reading = True
+        self.__reader = threading.Thread(target=self.__read_loop)
+        self.__reader.setDaemon(True)
+        self.__reader.start()
+
+    def close(self):
+        self.__reading = False
+        if self.__reader and self.__reader != threading.current_thread():
+            self.__reader.join()
+        self.__reader = None
+
+        serial.Serial.close(self)
+
+        if self.__wake_r is not None:
+            os.close(self.__wake_r)
+            os.close(self.__wake_w)
+            self.__wake_r = self.__wake_w = None
 
     def reconnect(self):
         self.close()
         time.sleep(0.5)
         self.open()
 
-    def is_xon(self):
-        time.sleep(0.01)
-        if serial.Serial.inWaiting(self) == 0:
-            return self.state
-        char = serial.Serial.read(self, 1)
-        if char == ASCII_XOFF:
-            if self.__swf_debug:
-                printlog("Comm      : ************* Got XOFF")
-            self.state = False
-        elif char == ASCII_XON:
+    @property
+    def state(self):
+        return self.__xon.isSet()
+
+    def __set_state(self, xon):
+        if xon == self.__xon.isSet():
+            return
+
+        if xon:
             if self.__swf_debug:
                 printlog("Comm","        : ------------- Got XON")
-            self.state = True
-        elif len(char) == 1:
-            printlog("Comm","        : Aiee! Read a non-XOFF char: 0x%02x `%s`" % (ord(char), char))
-            self.state = True
-            printlog("Comm","        : Assuming IXANY behavior")
+            self.__stats["xoff_time"] += time.time() - self.__xoff_start
+            self.__xon.set()
+        else:
+            if self.__swf_debug:
+                printlog("Comm      : ************* Got XOFF")
+            self.__stats["xoff_count"] += 1
+            self.__xoff_start = time.time()
+            self.__xon.clear()
+
+    def __received(self, data):
+        xon = data.rfind(_ASCII_XON)
+        xoff = data.rfind(_ASCII_XOFF)
+        if xon != -1 or xoff != -1:
+            data = data.translate(None, _ASCII_XON + _ASCII_XOFF)
+
+        if xoff > xon:
+            self.__set_state(False)
+        elif xon > xoff:
+            self.__set_state(True)
+
+        if not data:
+            return
 
-        return self.state
+        if not self.__xon.isSet() and xoff == -1:
+            printlog("Comm","        : Got data while XOFF, assuming IXANY behavior")
+            self.__set_state(True)
 
-    def _write(self, data):
-        chunk = 8
+        self.__rcond.acquire()
+        self.__rbuf += data
+        self.__rcond.notify_all()
+        self.__rcond.release()
+
+        if self.__wake_w is not None:
+            try:
+                os.write(self.__wake_w, b"!")
+            except OSError:
+                pass
+
+    def __read_loop(self):
+        while self.__reading:
+            try:
+                count = serial.Serial.inWaiting(self)
+                data = serial.Serial.read(self, max(1, count))
+            except Exception as e:
+                printlog("Comm","        : Serial reader failed: %s" % e)
+                self.__rcond.acquire()
+                self.__read_error = e
+                self.__rcond.notify_all()
+                self.__rcond.release()
+                break
+
+            if data:
+                self.__received(data)
+
+    def fileno(self):
+        if self.__wake_r is None:
+            raise IOError("Serial port is not selectable")
+        return self.__wake_r
+
+    def inWaiting(self):
+        return len(self.__rbuf)
+
+    def read(self, size=1):
+        self.__rcond.acquire()
+        try:
+            if size and not self.__rbuf and not self.__read_error:
+                self.__rcond.wait(self.timeout)
+
+            if self.__read_error and not self.__rbuf:
+                raise self.__read_error
+
+            data = bytes(self.__rbuf[:size])
+            del self.__rbuf[:size]
+
+            if not self.__rbuf and self.__wake_r is not None:
+                try:
+                    while os.read(self.__wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+
+            return data
+        finally:
+            self.__rcond.release()
+
+    def __wait_xon(self):
+        if self.__xon.isSet():
+            return
+
+        if self.__swf_debug:
+            printlog("Comm      : We're XOFF, waiting")
+        if not self.__xon.wait(self.xoff_limit):
+            printlog("Comm","        : XOFF for too long, assuming XON")
+            self.__set_state(True)
+
+    def __tune(self, xoff):
+        if self.chunk_size:
+            return
+        elif xoff:
+            self.__chunk = max(self.MIN_CHUNK, self.__chunk // 2)
+            self.__ceiling = self.__chunk
+        elif self.__chunk * 2 <= self.__ceiling:
+            self.__chunk *= 2
+        else:
+            self.__chunk = min(self.MAX_CHUNK,
+                               self.__chunk + max(self.MIN_CHUNK,
+                                                  self.__chunk // 8))
+
+    def write(self, data):
         pos = 0
         while pos < len(data):
+            self.__wait_xon()
+
+            chunk = self.chunk_size or self.__chunk
             if self.__swf_debug:
                 printlog("Comm","        : Sending %i-%i of %i" % (pos, pos+chunk, len(data)))
-            serial.Serial.write(self, data[pos:pos+chunk])
-            self.flush()
-            pos += chunk
-            start = time.time()
-            while not self.is_xon():
-                if self.__swf_debug:
-                    printlog(("Comm      : We're XOFF, waiting: %s" % self.state))
-                time.sleep(0.01)
-                
-                if (time.time() - start) > self.xoff_limit:
-                    #printlog("XOFF for too long, breaking loop!")
-                    #raise DataPathIOError("Write error (flow)")
-                    printlog("Comm","        : XOFF for too long, assuming XON")
-                    self.state = True
 
-    def write(self, data):
-        old_to = self.timeout
-        self.timeout = 0.01
-
-        self._write(data)
+            xoffs = self.__stats["xoff_count"]
+            sent = data[pos:pos+chunk]
+            serial.Serial.write(self, sent)
+            # Wait for it to be on the wire, so an XOFF it causes is
+            # seen before we pile on more
+            self.flush()
+            pos += len(sent)
+            self.__stats["bytes_written"] += len(sent)
 
-        self.timeout = old_to
+            self.__tune(self.__stats["xoff_count"] != xoffs or \
+                            not self.__xon.isSet())
 
-    def read(self, len):
-        return serial.Serial.read(self, len)
+    def get_flow_stats(self):
+        stats = dict(self.__stats)
+        if not self.__xon.isSet():
+            stats["xoff_time"] += time.time() - self.__xoff_start
+        stats["chunk_size"] = self.chunk_size or self.__chunk
+        stats["xoff"] = not self.__xon.isSet()
+        return stats
 
 
 class DataPath(object):
@@ -238,6 +425,11 @@ class DataPath(object):
     def is_connected(self):
         return False
 
+    def fileno(self):
+        # A descriptor that select() reports readable when data arrives,
+        # or None if the Transporter has to poll this path
+        return None
+
     def __str__(self):
         return "--"
 
@@ -265,7 +457,10 @@ class AGWDataPath(DataPath):
         self.connect()
 
     def read(self, count):
-        return agw.receive_data(self._agw)
+        try:
+            return agw.receive_data(self._agw)
+        except (IOError, socket.error) as e:
+            raise DataPathIOError("AGWPE read failed: %s" % e)
 
     def write(self, buf):
         agw.transmit_data(self._agw, "CQ", ["SRC", "RELAY"], buf)
@@ -279,14 +474,27 @@ class AGWDataPath(DataPath):
     def get_agw_connection(self):
         return self._agw
 
+    def fileno(self):
+        if not self._agw:
+            return None
+        return self._agw.fileno()
+
     def read_all_waiting(self):
-        return agw.receive_data(self._agw)
+        data = self.read(0)
+
+        # Frames read by someone waiting for another kind don't make
+        # the socket readable again, so take them all now
+        while self._agw.has_frames("K"):
+            data += self.read(0)
+
+        return data
 
 class SerialDataPath(DataPath):
-    def __init__(self, pathspec, timeout=0.25):
+    def __init__(self, pathspec, timeout=0.25, chunk_size=0):
         DataPath.__init__(self, pathspec, timeout)
 
         (self.port, self.baud) = pathspec
+        self.chunk_size = chunk_size
         self._serial = None
 
     def connect(self):
@@ -295,7 +503,8 @@ class SerialDataPath(DataPath):
                                      baudrate=self.baud,
                                      timeout=self.timeout,
                                      writeTimeout=self.timeout,
-                                     xonxoff=0)
+                                     xonxoff=0,
+                                     chunk_size=self.chunk_size)
         except Exception as e:
             printlog("Comm","        : Serial exception on connect: %s" % e)
             raise DataPathNotConnectedError("Unable to open serial port")
@@ -334,9 +543,21 @@ class SerialDataPath(DataPath):
     def is_connected(self):
         return self._serial != None
 
+    def fileno(self):
+        # Only POSIX serial ports can be select()ed
+        try:
+            return self._serial.fileno()
+        except Exception:
+            return None
+
     def flush(self):
         self._serial.flush()
 
+    def get_flow_stats(self):
+        if self._serial and hasattr(self._serial, "get_flow_stats"):
+            return self._serial.get_flow_stats()
+        return {}
+
     def __str__(self):
         return "[SERIAL %s@%s]" % (self.port, self.baud)
 
@@ -399,70 +620,150 @@ fcstab = [
     0x7bc7, 0x6a4e, 0x58d5, 0x495c, 0x3de3, 0x2c6a, 0x1ef1, 0x0f78
     ]
 
-def compute_fcs(data):
+def compute_fcs_legacy(data):
     fcs = 0xffff
 
-    for byte in data:
-        fcs = (fcs >> 8 ) ^ fcstab[(fcs ^ ord(byte)) & 0xff]
+    for byte in bytearray(data):
+        fcs = (fcs >> 8 ) ^ fcstab[(fcs ^ byte) & 0xff]
     
     return (~fcs) & 0xffff
 
+# The FCS is the bit-reflected form of the CRC that binascii.crc_hqx()
+# computes, so reflect the data and the result instead of looping here
+_BITREV = bytearray([int("{0:08b}".format(i)[::-1], 2) for i in range(256)])
+_BITREV_TABLE = bytes(_BITREV)
+
+def compute_fcs(data):
+    crc = binascii.crc_hqx(bytes(data).translate(_BITREV_TABLE), 0xffff)
+    fcs = (_BITREV[crc & 0xff] << 8) | _BITREV[crc >> 8]
+
+    return (~fcs) & 0xffff
+
+def ax25_address(call, last=False):
+    c, s = agw.ssid(call)
+    field = bytearray([ord(x) << 1 for x in c])
+    field.append((s << 1) | (last and 0x61 or 0x60))
+
+    return bytes(field)
+
+def ax25_ui_header(dest, spath):
+    """Build the address, control and PID fields of a UI frame"""
+    src = b"".join([ax25_address(scall, spath[-1] == scall)
+                    for scall in spath])
+
+    return struct.pack("7s%isBB" % len(src),
+                       ax25_address(dest), # Dest call
+                       src,                # Source path
+                       0x03,               # Control
+                       0xF0)               # PID: No layer 3
+
+def ax25_decode_ui(frame):
+    """Return (dest, source path, info) from a UI frame, or None"""
+    frame = bytearray(frame)
+
+    addrs = []
+    pos = 0
+    while True:
+        if pos + 7 > len(frame):
+            return None
+        field = frame[pos:pos+7]
+        pos += 7
+
+        call = "".join([chr(x >> 1) for x in field[:6]]).strip()
+        ssid = (field[6] >> 1) & 0x0F
+        if ssid:
+            call = "%s-%i" % (call, ssid)
+        addrs.append(call)
+
+        if field[6] & 0x01:
+            break # Last address
+
+    if len(addrs) < 2 or pos + 2 > len(frame):
+        return None
+    elif (frame[pos] & 0xEF) != 0x03:
+        return None # Not UI (ignoring the P/F bit)
+
+    return addrs[0], addrs[1:], bytes(frame[pos+2:])
+
 class TNCAX25DataPath(TNCDataPath):
     def __init__(self, pathspec, **kwargs):
         (port, rate, self.__call, self.__path) = pathspec
 
-        self.__buffer = ""
+        self.__buffer = bytearray()
         TNCDataPath.__init__(self, (port, rate), **kwargs)
 
+        # The addresses never change for the life of the path
+        spath = [self.__call,] + self.__path.split(",")
+        self.__hdr = ax25_ui_header("DRATS", spath)
+
     def __str__(self):
         return "[TNC-AX25 %s@%s>%s]" % (self.port, self.baud, self.__path)
 
     def write(self, buf):
-        spath = [self.__call,] + self.__path.split(",")
-        src = ""
-        for scall in spath:
-            c, s = agw.ssid(scall)
-            src += "".join([chr(ord(x) << 1) for x in c])
-            src += agw.encode_ssid(s, spath[-1] == scall)
-        
-
-        c, s = agw.ssid("DRATS")
-        dst = "".join([chr(ord(x) << 1) for x in c])
-        dst += agw.encode_ssid(s)
-
-        hdr = struct.pack("7s%isBB" % len(src),
-                          dst,     # Dest call
-                          src,     # Source path
-                          0x03,    # Control
-                          0xF0)    # PID: No layer 3
-
-        fcs = compute_fcs(hdr + buf)
-        data = hdr + buf + struct.pack(">H", fcs)
+        fcs = compute_fcs(self.__hdr + buf)
+        data = self.__hdr + buf + struct.pack(">H", fcs)
 
         #printlog("Transmitting AX.25 Frame:")
         #utils.hexprintlog(data)
         TNCDataPath.write(self, data)
 
+    def __decode(self, frame):
+        ui = ax25_decode_ui(frame)
+        if not ui:
+            printlog("Comm","        : [TNC] Dropping non-UI AX.25 frame")
+            return b""
+
+        dest, spath, info = ui
+
+        # We send our own FCS after the data; drop it if it checks out
+        if len(info) >= 2 and \
+                struct.unpack(">H", info[-2:])[0] == compute_fcs(frame[:-2]):
+            info = info[:-2]
+
+        return info
+
+    def __fill(self, size):
+        try:
+            frames = self._serial.read_frames(size)
+        except Exception as e:
+            printlog("Comm","        : Serial read exception: %s" % e)
+            utils.log_exception()
+            raise DataPathIOError("Failed to read from serial port")
+
+        for frame in frames:
+            self.__buffer += self.__decode(frame)
+
     def read(self, count):
-        while len(self.__buffer) < count:
-            chunk = TNCDataPath.read(self, 1)
-            if not chunk:
-                break
-            self.__buffer += chunk
-            
-        data = self.__buffer[:count]
-        self.__buffer = self.__buffer[count:]
+        if len(self.__buffer) < count:
+            self.__fill(count - len(self.__buffer))
+
+        data = bytes(self.__buffer[:count])
+        del self.__buffer[:count]
+        return data
+
+    def read_all_waiting(self):
+        self.__fill(1)
+
+        data = bytes(self.__buffer)
+        del self.__buffer[:]
         return data
 
 class SocketDataPath(DataPath):
+    # Most we take off the socket in one read_all_waiting()
+    RECV_BUFFER = 65536
+
     def __init__(self, pathspec, timeout=0.25):
         DataPath.__init__(self, pathspec, timeout)
 
         self._socket = None
 
+        # Reused by every read, and handed to the caller as a view
+        self._rbuf = bytearray(self.RECV_BUFFER)
+        self._rview = memoryview(self._rbuf)
+
         if isinstance(pathspec, socket.socket):
             self._socket = pathspec
-            self._socket.settimeout(self.timeout)
+            self._socket.setblocking(False)
             self.can_reconnect = False
             self.host = "(incoming)"
             self.port = 0
@@ -551,77 +852,116 @@ class SocketDataPath(DataPath):
         if self.passwd is not None:
             self.do_auth()
 
+        # From here on we wait with select() rather than the socket
+        self._socket.setblocking(False)
+
     def disconnect(self):
         if self._socket:
             self._socket.close()
         self._socket = None
 
-    def read(self, count):
-        data = ""
-        end = time.time() + self.timeout
+    def _recv_into(self, view, timeout=None):
+        # Receive into @view, waiting up to @timeout for data (or not at
+        # all if None).  Returns the number of bytes received.
+        if timeout is not None:
+            r, w, x = select.select([self._socket], [], [], timeout)
+            if not r:
+                return 0
+
+        try:
+            count = self._socket.recv_into(view)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise DataPathIOError("Socket error: %s" % e)
+
+        if count == 0:
+            raise DataPathIOError("Socket disconnected")
+
+        return count
 
+    def read(self, count):
         if not self._socket:
             raise DataPathIOError("Socket closed")
 
-        self._socket.setblocking(True)
-        self._socket.settimeout(self.timeout)
+        data = bytearray()
+        end = time.time() + self.timeout
 
         while len(data) < count:
-
-            try:
-                x = time.time()
-                inp = self._socket.recv(count - len(data))
-            except socket.timeout:
+            want = min(count - len(data), len(self._rbuf))
+            got = self._recv_into(self._rview[:want],
+                                  max(0, end - time.time()))
+            if not got:
                 if time.time() > end:
                     break
-                else:
-                    continue
-            except Exception as e:
-                raise DataPathIOError("Socket error: %s" % e)
-
-            if inp == "":
-                raise DataPathIOError("Socket disconnected")
+                continue
 
+            data += self._rview[:got]
             end = time.time() + self.timeout
-            data += inp
 
-
-        return data
+        return bytes(data)
 
     def read_all_waiting(self):
+        """Return everything waiting on the socket.
+
+        The result is a memoryview of our receive buffer, so it is
+        only good until the next read.
+        """
         if not self._socket:
             raise DataPathIOError("Socket disconnected")
 
-        self._socket.setblocking(False)
+        got = self._recv_into(self._rview, self.timeout)
+        if not got:
+            return b""
 
-        r, w, x = select.select([self._socket], [], [], self.timeout)
-        if not r:
-            return ""
-
-        data = ""
-        while True:
-            try:
-                d = self._socket.recv(4096)
-            except Exception as e:
+        while got < len(self._rbuf):
+            count = self._recv_into(self._rview[got:])
+            if not count:
                 break
-            if not d:
-                raise DataPathIOError("Socket disconnected")
-            data += d
+            got += count
 
-        return data
+        return self._rview[:got]
 
     def write(self, buf):
-        try:
-            self._socket.sendall(buf)
-        except Exception as e:
-            printlog("Comm","      : Socket write failed: %s" % e)
-            raise DataPathIOError("Socket write failed")
+        if not self._socket:
+            raise DataPathIOError("Socket closed")
+
+        if isinstance(buf, six.text_type):
+            buf = buf.encode("ISO-8859-1")
+        # bytes, bytearray and memoryview all go out as they are
+        view = memoryview(buf)
+
+        timeouts = 0
+        while len(view):
+            try:
+                r, w, x = select.select([], [self._socket], [],
+                                        self.timeout)
+                if not w:
+                    timeouts += 1
+                    if timeouts >= 10:
+                        raise DataPathIOError("Socket write timed out")
+                    continue
+                count = self._socket.send(view)
+                timeouts = 0
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    continue
+                printlog("Comm","      : Socket write failed: %s" % e)
+                raise DataPathIOError("Socket write failed")
+
+            view = view[count:]
 
         return
             
     def is_connected(self):
         return self._socket != None
 
+    def fileno(self):
+        if not self._socket:
+            return None
+        return self._socket.fileno()
+
     def flush(self):
         pass
 
@@ -631,3 +971,215 @@ class SocketDataPath(DataPath):
             return "[NET %s:%i]" % (addr, port)
         except:
             return "[NET closed]"
+
+class SimulatedLink(object):
+    """A half-duplex radio channel shared by two stations.
+
+    Only one end transmits at a time.  Each transmission pays the
+    key-up latency, plus the turnaround delay when the other end was
+    the last to transmit, and then takes len*8/rate seconds of air
+    time.  The receiving end may lose the whole transmission (loss)
+    or get it with bits flipped (ber).  Errors come from a seeded
+    generator, so a given seed damages the same transmissions on
+    every run.
+    """
+
+    def __init__(self, rate=9600, turnaround=0.1, keyup=0.05,
+                 ber=0.0, loss=0.0, seed=None):
+        self.rate = rate
+        self.turnaround = turnaround
+        self.keyup = keyup
+        self.ber = ber
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.__channel = threading.Lock()
+        self.__ends = [None, None]
+        self.__last_end = None
+        self.__last_end_time = 0
+        self.__stats = {
+            "transmissions" : 0,
+            "bytes" : 0,
+            "lost" : 0,
+            "corrupted" : 0,
+            "bit_errors" : 0,
+            "air_time" : 0.0,
+            "busy_time" : 0.0,
+            }
+
+    def attach(self, end, path):
+        self.__ends[end] = path
+
+    def detach(self, end):
+        self.__ends[end] = None
+
+    def __corrupt(self, data):
+        # Skip from one bit error to the next, rather than rolling
+        # for every bit
+        bits = len(data) * 8
+        log_ok = math.log(1.0 - self.ber)
+        errors = 0
+        pos = -1
+        while True:
+            pos += 1 + int(math.log(1.0 - self.random.random()) / log_ok)
+            if pos >= bits:
+                break
+            data[pos >> 3] ^= 1 << (pos & 7)
+            errors += 1
+
+        return errors
+
+    def transmit(self, end, data):
+        self.__channel.acquire()
+        try:
+            start = time.time()
+
+            delay = self.keyup
+            if self.__last_end is not None and self.__last_end != end:
+                delay += max(0, self.turnaround -
+                             (start - self.__last_end_time))
+            air = len(data) * 8.0 / self.rate
+
+            time.sleep(delay + air)
+
+            self.__last_end = end
+            self.__last_end_time = time.time()
+
+            self.__stats["transmissions"] += 1
+            self.__stats["bytes"] += len(data)
+            self.__stats["air_time"] += air
+            self.__stats["busy_time"] += self.__last_end_time - start
+
+            peer = self.__ends[1 - end]
+            if peer is None:
+                return
+
+            if self.loss and self.random.random() < self.loss:
+                self.__stats["lost"] += 1
+                return
+
+            data = bytearray(data)
+            if self.ber:
+                errors = self.__corrupt(data)
+                if errors:
+                    self.__stats["corrupted"] += 1
+                    self.__stats["bit_errors"] += errors
+
+            peer._received(bytes(data))
+        finally:
+            self.__channel.release()
+
+    def get_stats(self):
+        return dict(self.__stats)
+
+class SimulatedDataPath(DataPath):
+    """One end of a SimulatedLink"""
+
+    def __init__(self, pathspec, timeout=0.25):
+        DataPath.__init__(self, pathspec, timeout)
+        self.link, self.end = pathspec
+        self.can_reconnect = False
+
+        self.__connected = False
+        self.__rcond = threading.Condition()
+        self.__rbuf = bytearray()
+        self.__wake_r = self.__wake_w = None
+
+    def connect(self):
+        if os.name == "posix" and self.__wake_r is None:
+            import fcntl
+            self.__wake_r, self.__wake_w = os.pipe()
+            for fd in (self.__wake_r, self.__wake_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.link.attach(self.end, self)
+        self.__connected = True
+
+    def disconnect(self):
+        self.__connected = False
+        self.link.detach(self.end)
+
+        self.__rcond.acquire()
+        self.__rcond.notify_all()
+        self.__rcond.release()
+
+        if self.__wake_r is not None:
+            os.close(self.__wake_r)
+            os.close(self.__wake_w)
+            self.__wake_r = self.__wake_w = None
+
+    def _received(self, data):
+        self.__rcond.acquire()
+        self.__rbuf += data
+        self.__rcond.notify_all()
+        if self.__wake_w is not None:
+            try:
+                os.write(self.__wake_w, b"!")
+            except OSError:
+                pass
+        self.__rcond.release()
+
+    def __take(self, count):
+        data = bytes(self.__rbuf[:count])
+        del self.__rbuf[:count]
+
+        if not self.__rbuf and self.__wake_r is not None:
+            try:
+                while os.read(self.__wake_r, 4096):
+                    pass
+            except OSError:
+                pass
+
+        return data
+
+    def read(self, count):
+        self.__rcond.acquire()
+        try:
+            if not self.__rbuf and self.__connected:
+                self.__rcond.wait(self.timeout)
+            if not self.__connected:
+                raise DataPathNotConnectedError("Simulated link is closed")
+            return self.__take(count)
+        finally:
+            self.__rcond.release()
+
+    def read_all_waiting(self):
+        self.__rcond.acquire()
+        try:
+            return self.__take(len(self.__rbuf))
+        finally:
+            self.__rcond.release()
+
+    def write(self, buf):
+        if not self.__connected:
+            raise DataPathNotConnectedError("Simulated link is closed")
+        if not isinstance(buf, bytes):
+            buf = buf.encode("ISO-8859-1")
+
+        # Returns once the transmission is over, like a radio would
+        self.link.transmit(self.end, buf)
+
+    def flush(self):
+        pass
+
+    def is_connected(self):
+        return self.__connected
+
+    def fileno(self):
+        return self.__wake_r
+
+    def __str__(self):
+        return "[SIM %i baud end %i]" % (self.link.rate, self.end)
+
+def simulated_pair(rate=9600, turnaround=0.1, keyup=0.05,
+                   ber=0.0, loss=0.0, seed=None):
+    """Return two connected SimulatedDataPaths sharing one SimulatedLink"""
+    link = SimulatedLink(rate, turnaround, keyup, ber, loss, seed)
+
+    a = SimulatedDataPath((link, 0))
+    b = SimulatedDataPath((link, 1))
+    a.connect()
+    b.connect()
+
+    return a, b
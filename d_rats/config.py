@@ -155,6 +155,15 @@ _DEF_SETTINGS = {
     "warmup_length" : "16",                 #changed from 8 to 16 in 0.3.6
     "warmup_timeout" : "0",                #changed from 3 to 0 in 0.3.6
     "force_delay" : "-2",
+    "compress_dict" : "True",
+    "aggregate_frames" : "False",
+    "extended_sessions" : "True",
+    "stream_transfers" : "True",
+    "tx_rate" : "0",
+    "max_keydown" : "0",
+    "min_tx_gap" : "0",
+    "duty_cycle" : "100",
+    "serial_chunk_size" : "0",
     "ping_info" : "",
     "smtp_server" : "",
     "smtp_replyto" : "",
@@ -1210,6 +1219,42 @@ class DratsTransfersPanel(DratsPanel):
         val.add_numeric(-32, 32, 1)
         self.mv(_("Force transmission delay"), val)
 
+        val = DratsConfigWidget(config, "settings", "compress_dict")
+        val.add_bool()
+        self.mv(_("Compression dictionary"), val)
+
+        val = DratsConfigWidget(config, "settings", "aggregate_frames")
+        val.add_bool()
+        self.mv(_("Aggregate frames"), val)
+
+        val = DratsConfigWidget(config, "settings", "extended_sessions")
+        val.add_bool()
+        self.mv(_("Extended session windows"), val)
+
+        val = DratsConfigWidget(config, "settings", "stream_transfers")
+        val.add_bool()
+        self.mv(_("Stream file transfers"), val)
+
+        val = DratsConfigWidget(config, "settings", "tx_rate", True)
+        val.add_numeric(0, 100000, 10)
+        self.mv(_("Transmit rate limit (bytes/sec)"), val)
+
+        val = DratsConfigWidget(config, "settings", "max_keydown", True)
+        val.add_numeric(0, 600, 1)
+        self.mv(_("Maximum key-down time (sec)"), val)
+
+        val = DratsConfigWidget(config, "settings", "min_tx_gap", True)
+        val.add_numeric(0, 60, 0.5, 1)
+        self.mv(_("Minimum gap between transmissions (sec)"), val)
+
+        val = DratsConfigWidget(config, "settings", "duty_cycle", True)
+        val.add_numeric(1, 100, 1)
+        self.mv(_("Transmit duty cycle (%)"), val)
+
+        val = DratsConfigWidget(config, "settings", "serial_chunk_size", True)
+        val.add_numeric(0, 4096, 8)
+        self.mv(_("Serial write chunk size"), val)
+
         val = DratsConfigWidget(config, "settings", "delete_from")
         val.add_text()
         self.mv(_("Allow file deletes from"), val)
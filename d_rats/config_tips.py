@@ -29,6 +29,15 @@ TIPS_SETTINGS = {
     "mapdir" : _("Alternate location to store cached map images"),
     "warmup_length" : _("Amount of bytes to to prefix to each packet during a warmup cycle after a period of idle"),
     "warmup_timeout" : _("Amount of seconds between transmissions that must pass before we send a warmup block to open the power-save circuits on handhelds"),    
+    "compress_dict" : _("Use a preset compression dictionary for frames to stations that support it"),
+    "aggregate_frames" : _("Send frames queued back-to-back for stations that support it as a single block, to save airtime and key-ups"),
+    "extended_sessions" : _("Use 16-bit block numbers, selective ACKs and a window sized to the link in sessions with stations that support them"),
+    "stream_transfers" : _("Compress and send files a piece at a time, and resume them by file position, with stations that support it"),
+    "tx_rate" : _("Average number of bytes per second a port may transmit (0 for no limit)"),
+    "max_keydown" : _("Longest single transmission in seconds; frames are grouped up to this limit (0 for no limit)"),
+    "min_tx_gap" : _("Quiet time in seconds to leave between transmissions on a port"),
+    "duty_cycle" : _("Percentage of any ten minute period a port may spend transmitting"),
+    "serial_chunk_size" : _("Bytes written to a serial radio between XON/XOFF checks (0 to tune automatically to the radio's buffer)"),
     "force_delay" : _("Amount of seconds to wait between transmissions (a positive number is a fixed delay, a negative value means 'randomly choose between 0 and X')"),
     "delete_from" : _("Comma-separated list of callsigns that may delete files remotely"),
     "remote_admin_passwd" : _("Password required for remote administration tasks (blank for none)"),
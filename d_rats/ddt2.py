@@ -23,7 +23,9 @@ from .debug import printlog
 import struct
 import zlib
 import base64
+import binascii
 import sys
+import time
 from . import yencode
 
 import threading
@@ -34,6 +36,43 @@ from six.moves import range
 ENCODED_HEADER = b"[SOB]"
 ENCODED_TRAILER = b"[EOB]"
 
+MAGIC_ZLIB  = 0xDD
+MAGIC_RAW   = 0x22 # ~MAGIC_ZLIB
+MAGIC_ZDICT = 0xDE # zlib with the ZDICT preset dictionary
+
+# Preset dictionary of common chat, form and position report strings.
+# Only used for frames to stations that advertised CAP_ZDICT, because
+# older stations do not know MAGIC_ZDICT.  Never change this without
+# also changing MAGIC_ZDICT.
+ZDICT = (b"$GPGGA,$GPRMC,$$CRC,W,1,0,M,,*,N,"
+         b"ACK NAK RESUME:OK Ping Request Running D-RATS "
+         b"<entry type='multiline'/><entry type='choice'>"
+         b"<entry type='toggle'>False</entry><entry type='date'>"
+         b"<entry type='time'><entry type='label'>"
+         b"<title>Email Message</title><caption>Message</caption>"
+         b"<caption>Subject</caption><caption>Date</caption>"
+         b"<caption>Time</caption><caption>From</caption>"
+         b"<caption>To</caption><field id='_auto_sender'>"
+         b"<field id='_auto_recip'><field id='_auto_subject'>"
+         b"<field id='_auto_message'><field id='_auto_number'>"
+         b"<field id='subject'><field id='message'>"
+         b"<field id='recip'><field id='sender'>"
+         b"<entry type='text'></entry></field>\n"
+         b"<?xml version=\"1.0\"?>\n<xml>\n  <form id='email'>\n"
+         b"</form>\n</xml>\n  CQCQCQ the and you for that this with ")
+ZDICT_SUPPORTED = sys.version_info[:2] >= (3, 3)
+
+def compress_level_for_rate(rate):
+    # On slow RF links airtime costs far more than CPU, so squeeze as
+    # hard as possible.  On fast (network) links the reverse is true.
+    # The rate is in the units of DDT2Frame.get_xmit_bps()
+    if not rate or rate < 2400:
+        return 9
+    elif rate < 64000:
+        return 6
+    else:
+        return 1
+
 
 def update_crc(c, crc):
     # python 2 compatibility hack
@@ -57,7 +96,7 @@ def update_crc(c, crc):
 
     return crc & 0xFFFF
 
-def calc_checksum(data):
+def calc_checksum_legacy(data):
     checksum = 0
     for i in data:
         checksum = update_crc(i, checksum)
@@ -66,6 +105,20 @@ def calc_checksum(data):
     checksum = update_crc(0, checksum)
     return checksum
 
+def crc16(data, crc=0):
+    # The bit-wise update_crc() above, flushed with two zero bytes, is
+    # the augmented form of CRC-16/XMODEM (poly 0x1021, init 0).
+    # binascii.crc_hqx() is the table-driven C implementation of the
+    # same CRC, and it takes bytes, bytearray or memoryview without
+    # copying.  Pass the previous result as crc to continue over
+    # several buffers.
+    if (sys.version_info[0] > 2) and isinstance(data, str):
+        data = data.encode('ISO-8859-1')
+    return binascii.crc_hqx(data, crc)
+
+def calc_checksum(data):
+    return crc16(data)
+
 def encode(data):
     return yencode.yencode_buffer(data)
 
@@ -77,23 +130,52 @@ class DDT2Frame(object):
     cso = 6
     csl = 2
 
+    # Changing any of these invalidates the cached packed frame
+    _packed_fields = ("magic", "seq", "session", "type",
+                      "s_station", "d_station", "data", "compress",
+                      "compress_level", "zdict")
+
+    def __setattr__(self, name, value):
+        if name in self._packed_fields and \
+                self.__dict__.get(name) != value:
+            self.invalidate()
+        object.__setattr__(self, name, value)
+
     def __init__(self):
+        self.invalidate()
+
         self.seq = 0
         self.session = 0
         self.type = 0
         self.d_station = ""
         self.s_station = ""
         self.data = ""
-        self.magic = 0xDD
+        self.magic = MAGIC_ZLIB
 
         self.sent_event = threading.Event()
         self.ackd_event = threading.Event()
+        self.on_sent = None # Called from the port's thread by set_sent()
 
         self.compress = True
+        self.compress_level = 9
+        self.zdict = False
+
+        self.priority = None # Outbound queue class (transport.PRI_*)
 
         self._xmit_s = 0
         self._xmit_e = 0
         self._xmit_z = 0
+        self._wire_z = 0 # Size on the wire, as received by unpack()
+
+    def invalidate(self):
+        # Mutating data in place (e.g. a bytearray) must call this
+        self.__dict__["_packed"] = None
+        self.__dict__["_encoded"] = None
+
+    def set_sent(self):
+        self.sent_event.set()
+        if self.on_sent:
+            self.on_sent(self)
 
     def get_xmit_bps(self):
         if not self._xmit_e:
@@ -108,14 +190,32 @@ class DDT2Frame(object):
     def set_compress(self, compress=True):
         self.compress = compress
 
+    def _compress(self, data):
+        if self.zdict and ZDICT_SUPPORTED:
+            z = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                 zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY,
+                                 ZDICT)
+            return MAGIC_ZDICT, z.compress(data) + z.flush()
+        else:
+            return self.magic, zlib.compress(data, self.compress_level)
+
     def get_packed(self):
+        if self._packed is not None:
+            return self._packed
+
         data = self.data
         if (sys.version_info[0] > 2) and isinstance(data, str):
             data = self.data.encode('ISO-8859-1')
+        elif isinstance(data, (bytearray, memoryview)):
+            # As unpack() leaves them on python2; zlib wants bytes
+            data = yencode.to_bytes(data)
+        magic = (~self.magic) & 0xFF
         if self.compress:
-            data = zlib.compress(data, 9)
-        else:
-            self.magic = (~self.magic) & 0xFF
+            zmagic, zdata = self._compress(data)
+            # Short and already-compressed payloads are sent as-is when
+            # compressing them would not make the frame any smaller
+            if len(zdata) < len(data):
+                magic, data = zmagic, zdata
 
         length = len(data)
         
@@ -133,7 +233,7 @@ class DDT2Frame(object):
             d_station = self.d_station.ljust(8, "~")
 
         val = struct.pack(self.format,
-                          self.magic,
+                          magic,
                           self.seq,
                           self.session,
                           self.type,
@@ -142,10 +242,10 @@ class DDT2Frame(object):
                           s_station,
                           d_station)
 
-        checksum = calc_checksum(val + data)
+        checksum = crc16(data, crc16(val))
 
         val = struct.pack(self.format,
-                          self.magic,
+                          magic,
                           self.seq,
                           self.session,
                           self.type,
@@ -155,17 +255,22 @@ class DDT2Frame(object):
                           d_station)
 
         self._xmit_z = len(val) + len(data)
+        self._packed = val + data
 
-        return val + data
+        return self._packed
 
     def unpack(self, val):
         magic = val[0]
         # python2 compatibility hack
         if isinstance(magic, str):
             magic = ord(val[0])
-        if magic == 0xDD:
+        if magic == MAGIC_ZLIB:
             self.compress = True
-        elif magic == 0x22:
+            self.zdict = False
+        elif magic == MAGIC_ZDICT and ZDICT_SUPPORTED:
+            self.compress = True
+            self.zdict = True
+        elif magic == MAGIC_RAW:
             self.compress = False
         else:
             printlog(("Ddt2      : Magic 0x%X not recognized" % magic))
@@ -188,16 +293,24 @@ class DDT2Frame(object):
                               self.s_station,
                               self.d_station)
 
-        _checksum = calc_checksum(_header + data)
+        _checksum = crc16(data, crc16(_header))
 
         self.s_station = self.s_station.replace(b"~", b"")
         self.d_station = self.d_station.replace(b"~", b"")
+        if sys.version_info[0] > 2:
+            # Callsigns are str everywhere above us, including the keys
+            # of the per-station tables
+            self.s_station = self.s_station.decode("ISO-8859-1")
+            self.d_station = self.d_station.decode("ISO-8859-1")
 
         if _checksum != checksum:
             printlog(("Ddt2      : Checksum failed: %s != %s" % (checksum, _checksum)))
             return False
 
-        if self.compress:
+        if self.zdict:
+            z = zlib.decompressobj(zlib.MAX_WBITS, ZDICT)
+            self.data = z.decompress(data) + z.flush()
+        elif self.compress:
             if sys.version_info[0] > 2:
                self.data = zlib.decompress(data)
             else:
@@ -206,6 +319,9 @@ class DDT2Frame(object):
         else:
             self.data = data
 
+        self._packed = bytes(val)
+        self._xmit_z = self._wire_z = len(val)
+
         return True
 
     def __str__(self):
@@ -245,15 +361,28 @@ class DDT2Frame(object):
         f.d_station = self.d_station
         f.data = self.data
         f.set_compress(self.compress)
+        f.compress_level = self.compress_level
+        f.zdict = self.zdict
+        f.priority = self.priority
+
+        # Same contents, so the copy can reuse our packed frame
+        f._packed = self._packed
+        f._encoded = self._encoded
+        f._xmit_z = self._xmit_z
         return f
 
 class DDT2EncodedFrame(DDT2Frame):
     def get_packed(self):
+        if self._encoded is not None:
+            return self._encoded
+
         raw = DDT2Frame.get_packed(self)
 
         encoded = encode(raw)
 
-        return ENCODED_HEADER + encoded + ENCODED_TRAILER
+        self._encoded = ENCODED_HEADER + encoded + ENCODED_TRAILER
+
+        return self._encoded
 
     def unpack(self, val):
         try:
@@ -273,7 +402,13 @@ class DDT2EncodedFrame(DDT2Frame):
             printlog(("Ddt2      : Unable to decode frame: %s" % e))
             return False
 
-        return DDT2Frame.unpack(self, decoded)
+        if not DDT2Frame.unpack(self, decoded):
+            return False
+
+        self._encoded = bytes(val[h-len(ENCODED_HEADER):t+len(ENCODED_TRAILER)])
+        self._wire_z = len(self._encoded)
+
+        return True
 
 class DDT2RawData(DDT2Frame):
     def get_packed(self):
@@ -311,7 +446,72 @@ def test_crap():
     except Exception as e:
         printlog("Ddt2","      : PASS")
 
+def test_compress_policy():
+    import os
+
+    fail = 0
+    for data, zdict in [(b"Hi", False),
+                        (os.urandom(512), False),
+                        (b"<entry type='text'>Hello</entry>" * 4, False),
+                        (b"<entry type='text'>Hello</entry>" * 4, True)]:
+        fin = DDT2EncodedFrame()
+        fin.s_station = "FOO"
+        fin.d_station = "BAR"
+        fin.data = data
+        fin.zdict = zdict
+        packed = DDT2Frame.get_packed(fin)
+
+        fout = DDT2EncodedFrame()
+        if not fout.unpack(fin.get_packed()) or fout.data != data:
+            fail += 1
+        elif len(packed) > 25 + len(data):
+            fail += 1
+
+    if fail:
+        printlog("Ddt2", "      : Compression policy FAIL (%i)" % fail)
+    else:
+        printlog("Ddt2", "      : Compression policy PASS")
+
+def test_crc_compat():
+    import os
+
+    fail = 0
+    for size in [0, 1, 2, 25, 64, 255, 1024, 1049]:
+        data = os.urandom(size)
+        legacy = calc_checksum_legacy(data)
+        for buf in [data, bytearray(data), memoryview(data)]:
+            if calc_checksum(buf) != legacy:
+                fail += 1
+        if crc16(data[size // 2:], crc16(data[:size // 2])) != legacy:
+            fail += 1
+
+    if fail:
+        printlog("Ddt2", "      : CRC compat FAIL (%i mismatches)" % fail)
+    else:
+        printlog("Ddt2", "      : CRC compat PASS")
+
+def bench_crc(size=1049, count=200):
+    import os
+
+    data = os.urandom(size)
+
+    start = time.time()
+    for i in range(count):
+        calc_checksum_legacy(data)
+    legacy = time.time() - start
+
+    start = time.time()
+    for i in range(count):
+        calc_checksum(data)
+    table = time.time() - start
+
+    printlog("Ddt2", "      : CRC of %i x %i bytes: legacy %.3f sec, "
+             "table %.3f sec" % (count, size, legacy, table))
+
 if __name__ == "__main__":
     test_symmetric()
     test_symmetric(False)
     test_crap()
+    test_compress_policy()
+    test_crc_compat()
+    bench_crc()
@@ -1,5 +1,8 @@
 
 from __future__ import print_function
+import sys
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 
 
@@ -21,6 +24,7 @@ def printlog(arg1, *args):
                      'Formbuilder',      # d_rats\formbuilder.py     
                      'Formgui',          # d_rats\formgui.py
                      'Gps',              # d_rats\gps.py
+                     'HashIndex',        # d_rats\hashindex.py
                      'Geocode',          # geocode.py      
                      'Mainapp',          # mainapp.py'
                      'Mainchat',         # d_rats\ui\main_chat.py
@@ -40,8 +44,10 @@ def printlog(arg1, *args):
                      'Msgrouting',        # d_rats\msgrouting.py                    
                      'Qst',              # d_rats\qst.py
                      'RPC',              # d_rats\sessions\rpc.py
+                     'Scheduler',        # d_rats\sessions\scheduler.py
                      'SessCoord',        # d_rats\session_coordinator.py
                      'Sessionmgr',       # Sessionmanager.py  
+                     'Simbench',         # d_rats\simbench.py
                      'Subst',            # d_rats\subst.py
                      
                      'Transport',        # d_rats\transport.py
@@ -91,3 +97,45 @@ def printlog(arg1, *args):
         print(date_time, arg1, *args)
     else:
         print(date_time, "x", arg1, *args)
+
+
+class _QuietStream(object):
+    """Stands in for sys.stdout, keeping only the last few lines"""
+
+    def __init__(self, keep):
+        self.tail = deque(maxlen=keep)
+        self._line = ""
+
+    def write(self, data):
+        lines = (self._line + data).split("\n")
+        self._line = lines.pop()
+        self.tail.extend(lines)
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def quiet(enabled=True, keep=50):
+    '''Discard what is printed inside the block, as the benchmarks do
+    to keep per-frame logging out of their timings.  If the block
+    raises, the last keep lines it printed are written out before the
+    exception carries on, so what led up to it is not lost'''
+    if not enabled:
+        yield
+        return
+
+    stdout = sys.stdout
+    stream = _QuietStream(keep)
+    sys.stdout = stream
+    try:
+        yield
+    except:
+        sys.stdout = stdout
+        if stream._line:
+            stream.tail.append(stream._line)
+        for line in stream.tail:
+            print(line)
+        raise
+    finally:
+        sys.stdout = stdout
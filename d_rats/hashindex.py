@@ -0,0 +1,343 @@
+#!/usr/bin/python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Content hashes of the files a station already has, so that file and
+# form transfers can skip sending what the other end holds.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+#importing printlog() wrapper
+from .debug import printlog
+
+import os
+import re
+import json
+import hashlib
+import threading
+
+HASH_CHUNK = 1 << 16
+
+# Seconds between rescans of an index's directories
+REFRESH_INTERVAL = 300
+
+# The routing path a form collects at every station it passes through
+_FORM_PATH = re.compile(b"<path>.*?</path>|<path/>", re.DOTALL)
+
+def hash_file(filename):
+    """Return the SHA-256 of a file, as hex"""
+    hash = hashlib.sha256()
+    f = open(filename, "rb")
+    try:
+        while True:
+            data = f.read(HASH_CHUNK)
+            if not data:
+                break
+            hash.update(data)
+    finally:
+        f.close()
+
+    return hash.hexdigest()
+
+def hash_form(filename):
+    """Return the SHA-256 of a form without its routing path, so that
+    copies that came by different routes hash the same"""
+    f = open(filename, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    return hashlib.sha256(_FORM_PATH.sub(b"", data)).hexdigest()
+
+class HashIndex(object):
+    """Content hashes of every file under a set of directories, plus
+    the hash each received file had as it arrived (a stored file may be
+    changed afterwards).
+
+    Lookups only consult the tables.  The directories are walked, and
+    new or changed files hashed, by refresh(), which start() runs in
+    the background every REFRESH_INTERVAL seconds or when poked.  The
+    index is kept in cachefile between runs.
+    """
+
+    def __init__(self, dirs, cachefile=None, hashfn=hash_file):
+        self.dirs = list(dirs)
+        self.cachefile = cachefile
+        self.hashfn = hashfn
+
+        self._lock = threading.Lock()
+        self._files = {}    # path: [size, mtime, hash]
+        self._hashes = {}   # hash: path, from _files
+        self._received = {} # hash: path
+        self._dirty = False
+
+        self._poke = threading.Event()
+        self._thread = None
+
+        self._load()
+
+    def _load(self):
+        if not self.cachefile or not os.path.exists(self.cachefile):
+            return
+
+        try:
+            f = open(self.cachefile)
+            cache = json.load(f)
+            f.close()
+            self._set_files(cache.get("files", {}))
+            self._received = cache.get("received", {})
+        except (IOError, ValueError) as e:
+            printlog("HashIndex"," : Unable to load %s: %s" % \
+                         (self.cachefile, e))
+
+    def _save(self):
+        if not self.cachefile or not self._dirty:
+            return
+
+        try:
+            tmp = self.cachefile + ".tmp"
+            f = open(tmp, "w")
+            json.dump({"files" : self._files,
+                       "received" : self._received}, f)
+            f.close()
+            if os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+            os.rename(tmp, self.cachefile)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            printlog("HashIndex"," : Unable to save %s: %s" % \
+                         (self.cachefile, e))
+
+    def _set_files(self, files):
+        # Called with the lock held (or before anyone else has us)
+        self._files = files
+        self._hashes = {}
+        for path, (size, mtime, hash) in files.items():
+            self._hashes[hash] = path
+
+    def set_dirs(self, dirs):
+        self._lock.acquire()
+        changed = self.dirs != list(dirs)
+        self.dirs = list(dirs)
+        self._lock.release()
+
+        if changed:
+            self.poke()
+
+    def _scan(self, dirs, known):
+        files = {}
+        for top in dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                for name in filenames:
+                    if name.endswith(".part") or \
+                            name.endswith(".journal") or \
+                            name.endswith(".lock") or \
+                            name.endswith(".tmp"):
+                        continue
+
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+
+                    entry = known.get(path)
+                    if entry and entry[0] == st.st_size and \
+                            entry[1] == st.st_mtime:
+                        files[path] = entry
+                        continue
+
+                    try:
+                        hash = self.hashfn(path)
+                    except (IOError, OSError):
+                        continue
+
+                    files[path] = [st.st_size, st.st_mtime, hash]
+
+        return files
+
+    def refresh(self):
+        """Rescan the directories, hashing new and changed files.  This
+        walks and reads them, so it belongs on start()'s thread"""
+        self._lock.acquire()
+        dirs = list(self.dirs)
+        known = dict(self._files)
+        self._lock.release()
+
+        files = self._scan(dirs, known)
+
+        self._lock.acquire()
+        try:
+            if files != self._files:
+                self._set_files(files)
+                self._dirty = True
+
+            for hash, path in list(self._received.items()):
+                if not os.path.exists(path):
+                    del self._received[hash]
+                    self._dirty = True
+
+            self._save()
+        finally:
+            self._lock.release()
+
+    def _worker(self, interval):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                printlog("HashIndex"," : Refresh failed: %s" % e)
+
+            self._poke.wait(interval)
+            self._poke.clear()
+
+    def start(self, interval=REFRESH_INTERVAL):
+        """Keep the index up to date from a background thread"""
+        if self._thread:
+            return
+
+        self._thread = threading.Thread(target=self._worker,
+                                        args=(interval,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def poke(self):
+        """Have the background thread rescan now"""
+        self._poke.set()
+
+    def _lookup(self, hash):
+        path = self._hashes.get(hash)
+        if path:
+            size, mtime, _hash = self._files[path]
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st and st.st_size == size and st.st_mtime == mtime:
+                return path
+
+            # Changed or gone since it was hashed
+            self.poke()
+
+        path = self._received.get(hash)
+        if path and os.path.exists(path):
+            return path
+
+        return None
+
+    def lookup(self, hash):
+        """Return the path of a file we have with this hash, or None"""
+        return self.lookup_all([hash]).get(hash)
+
+    def lookup_all(self, hashes):
+        """Return {hash: path} for each of hashes that we have"""
+        self._lock.acquire()
+        try:
+            found = {}
+            for hash in hashes:
+                path = self._lookup(hash)
+                if path:
+                    found[hash] = path
+            return found
+        finally:
+            self._lock.release()
+
+    def add_received(self, hash, path):
+        """Remember that path arrived with this hash"""
+        self._lock.acquire()
+        self._received[hash] = path
+        self._dirty = True
+        self._lock.release()
+
+        # Saved (and the file itself indexed) by the next refresh
+        self.poke()
+
+_INDEXES = {}
+
+def _get_index(name, dirs, config, hashfn):
+    index = _INDEXES.get(name)
+    if not index:
+        index = HashIndex(dirs, config.platform.config_file(name), hashfn)
+        index.start()
+        _INDEXES[name] = index
+    else:
+        index.set_dirs(dirs)
+
+    return index
+
+def get_index(config):
+    """Return the index of the download directory"""
+    return _get_index("hashindex.json", [config.get("prefs", "download_dir")],
+                      config, hash_file)
+
+def get_form_index(config):
+    """Return the index of the form store, by hash_form()"""
+    return _get_index("formindex.json", [config.form_store_dir()],
+                      config, hash_form)
+
+def test_index():
+    import tempfile
+    import shutil
+
+    tmp = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmp, "a.txt")
+        f = open(fn, "wb")
+        f.write(b"hello")
+        f.close()
+
+        hash = hash_file(fn)
+        cache = os.path.join(tmp, "cache", "index.json")
+        os.mkdir(os.path.dirname(cache))
+
+        index = HashIndex([tmp], cache)
+        assert index.lookup(hash) is None # Not scanned yet
+        index.refresh()
+        assert index.lookup(hash) == fn
+        assert index.lookup("0" * 64) is None
+
+        # Received under one hash, then changed on disk
+        index.add_received("1" * 64, fn)
+        f = open(fn, "wb")
+        f.write(b"hello again")
+        f.close()
+        assert index.lookup(hash) is None
+        assert index.lookup("1" * 64) == fn
+
+        # And it all survives a restart
+        index.refresh()
+        index = HashIndex([tmp], cache)
+        found = index.lookup_all([hash_file(fn), "1" * 64, "2" * 64])
+        assert set(found.keys()) == set([hash_file(fn), "1" * 64])
+
+        # Forms hash the same whatever route they took
+        form = b"<form id='x'>%s<field id='a'>b</field></form>"
+        a = os.path.join(tmp, "a.xml")
+        b = os.path.join(tmp, "b.xml")
+        for fn, path in [(a, b"<path><e>A</e></path>"),
+                         (b, b"<path><e>A</e><e>B</e></path>")]:
+            f = open(fn, "wb")
+            f.write(form.replace(b"%s", path))
+            f.close()
+        assert hash_form(a) == hash_form(b)
+        assert hash_file(a) != hash_file(b)
+
+        printlog("HashIndex"," : Index test passed")
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    test_index()
@@ -304,7 +304,8 @@ class MainApp(object):
 
             path = comm.SocketDataPath((host, int(sport), call, rate))
         else:
-            path = comm.SerialDataPath((port, int(rate)))
+            chunk = self.config.getint("settings", "serial_chunk_size")
+            path = comm.SerialDataPath((port, int(rate)), chunk_size=chunk)
 
         if name in self.__pipes:
             raise Exception("Port %s already started!" % name)
@@ -320,6 +321,15 @@ class MainApp(object):
             "warmup_length" : self.config.getint("settings", "warmup_length"),
             "warmup_timeout" : self.config.getint("settings", "warmup_timeout"),
             "force_delay" : self.config.getint("settings", "force_delay"),
+            "zdict" : self.config.getboolean("settings", "compress_dict"),
+            "aggregate" : self.config.getboolean("settings", "aggregate_frames"),
+            "seq16" : self.config.getboolean("settings", "extended_sessions"),
+            "sack" : self.config.getboolean("settings", "extended_sessions"),
+            "file_stream" : self.config.getboolean("settings", "stream_transfers"),
+            "tx_rate" : self.config.getint("settings", "tx_rate"),
+            "max_keydown" : self.config.getint("settings", "max_keydown"),
+            "min_tx_gap" : self.config.getfloat("settings", "min_tx_gap"),
+            "duty_cycle" : self.config.getint("settings", "duty_cycle") / 100.0,
             "msg_fn" : transport_msg,
             }
 
@@ -775,6 +785,14 @@ class MainApp(object):
     def __outgoing_chat_message(self, object, src, dst, data, port=None):
         self.__chat(src, dst, data, False, port)
 
+    def __get_port_stats(self, object, port):
+        if port in self.sm:
+            sm, sc = self.sm[port]
+            stats = sm.get_link_stats()
+            stats["peers"] = sm.get_peer_stats()
+            return stats
+        return {}
+
     def __get_station_list(self, object):
         stations = {}
         for port, (sm, sc) in self.sm.items():
@@ -1097,6 +1115,7 @@ class MainApp(object):
             "incoming-chat-message" : self.__incoming_chat_message,
             "outgoing-chat-message" : self.__outgoing_chat_message,
             "get-station-list" : self.__get_station_list,
+            "get-port-stats" : self.__get_port_stats,
             "get-message-list" : self.__get_message_list,
             "submit-rpc-job" : self.__submit_rpc_job,
             "event" : self.__event,
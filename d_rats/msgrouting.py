@@ -59,6 +59,10 @@ import traceback
 
 CALL_TIMEOUT_RETRY = 300
 
+# Don't hand a port more mail while it needs longer than this (in
+# seconds) to send what it already has queued
+PORT_BUSY_DRAIN = 60
+
 MSG_LOCK_LOCK = threading.Lock()
 
 def __msg_lockfile(fn):
@@ -213,6 +217,7 @@ class MessageRoute(object):
 class MessageRouter(gobject.GObject):
     __gsignals__ = {
         "get-station-list" : signals.GET_STATION_LIST,
+        "get-port-stats" : signals.GET_PORT_STATS,
         "user-send-form" : signals.USER_SEND_FORM,
         "form-sent" : signals.FORM_SENT,
         "form-received" : signals.FORM_RECEIVED,
@@ -314,7 +319,16 @@ class MessageRouter(gobject.GObject):
         return False
 
     def _port_free(self, port):
-        return port not in self.__sent_port
+        if port in self.__sent_port:
+            return False
+
+        stats = self.emit("get-port-stats", port) or {}
+        drain = stats.get("drain_time", 0)
+        if drain > PORT_BUSY_DRAIN:
+            self._p("Port %s needs %i sec to drain" % (port, drain))
+            return False
+
+        return True
 
     def _route_msg(self, src, dst, path, slist, routes):
         invalid = []
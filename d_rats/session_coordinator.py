@@ -32,6 +32,7 @@ from . import formgui
 from . import emailgw
 from . import signals
 from . import msgrouting
+from . import hashindex
 from .utils import run_safe, run_gtk_locked
 
 from d_rats.sessions import base, file, form, sock
@@ -138,8 +139,12 @@ class FileRecvThread(FileBaseThread):
     progress_key = "recv_size"
     
     def worker(self, path):
-        fn = self.session.recv_file(path)
-        if fn:
+        fn = self.session.recv_file(path,
+                                    hashindex.get_index(self.coord.config))
+        if fn and self.session.have_file:
+            self.completed("file %s (%s)" % (os.path.basename(fn),
+                                             _("already here")))
+        elif fn:
             self.completed("file %s" % os.path.basename(fn))
             self.coord.session_newfile(self.session, fn)
         else:
@@ -165,13 +170,17 @@ class FormRecvThread(FileBaseThread):
         if not msgrouting.msg_lock(newfn):
             printlog("SessCoord : AIEE! Unable to lock incoming new message file!")
 
-        fn = self.session.recv_file(newfn)
+        fn = self.session.recv_file(newfn,
+                                    hashindex.get_form_index(self.coord.config))
 
         name = "%s %s %s" % (self.session.name,
                                _("from"),
                                self.session.get_station())
 
-        if fn == newfn:
+        if fn and self.session.have_file:
+            msgrouting.msg_unlock(newfn)
+            self.completed("form (%s)" % _("already here"))
+        elif fn == newfn:
             form = formgui.FormFile(fn)
             form.add_path_element(self.coord.config.get("user", "callsign"))
             form.save_to(fn)
@@ -246,7 +255,7 @@ class SocketThread(SessionThread):
             printlog("SessCoord"," : Waited %f sec for socket" % (time.time() - t))
             
             try:
-                rd = self.session.read(512)
+                view = self.session.peek(4096)
             except base.SessionClosedError as e:
                 printlog("SessCoord"," : Session closed")
                 self.enabled = False
@@ -258,9 +267,10 @@ class SocketThread(SessionThread):
                 printlog("SessCoord"," : Sending socket data (%i)" % len(sd))
                 self.session.write(sd)
 
-            if rd:
-                printlog("SessCoord"," : Sending radio data (%i)" % len(rd))
-                sock.sendall(rd)
+            if len(view):
+                printlog("SessCoord"," : Sending radio data (%i)" % len(view))
+                sock.sendall(view)
+                self.session.consume(len(view))
         
         printlog("SessCoord"," : Closing session")
 
@@ -483,6 +493,11 @@ class SessionCoordinator(gobject.GObject):
 
         self.socket_listeners = {}
 
+        # Start indexing what we already have, so that offers of it can
+        # be answered by the time they arrive
+        hashindex.get_index(config)
+        hashindex.get_form_index(config)
+
     def shutdown(self):
         for dport, listener in self.socket_listeners.items():
             printlog("SessCoord"," : Stopping TCP:%i" % dport)
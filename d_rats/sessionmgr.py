@@ -21,6 +21,7 @@ from __future__ import print_function
 #importing printlog() wrapper
 from .debug import printlog
 
+import sys
 import time
 import threading
 import os
@@ -31,7 +32,8 @@ from .ddt2 import DDT2EncodedFrame
 from . import transport
 
 from .sessions import base, control, stateful, stateless
-from .sessions import file, form, sock, sniff
+from .sessions import file, form, sock
+from .sessions import congestion, scheduler
 from six.moves import range
 
 class SessionManager(object):
@@ -40,15 +42,34 @@ class SessionManager(object):
         if self.tport:
             self.tport.disable()
 
-        self.tport = transport.Transporter(self.pipe,
-                                           inhandler=self.incoming,
-                                           **kwargs)
+        engine = kwargs.pop("engine", "thread")
+        if engine == "asyncio" and sys.version_info[0] < 3:
+            printlog("Sessionmgr",": asyncio engine needs Python 3, using threads")
+            engine = "thread"
+
+        if engine == "asyncio":
+            # Imported here because it needs Python 3
+            from . import aiotransport
+            cls = aiotransport.AsyncTransporter
+            self.session_driver = aiotransport.AsyncSessionDriver()
+        else:
+            cls = transport.Transporter
+            if not isinstance(self.session_driver,
+                              scheduler.SessionScheduler):
+                self.session_driver = scheduler.SessionScheduler()
+
+        self.tport = cls(self.pipe, inhandler=self.incoming, **kwargs)
+
+        if self.control:
+            self.control.send_caps()
 
     def set_call(self, callsign):
         self.station = callsign
 
     def __init__(self, pipe, station, **kwargs):
         self.pipe = self.tport = None
+        self.control = None
+        self.session_driver = None
         self.station = station
 
         self.sniff_session = None
@@ -56,6 +77,9 @@ class SessionManager(object):
         self.last_frame = 0
         self.sessions = {}
         self.session_cb = {}
+        self._stations_heard = {}
+        self._rtt = {}
+        self._congestion = {}
 
         self.set_comm(pipe, **kwargs)
 
@@ -64,8 +88,7 @@ class SessionManager(object):
 
         self.control = control.ControlSession()
         self._register_session(self.control, "CQCQCQ", "new,out")
-
-        self._stations_heard = {}
+        self.control.send_caps()
 
     def get_heard_stations(self):
         return dict(self._stations_heard)
@@ -73,6 +96,37 @@ class SessionManager(object):
     def manual_heard_station(self, station):
         self._stations_heard[station] = time.time()
 
+    def get_link_stats(self):
+        """Return the transport's queue and transmit limit statistics"""
+        if self.tport:
+            return self.tport.get_stats()
+        return {}
+
+    def get_rtt_estimator(self, station):
+        """Return the round trip estimator shared by sessions with station"""
+        if station not in self._rtt:
+            self._rtt[station] = stateful.RTTEstimator()
+        return self._rtt[station]
+
+    def get_congestion(self, station, initial=1 << 12):
+        """Return the congestion window shared by sessions with station"""
+        if station not in self._congestion:
+            self._congestion[station] = \
+                congestion.CongestionControl(station, initial)
+        return self._congestion[station]
+
+    def get_peer_stats(self):
+        """Return the congestion and round trip state for each station"""
+        stats = {}
+        for station, cc in self._congestion.items():
+            stats[station] = cc.get_stats()
+        for station, rtt in self._rtt.items():
+            peer = stats.setdefault(station, {})
+            peer["srtt"] = rtt.srtt
+            peer["rttvar"] = rtt.rttvar
+            peer["rto"] = rtt.rto()
+        return stats
+
     def fire_session_cb(self, session, reason):
         for f,d in self.session_cb.items():
             try:
@@ -93,13 +147,16 @@ class SessionManager(object):
         if self.control._id in self.sessions:
             del self.sessions[self.control._id]
 
-        for s in self.sessions.values():
+        for s in list(self.sessions.values()):
             printlog("Sessionmgr",": Stopping session `%s'" % s.name)
             s.close(force)
 
         if not force:
             self.tport.disable()
 
+        if isinstance(self.session_driver, scheduler.SessionScheduler):
+            self.session_driver.shutdown()
+
     def incoming(self, frame):
     #manage incoming sessions
         #record time for marking sessions
@@ -188,6 +245,7 @@ class SessionManager(object):
         session._id = id
         session._st = dest
         self.sessions[id] = session
+        session.start(self.session_driver)
 
         self.fire_session_cb(session, reason)
 
@@ -59,6 +59,9 @@ class Session(object):
                        "retries"     : 0,
                        }
 
+    def start(self, driver=None):
+        pass
+
     def send_blocks(self, blocks):
         for b in blocks:
             self._sm.outgoing(self, b)
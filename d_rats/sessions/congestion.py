@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import print_function
+import threading
+
+class CongestionControl(object):
+    """AIMD congestion window for the path to one station on one port.
+
+    Every stateful session to the station shares the window, each
+    active one getting an equal part of it, and a new session starts
+    from whatever the earlier ones have learned.  The window opens by
+    the bytes ACK'd while below ssthresh (slow start) and by about one
+    block per round above it.  A round that loses blocks shrinks it by
+    LOSS_BACKOFF, and one that gets no answer at all halves it: radio
+    links lose frames to noise as much as to congestion, so neither
+    goes all the way back to MIN_WINDOW.
+    """
+
+    MIN_WINDOW = 1 << 9
+    MAX_WINDOW = 1 << 16
+    LOSS_BACKOFF = 0.7
+    RATE_WEIGHT = 0.25
+
+    def __init__(self, station, initial=1 << 12):
+        self.station = station
+        self.cwnd = max(self.MIN_WINDOW, min(initial, self.MAX_WINDOW))
+        self.ssthresh = self.MAX_WINDOW
+        self.rate = 0.0 # Delivered bytes/sec, averaged over rounds
+
+        self._lock = threading.Lock()
+        self._active = set()
+        self._stats = {
+            "acked" : 0,
+            "losses" : 0,
+            "timeouts" : 0,
+            }
+
+    def join(self, session):
+        self._lock.acquire()
+        self._active.add(session)
+        self._lock.release()
+
+    def leave(self, session):
+        self._lock.acquire()
+        self._active.discard(session)
+        self._lock.release()
+
+    def window(self, session, limit):
+        """Return the bytes session may have outstanding, at most limit"""
+        self._lock.acquire()
+        share = self.cwnd // max(1, len(self._active | set([session])))
+        self._lock.release()
+
+        return max(self.MIN_WINDOW, min(share, limit))
+
+    def on_ack(self, acked, lost, bsize, elapsed):
+        """Record a round: acked bytes delivered in elapsed seconds,
+        and whether the remote was missing any blocks"""
+        self._lock.acquire()
+        try:
+            self._stats["acked"] += acked
+            if elapsed > 0 and acked:
+                rate = acked / float(elapsed)
+                if self.rate:
+                    rate = self.rate + self.RATE_WEIGHT * (rate - self.rate)
+                self.rate = rate
+
+            if lost:
+                self._stats["losses"] += 1
+                self.ssthresh = max(int(self.cwnd * self.LOSS_BACKOFF),
+                                    self.MIN_WINDOW)
+                self.cwnd = self.ssthresh
+            elif self.cwnd < self.ssthresh:
+                self.cwnd += acked
+            else:
+                self.cwnd += max(1, bsize * acked // self.cwnd)
+
+            self.cwnd = max(self.MIN_WINDOW, min(self.cwnd, self.MAX_WINDOW))
+        finally:
+            self._lock.release()
+
+    def on_timeout(self):
+        self._lock.acquire()
+        self._stats["timeouts"] += 1
+        self.ssthresh = max(self.cwnd // 2, self.MIN_WINDOW)
+        self.cwnd = self.ssthresh
+        self._lock.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        stats = dict(self._stats)
+        stats["cwnd"] = self.cwnd
+        stats["ssthresh"] = self.ssthresh
+        stats["rate"] = self.rate
+        stats["sessions"] = len(self._active)
+        self._lock.release()
+
+        return stats
+
+def test_aimd():
+    cc = CongestionControl("TEST", 4096)
+    a = object()
+    b = object()
+
+    cc.join(a)
+    assert cc.window(a, 1 << 20) == 4096
+    cc.join(b)
+    assert cc.window(a, 1 << 20) == 2048
+    assert cc.window(a, 1024) == 1024
+
+    # Slow start doubles per round
+    cc.on_ack(4096, False, 1024, 1.0)
+    assert cc.cwnd == 8192
+
+    # Loss backs off
+    cc.on_ack(4096, True, 1024, 1.0)
+    assert cc.cwnd == cc.ssthresh == 5734
+
+    # Then about one block per round
+    cc.on_ack(4096, False, 1024, 1.0)
+    assert cc.cwnd == 5734 + 1024 * 4096 // 5734
+
+    cc.on_timeout()
+    assert cc.cwnd == cc.ssthresh == (5734 + 731) // 2
+
+    cc.leave(b)
+    assert cc.get_stats()["sessions"] == 1
+
+    print("AIMD test passed: %s" % cc.get_stats())
+
+if __name__ == "__main__":
+    test_aimd()
@@ -18,6 +18,8 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import struct
+import random
+import threading
 
 from d_rats.utils import log_exception
 from d_rats.ddt2 import DDT2EncodedFrame
@@ -29,6 +31,11 @@ T_PNG = 0
 T_END = 1
 T_ACK = 2
 T_NEW = 3
+T_CAPS = 253 # Capability advertisement, sent to CQCQCQ or to whoever asked
+
+# Every station that hears a caps query answers it, so the answers are
+# spread over this many seconds instead of colliding on the channel
+CAPS_REPLY_DELAY = 5
 
 class ControlSession(base.Session):
     stateless = True
@@ -86,7 +93,9 @@ class ControlSession(base.Session):
     def ctl_new(self, frame):
         try:
             (id,) = struct.unpack("B", frame.data[:1])
-            name = frame.data[1:]
+            name = bytes(frame.data[1:])
+            if not isinstance(name, str):
+                name = name.decode("ISO-8859-1")
         except Exception as e:
             print(("Control   : Session request had invalid ID: %s" % e))
             return
@@ -117,7 +126,63 @@ class ControlSession(base.Session):
         data = struct.pack("BB", id, num)
         self.ack_req(frame.s_station, data)
 
+    def send_caps(self, query=True, dest="CQCQCQ"):
+        caps = self._sm.tport.get_caps()
+        if not caps:
+            return
+
+        if query:
+            # Ask stations that hear us to advertise theirs too
+            caps.add("?")
+
+        f = DDT2EncodedFrame()
+        f.type = T_CAPS
+        f.seq = 0
+        f.d_station = dest
+        f.data = ",".join(sorted(caps))
+        f.set_compress(False)
+        self._sm.outgoing(self, f)
+
+    def ctl_caps(self, frame):
+        data = frame.data
+        if not isinstance(data, str):
+            data = data.decode("ISO-8859-1")
+        caps = set([x for x in data.split(",") if x])
+
+        self._sm.tport.set_peer_caps(frame.s_station, caps - set(["?"]))
+        if "?" in caps:
+            self._queue_caps_reply(frame.s_station)
+
+    def _queue_caps_reply(self, station):
+        self._caps_lock.acquire()
+        try:
+            if station in self._caps_replies:
+                return
+
+            t = threading.Timer(random.uniform(0, CAPS_REPLY_DELAY),
+                                self._send_caps_reply, args=(station,))
+            t.setDaemon(True)
+            self._caps_replies[station] = t
+            t.start()
+        finally:
+            self._caps_lock.release()
+
+    def _send_caps_reply(self, station):
+        self._caps_lock.acquire()
+        self._caps_replies.pop(station, None)
+        self._caps_lock.release()
+
+        try:
+            self.send_caps(query=False, dest=station)
+        except Exception as e:
+            print(("Control   : Unable to answer caps query from %s: %s" % \
+                       (station, e)))
+
     def ctl(self, frame):
+        if frame.type == T_CAPS:
+            self.ctl_caps(frame)
+            return
+
         if frame.d_station != self._sm.station:
             print(("Control   : Control ignoring frame for station %s" % frame.d_station))
             return
@@ -136,7 +201,10 @@ class ControlSession(base.Session):
         f.type = T_NEW + session.type
         f.seq = 0
         f.d_station = session._st
-        f.data = struct.pack("B", int(session._id)) + session.name
+        name = session.name
+        if not isinstance(name, bytes):
+            name = name.encode("ISO-8859-1")
+        f.data = struct.pack("B", int(session._id)) + name
 
         wait_time = 5
 
@@ -207,6 +275,9 @@ class ControlSession(base.Session):
         base.Session.__init__(self, "control")
         self.handler = self.ctl
 
+        self._caps_lock = threading.Lock()
+        self._caps_replies = {}
+
         self.stypes = { T_NEW + base.T_GENERAL  : stateful.StatefulSession,
                         T_NEW + base.T_FILEXFER : file.FileTransferSession,
                         T_NEW + base.T_FORMXFER : form.FormTransferSession,
@@ -1,17 +1,187 @@
 from __future__ import absolute_import
 from __future__ import print_function
-import UserDict
 import struct
 import os
 import time
 import zlib
+import json
+import hashlib
 
+from d_rats import transport, hashindex
 from d_rats.sessions import base, stateful
-from six.moves import range
+from six.moves import range, UserDict
+
+# The size field of a streamed file offer.  The real (uncompressed)
+# size follows it, then the name, then optional NUL-separated fields.
+STREAM_OFFER = 0xFFFFFFFF
+
+# Bytes of file read, and compressed, at a time when streaming
+STREAM_CHUNK = 1 << 14
+
+# Compressed bytes a streaming sender keeps queued ahead of the ACKs
+STREAM_BACKLOG = 1 << 15
+
+# A part's journal is brought up to date after this many bytes, or
+# this many seconds, of writes, and whenever the part is closed
+JOURNAL_BYTES = 1 << 16
+JOURNAL_INTERVAL = 2
+
+# What _wait_for_start() returns when the remote already has the file
+HAVE = -1
+
+class PartFile(object):
+    """The .part file a transfer is received into, and the journal
+    beside it that says how much of the part is good.
+
+    Every JOURNAL_BYTES or JOURNAL_INTERVAL seconds of writes, and on
+    close, the part is synced to disk before the journal is updated
+    with the new offset and the SHA-1 of everything up to it, so after
+    a dropped link or a restart recover() can check the part and resume
+    from its last journalled byte.  The journal also names the offer
+    (size and kind of transfer) the part belongs to.
+    """
+
+    def __init__(self, filename, size, kind):
+        self.filename = filename
+        self.partname = filename + ".part"
+        self.journalname = self.partname + ".journal"
+        self.size = size
+        self.kind = kind
+        self.offset = 0
+
+        self._hash = hashlib.sha1()
+        self._f = None
+        self._journalled = 0
+        self._journal_time = 0
+
+    def _read_journal(self):
+        try:
+            f = open(self.journalname)
+            journal = json.load(f)
+            f.close()
+        except (IOError, ValueError) as e:
+            return None
+
+        if journal.get("size") != self.size or \
+                journal.get("kind") != self.kind:
+            print("Part file is from a different offer")
+            return None
+
+        return journal
+
+    def _write_journal(self):
+        journal = {
+            "size" : self.size,
+            "kind" : self.kind,
+            "offset" : self.offset,
+            "sha1" : self._hash.hexdigest(),
+            }
+
+        tmp = self.journalname + ".tmp"
+        f = open(tmp, "w")
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        if os.path.exists(self.journalname):
+            os.remove(self.journalname)
+        os.rename(tmp, self.journalname)
+
+        self._journalled = self.offset
+        self._journal_time = time.time()
+
+    def recover(self):
+        """Check any part left by an earlier attempt against its
+        journal, and return the offset to resume from"""
+        journal = self._read_journal()
+        if not journal or not os.path.exists(self.partname):
+            self.discard()
+            return 0
+
+        offset = journal["offset"]
+        if os.path.getsize(self.partname) < offset:
+            print("Part file is shorter than its journal")
+            self.discard()
+            return 0
+
+        hash = hashlib.sha1()
+        f = open(self.partname, "rb")
+        left = offset
+        while left:
+            data = f.read(min(left, STREAM_CHUNK))
+            if not data:
+                break
+            hash.update(data)
+            left -= len(data)
+        f.close()
+
+        if left or hash.hexdigest() != journal["sha1"]:
+            print("Part file does not match its journal")
+            self.discard()
+            return 0
+
+        self.offset = offset
+        self._hash = hash
+
+        return offset
+
+    def open(self):
+        if self.offset:
+            self._f = open(self.partname, "r+b")
+            # Anything past the journal was never verified
+            self._f.seek(self.offset)
+            self._f.truncate()
+        else:
+            self._f = open(self.partname, "wb")
+            self._write_journal()
+
+    def write(self, data):
+        if not data:
+            return
+
+        self._f.write(data)
+        self._hash.update(data)
+        self.offset += len(data)
+
+        if self.offset - self._journalled >= JOURNAL_BYTES or \
+                time.time() - self._journal_time >= JOURNAL_INTERVAL:
+            self.sync()
 
-class NotifyDict(UserDict.UserDict):
+    def sync(self):
+        """Put everything written so far on disk, then journal it"""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._write_journal()
+
+    def close(self):
+        if not self._f:
+            return
+
+        try:
+            if self.offset != self._journalled:
+                self.sync()
+        except (IOError, OSError) as e:
+            print("Failed to journal part file: %s" % e)
+
+        self._f.close()
+        self._f = None
+
+    def discard(self):
+        self.close()
+        for fn in [self.partname, self.journalname]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def finish(self):
+        """Forget the journal, leaving the part complete"""
+        self.close()
+        if os.path.exists(self.journalname):
+            os.remove(self.journalname)
+
+class NotifyDict(UserDict):
     def __init__(self, cb, data={}):
-        UserDict.UserDict.__init__(self)
+        UserDict.__init__(self)
         self.cb = cb
         self.data = data
 
@@ -21,6 +191,13 @@ class NotifyDict(UserDict.UserDict):
 
 class FileTransferSession(stateful.StatefulSession):
     type = base.T_FILEXFER
+    priority = transport.PRI_BULK
+
+    # The streamed offer field carrying content_hash()
+    hash_field = "sha256"
+
+    def content_hash(self, filename):
+        return hashindex.hash_file(filename)
 
     def internal_status(self, vals):
         print("XFER STATUS: %s" % vals["msg"])
@@ -48,6 +225,7 @@ class FileTransferSession(stateful.StatefulSession):
         self.sent_size = self.recv_size = 0
         self.retries = 0
         self.filename = ""
+        self.have_file = None # Our copy, when we did not need theirs
 
         self.last_status = ""
         self.stats = NotifyDict(self.status_tick, self.stats)
@@ -65,20 +243,39 @@ class FileTransferSession(stateful.StatefulSession):
         f.write(data)
         f.close()
     
-    def send_file(self, filename):
-        data = self.get_file_data(filename)
-        if not data:
-            return False
+    def peer_streams(self):
+        """Return True if the remote takes streamed transfers"""
+        tport = self._sm and self._sm.tport
+        return bool(tport) and \
+            tport.peer_has_cap(self._st, transport.CAP_FILESTREAM)
+
+    def _estimate_size(self, wire, done, total):
+        # The compressed size of a stream is only known at the end, so
+        # scale what has crossed the link so far by the file left to go
+        if not done:
+            return total
+        return int(wire * total / float(done))
+
+    def _dest_filename(self, dir, name):
+        if os.path.isdir(dir):
+            return os.path.join(dir, name)
+        else:
+            return dir
 
+    def _send_start(self, offset):
         try:
-            offer = struct.pack("I", len(data)) + os.path.basename(filename)
-            self.write(offer)
+            if offset:
+                print("Sending resume at %i" % offset)
+                self.write("RESUME:%i" % offset)
+            else:
+                self.write("OK")
         except base.SessionClosedError as e:
-            print("Session closed while sending file information")
+            print("Session closed while sending start ack")
             return False
 
-        self.filename = os.path.basename(filename)
+        return True
 
+    def _wait_for_start(self):
         offset = None
 
         for i in range(40):
@@ -87,10 +284,14 @@ class FileTransferSession(stateful.StatefulSession):
                 resp = self.read()
             except base.SessionClosedError as e:
                 print("Session closed while waiting for start ack")
-                return False
+                return None
 
             if not resp:
                 self.status(_("Waiting for response"))
+            elif resp == "HAVE":
+                self.status(_("Remote already has this file"))
+                offset = HAVE
+                break
             elif resp == "OK":
                 self.status(_("Negotiation Complete"))
                 offset = 0
@@ -110,6 +311,26 @@ class FileTransferSession(stateful.StatefulSession):
 
             time.sleep(0.5)
 
+        return offset
+
+    def send_file(self, filename):
+        if self.peer_streams():
+            return self.send_file_stream(filename)
+
+        data = self.get_file_data(filename)
+        if not data:
+            return False
+
+        try:
+            offer = struct.pack("I", len(data)) + os.path.basename(filename)
+            self.write(offer)
+        except base.SessionClosedError as e:
+            print("Session closed while sending file information")
+            return False
+
+        self.filename = os.path.basename(filename)
+
+        offset = self._wait_for_start()
         if offset is None:
             print("Did not get start response")
             return False
@@ -137,7 +358,100 @@ class FileTransferSession(stateful.StatefulSession):
             self.status(_("Complete"))
             return True
 
-    def recv_file(self, dir):
+    def send_file_stream(self, filename):
+        """Send filename compressed a chunk at a time, so that neither
+        end ever holds more than a few chunks of it.  A RESUME offset
+        is a position in the uncompressed file.  The offer carries the
+        file's content_hash(), and the remote may answer HAVE to skip it."""
+        try:
+            size = os.path.getsize(filename)
+            hash = self.content_hash(filename)
+            f = open(filename, "rb")
+        except (IOError, OSError) as e:
+            print("Unable to open %s: %s" % (filename, e))
+            return False
+
+        try:
+            offer = struct.pack("II", STREAM_OFFER, size) + \
+                os.path.basename(filename) + \
+                "\0%s=%s" % (self.hash_field, hash)
+            self.write(offer)
+        except base.SessionClosedError as e:
+            print("Session closed while sending file information")
+            f.close()
+            return False
+
+        self.filename = os.path.basename(filename)
+
+        offset = self._wait_for_start()
+        if offset == HAVE:
+            f.close()
+            self.close()
+            self.stats["sent_size"] = self.stats["total_size"] = size
+            self.status(_("Complete"))
+            return True
+        elif offset is None or offset > size:
+            print("Did not get a usable start response (%s)" % offset)
+            f.close()
+            return False
+
+        f.seek(offset)
+        comp = zlib.compressobj(9)
+        done = queued = 0
+        acked = False
+
+        # From here on, sent_size and total_size count the compressed
+        # stream, the latter estimated until the last chunk is read
+        self.stats["sent_size"] = 0
+        self.stats["total_size"] = size - offset
+        self.stats["start_time"] = time.time()
+
+        try:
+            self.status(_("Sending"))
+            while True:
+                chunk = f.read(STREAM_CHUNK)
+                if chunk:
+                    zdata = comp.compress(chunk)
+                    done += len(chunk)
+                else:
+                    zdata = comp.flush()
+
+                if zdata:
+                    queued += len(zdata)
+                    if chunk:
+                        self.stats["total_size"] = \
+                            self._estimate_size(queued, done, size - offset)
+                    else:
+                        self.stats["total_size"] = queued
+                    self.write(zdata, timeout=None)
+                    if not self.wait_for_backlog(STREAM_BACKLOG):
+                        break
+
+                if not chunk:
+                    acked = self.wait_for_backlog(0)
+                    break
+        except base.SessionClosedError:
+            print("Session closed while doing write")
+        finally:
+            f.close()
+
+        self.close()
+
+        # Not sent_size, which can still pick up the ACK for the offer
+        # after it was reset
+        if done != size - offset or not acked:
+            self.status(_("Failed to send file (incomplete)"))
+            return False
+        else:
+            self.stats["sent_size"] = self.stats["total_size"] = size
+            self.status(_("Complete"))
+            return True
+
+    def recv_file(self, dir, index=None):
+        """Receive a file into dir (or as dir, if it is not a directory)
+        and return its name.  With a hashindex.HashIndex, a streamed
+        offer of a file the index has is declined, and the name of our
+        copy returned (and kept in have_file) instead."""
         self.status(_("Waiting for transfer to start"))
         for i in range(40):
             try:
@@ -156,22 +470,18 @@ class FileTransferSession(stateful.StatefulSession):
             return None
 
         size, = struct.unpack("I", data[:4])
-        name = data[4:]
+        if size == STREAM_OFFER:
+            return self.recv_file_stream(dir, data[4:], index)
 
-        if os.path.isdir(dir):
-            filename = os.path.join(dir, name)
-        else:
-            filename = dir
-
-        partfilename = filename + ".part"
+        name = data[4:]
+        filename = self._dest_filename(dir, name)
 
-        if os.path.exists(partfilename):
-            data = self.get_file_data(self, partfilename)
-            offset = os.path.getsize(partfilename)
-            print("Part file exists, resuming at %i" % offset)
-        else:
-            data = ""
-            offset = 0
+        # The part holds the compressed file, and the offset counts
+        # compressed bytes, which is what the sender resumes from
+        part = PartFile(filename, size, "zlib")
+        offset = part.recover()
+        if offset:
+            print("Part file checks out, resuming at %i" % offset)
 
         self.status(_("Receiving file") + \
                         " %s " % name + \
@@ -181,47 +491,146 @@ class FileTransferSession(stateful.StatefulSession):
         self.stats["total_size"] = size
         self.stats["start_time"] = time.time()
 
-        try:
-            if offset:
-                print("Sending resume at %i" % offset)
-                self.write("RESUME:%i" % offset)
-            else:
-                self.write("OK")
-        except base.SessionClosedError as e:
-            print("Session closed while sending start ack")
+        if not self._send_start(offset):
             return None
 
         self.status(_("Waiting for first block"))
 
-        while True:
-            try:
-                d = self.read()
-            except base.SessionClosedError:
-                print("SESSION IS CLOSED")
-                break
+        part.open()
+        try:
+            while True:
+                try:
+                    d = self.read()
+                except base.SessionClosedError:
+                    print("SESSION IS CLOSED")
+                    break
+
+                if d:
+                    part.write(d)
+                    self.status(_("Receiving"))
+        except IOError as e:
+            print("Failed to write transfer data: %s" % e)
+            return None
+        finally:
+            part.close()
 
-            if d:
-                data += d
-                self.status(_("Receiving"))
+        if part.offset != size:
+            self.status(_("Failed to receive file (incomplete)"))
+            return None
 
         try:
-            self.put_file_data(filename, data)
-            if os.path.exists(partfilename):
-                print("Removing old file part")
-                os.remove(partfilename)
-        except Exception as e:
+            self.put_file_part(filename, part.partname)
+        except (zlib.error, IOError) as e:
             print("Failed to write transfer data: %s" % e)
-            self.put_file_data(self, partfilename, data)
+            part.discard()
             return None
 
-        if self.stats["recv_size"] != self.stats["total_size"]:
+        part.discard()
+
+        actual = os.stat(filename).st_size
+        self.stats["recv_size"] = self.stats["total_size"] = actual
+        self.status(_("Complete"))
+        return filename
+
+    def recv_file_stream(self, dir, offer, index=None):
+        """Receive a streamed file, decompressing it onto the end of its
+        .part file as it arrives, and resume from whatever that holds"""
+        size, = struct.unpack("I", offer[:4])
+        fields = offer[4:].split("\0")
+        name = fields[0]
+        filename = self._dest_filename(dir, name)
+
+        extra = {}
+        for field in fields[1:]:
+            if "=" in field:
+                k, v = field.split("=", 1)
+                extra[k] = v
+        hash = extra.get(self.hash_field)
+
+        if hash and index:
+            have = index.lookup(hash)
+            if have:
+                print("Already have %s as %s" % (name, have))
+                try:
+                    self.write("HAVE")
+                except base.SessionClosedError as e:
+                    print("Session closed while sending start ack")
+                    return None
+                self.have_file = have
+                self.stats["recv_size"] = self.stats["total_size"] = size
+                self.status(_("Already have this file"))
+                return have
+
+        part = PartFile(filename, size, "stream")
+        offset = part.recover()
+        if offset:
+            print("Part file checks out, resuming at %i" % offset)
+
+        self.status(_("Receiving file") + \
+                        " %s " % name + \
+                        _("of size") + \
+                        " %i" % size)
+        self.stats["recv_size"] = 0
+        self.stats["total_size"] = size - offset
+        self.stats["start_time"] = time.time()
+
+        if not self._send_start(offset):
+            return None
+
+        self.status(_("Waiting for first block"))
+
+        decomp = zlib.decompressobj()
+        part.open()
+        try:
+            while True:
+                try:
+                    d = self.read()
+                except base.SessionClosedError:
+                    print("SESSION IS CLOSED")
+                    break
+
+                if d:
+                    part.write(decomp.decompress(d))
+                    self.stats["total_size"] = \
+                        self._estimate_size(self.stats["recv_size"],
+                                            part.offset - offset,
+                                            size - offset)
+                    self.status(_("Receiving"))
+
+            part.write(decomp.flush())
+        except zlib.error as e:
+            print("Failed to decompress transfer data: %s" % e)
+            # The stream is only checked at its end, so nothing written
+            # from it can be trusted for a resume
+            part.discard()
+            return None
+        except IOError as e:
+            print("Failed to write transfer data: %s" % e)
+            return None
+        finally:
+            part.close()
+
+        if part.offset != size:
             self.status(_("Failed to receive file (incomplete)"))
             return None
-        else:
-            actual = os.stat(filename).st_size
-            self.stats["recv_size"] = self.stats["total_size"] = actual
-            self.status(_("Complete"))
-            return filename
+
+        if hash and self.content_hash(part.partname) != hash:
+            print("Received file does not match the offered hash")
+            part.discard()
+            self.status(_("Failed to receive file (corrupted)"))
+            return None
+
+        part.finish()
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(part.partname, filename)
+
+        if hash and index:
+            index.add_received(hash, filename)
+
+        self.stats["recv_size"] = self.stats["total_size"] = size
+        self.status(_("Complete"))
+        return filename
 
     def get_file_data(self, filename):
         f = open(filename, "rb")
@@ -230,11 +639,22 @@ class FileTransferSession(stateful.StatefulSession):
 
         return zlib.compress(data, 9)
 
-    def put_file_data(self, filename, zdata):
+    def put_file_part(self, filename, partfilename):
+        """Decompress a received part into filename"""
+        decomp = zlib.decompressobj()
+        src = open(partfilename, "rb")
+        dst = open(filename, "wb")
         try:
-            data = zlib.decompress(zdata)
-            f = open(filename, "wb")
-            f.write(data)
-            f.close()
-        except zlib.error as e:
-            raise e
+            while True:
+                zdata = src.read(STREAM_CHUNK)
+                if not zdata:
+                    break
+                dst.write(decomp.decompress(zdata))
+            dst.write(decomp.flush())
+        except zlib.error:
+            dst.close()
+            os.remove(filename)
+            raise
+        finally:
+            src.close()
+            dst.close()
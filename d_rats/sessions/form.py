@@ -1,5 +1,12 @@
 from __future__ import absolute_import
+from d_rats import hashindex
 from d_rats.sessions import base, file
 
 class FormTransferSession(file.FileTransferSession):
     type = base.T_FORMXFER
+
+    # Every station a form passes through adds itself to its path
+    hash_field = "formsha256"
+
+    def content_hash(self, filename):
+        return hashindex.hash_form(filename)
@@ -25,7 +25,7 @@ import sys
 
 import gobject
 
-from d_rats import ddt2, signals, emailgw, wl2k
+from d_rats import ddt2, signals, emailgw, wl2k, hashindex
 
 # This feels wrong
 from d_rats.ui import main_events
@@ -197,6 +197,22 @@ class RPCCheckMail(RPCJob):
         return self._args["host"], self._args["user"], self._args["pasw"], \
             int(self._args["port"]), self._args["ssl"] == "True"
 
+class RPCHaveHashesJob(RPCJob):
+    """Ask which of a batch of file (hashindex.hash_file()) or form
+    (hashindex.hash_form()) hashes the remote has.  The result maps
+    each one to "True" or "False"."""
+
+    def set_hashes(self, hashes):
+        self._args = {}
+        for hash in hashes:
+            self._args[hash] = ""
+
+    def get_hashes(self):
+        return list(self._args.keys())
+
+    def do(self, rpcactions):
+        return rpcactions.RPC_have_hashes(self)
+
 class RPCSession(gobject.GObject, stateless.StatelessSession):
     type = base.T_RPC
 
@@ -530,6 +546,18 @@ class RPCActionSet(gobject.GObject):
             
         return result
 
+    def RPC_have_hashes(self, job):
+        found = {}
+        for index in [hashindex.get_index(self.__config),
+                      hashindex.get_form_index(self.__config)]:
+            found.update(index.lookup_all(job.get_hashes()))
+
+        result = {}
+        for hash in job.get_hashes():
+            result[hash] = str(hash in found)
+
+        return result
+
     def RPC_check_mail(self, job):
         def check_done(mt, success, message, job):
             result = { "rc"  : success and "0" or "-1",
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+#importing printlog() wrapper
+from d_rats.debug import printlog
+
+import heapq
+import threading
+import time
+from collections import deque
+
+from d_rats import utils
+
+# Where a session is in the scheduler
+_WAITING = 0  # On the timer heap until its deadline or a wake()
+_READY = 1    # Queued for a worker
+_RUNNING = 2  # In step() or expire() on a worker
+
+class SessionScheduler(object):
+    """Drives StatefulSession.step() for every session of a
+    SessionManager from one timer thread and a small worker pool.
+
+    Each session sits on a heap keyed by the deadline its last step()
+    asked for, and is handed to a worker when that passes or when
+    notify() wakes it.  A session is only ever run by one worker at a
+    time; a wake() while it runs makes it step again straight after.
+    Steps hand their blocks to the port and return, to be woken again
+    once they are sent, so a held or dead port never ties up a worker.
+    """
+
+    def __init__(self, workers=4):
+        self._lock = threading.Condition()
+        self._heap = []
+        self._ready = deque()
+        self._state = {}
+        self._entry = {}   # Live heap entry per waiting session
+        self._woken = set()
+        self._local = threading.local()
+        self._seq = 0
+        self.enabled = True
+
+        self._stats = {
+            "steps" : 0,
+            "wakes" : 0,
+            "expired" : 0,
+            }
+
+        self._timer = threading.Thread(target=self._timer_worker)
+        self._timer.setDaemon(True)
+        self._timer.start()
+
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def _queue(self, session, action="step"):
+        # Called with the lock held
+        self._state[session] = _READY
+        self._ready.append((session, action))
+        self._lock.notify_all()
+
+    def _schedule(self, session, timeout, idle):
+        # Called with the lock held
+        self._seq += 1
+        entry = [time.time() + timeout, self._seq, session, idle]
+        self._entry[session] = entry
+        self._state[session] = _WAITING
+        heapq.heappush(self._heap, entry)
+        self._lock.notify_all()
+
+    def _unschedule(self, session):
+        # Called with the lock held.  Stale entries stay on the heap,
+        # marked dead, until the timer pops them
+        entry = self._entry.pop(session, None)
+        if entry:
+            entry[2] = None
+
+    def add(self, session):
+        self._lock.acquire()
+        self._queue(session)
+        self._lock.release()
+
+    def wake(self, session):
+        self._lock.acquire()
+        try:
+            state = self._state.get(session)
+            if state == _WAITING:
+                self._stats["wakes"] += 1
+                self._unschedule(session)
+                self._queue(session)
+            elif state == _RUNNING:
+                self._woken.add(session)
+        finally:
+            self._lock.release()
+
+    def remove(self, session):
+        self._lock.acquire()
+        try:
+            self._unschedule(session)
+            self._woken.discard(session)
+
+            # Like joining a worker thread, unless the caller is the
+            # session's own step
+            if getattr(self._local, "session", None) is not session:
+                while self._state.get(session) == _RUNNING:
+                    self._lock.wait()
+
+            if self._state.get(session) == _READY:
+                self._ready = deque([x for x in self._ready
+                                     if x[0] is not session])
+            self._state.pop(session, None)
+        finally:
+            self._lock.release()
+
+    def _timer_worker(self):
+        self._lock.acquire()
+        try:
+            while self.enabled:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, seq, session, idle = heapq.heappop(self._heap)
+                    if session is None:
+                        continue
+                    del self._entry[session]
+                    self._queue(session, idle and "expire" or "step")
+
+                if self._heap:
+                    self._lock.wait(self._heap[0][0] - now)
+                else:
+                    self._lock.wait()
+        finally:
+            self._lock.release()
+
+    def _run(self, session, action):
+        self._local.session = session
+        try:
+            if action == "expire":
+                self._stats["expired"] += 1
+                session.expire()
+                return 0, False
+            else:
+                self._stats["steps"] += 1
+                return session.step()
+        except Exception as e:
+            printlog("Scheduler"," : Session %s failed: %s" % (session.name, e))
+            utils.log_exception()
+            session.enabled = False
+            return 0, False
+        finally:
+            self._local.session = None
+
+    def _worker(self):
+        self._lock.acquire()
+        while self.enabled:
+            if not self._ready:
+                self._lock.wait()
+                continue
+
+            session, action = self._ready.popleft()
+            self._state[session] = _RUNNING
+            self._lock.release()
+
+            timeout, idle = self._run(session, action)
+
+            self._lock.acquire()
+            if session not in self._state:
+                pass # Removed while it ran
+            elif not session.enabled:
+                del self._state[session]
+                self._woken.discard(session)
+            elif timeout == 0 or session in self._woken:
+                self._woken.discard(session)
+                self._queue(session)
+            else:
+                self._schedule(session, timeout, idle)
+            self._lock.notify_all()
+        self._lock.release()
+
+    def shutdown(self):
+        self._lock.acquire()
+        self.enabled = False
+        self._lock.notify_all()
+        self._lock.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        stats = dict(self._stats)
+        stats["sessions"] = len(self._state)
+        stats["ready"] = len(self._ready)
+        stats["workers"] = len(self._workers)
+        self._lock.release()
+
+        return stats
+
+def test_scheduler():
+    class TestSession(object):
+        def __init__(self, name, steps):
+            self.name = name
+            self.enabled = True
+            self.steps = steps
+            self.times = []
+            self.expired = False
+
+        def step(self):
+            self.times.append(time.time())
+            if len(self.times) >= self.steps:
+                return 0.2, True
+            return 0.1, False
+
+        def expire(self):
+            self.expired = True
+            self.enabled = False
+
+    s = SessionScheduler(2)
+    sessions = [TestSession("s%i" % i, 3) for i in range(20)]
+    for session in sessions:
+        s.add(session)
+
+    time.sleep(1)
+    for session in sessions:
+        assert len(session.times) == 3, len(session.times)
+        assert session.expired
+
+    # A wake runs the session before its deadline
+    session = TestSession("woken", 100)
+    session.step = lambda: (session.times.append(time.time()) or (60, False))
+    s.add(session)
+    time.sleep(0.1)
+    s.wake(session)
+    time.sleep(0.1)
+    assert len(session.times) == 2
+    s.remove(session)
+
+    printlog("Scheduler"," : Test passed: %s" % s.get_stats())
+    s.shutdown()
+
+if __name__ == "__main__":
+    test_scheduler()
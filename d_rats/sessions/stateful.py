@@ -19,9 +19,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 import threading
 import time
+import struct
 
 from d_rats import transport
-from d_rats.ddt2 import DDT2EncodedFrame
+from d_rats.ddt2 import DDT2EncodedFrame, compress_level_for_rate
 from d_rats.sessions import base
 from six.moves import range
 
@@ -31,6 +32,110 @@ T_NAK    = 2
 T_DAT    = 4
 T_REQACK = 5
 
+# REQACK and ACK with 16-bit block numbers, used in sessions with
+# stations that advertise transport.CAP_SEQ16
+T_REQACK16 = 6
+T_ACK16    = 7
+
+# With stations that advertise transport.CAP_SACK as well as
+# CAP_SEQ16, the last block of each window asks for an ACK itself (or
+# a bare REQSACK, when asking again), and the answer is a SACK: the
+# next block expected, followed by a bitmap of the blocks received
+# after it
+T_SACK     = 8
+T_DATREQ   = 9
+T_REQSACK  = 10
+
+def encode_blocks(blocks, seq16=False):
+    if seq16:
+        return struct.pack("!%iH" % len(blocks), *blocks)
+    else:
+        return bytes(bytearray(blocks))
+
+def decode_blocks(data, seq16=False):
+    if seq16:
+        count = len(data) // 2
+        return list(struct.unpack("!%iH" % count, data[:count * 2]))
+    else:
+        return list(bytearray(data))
+
+def encode_sack(cum, received, limit):
+    bitmap = bytearray()
+    for seq in received:
+        offset = (seq - cum - 1) % limit
+        if offset >= limit // 2:
+            continue # Behind cum, so a duplicate
+        while len(bitmap) <= offset >> 3:
+            bitmap.append(0)
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    return struct.pack("!H", cum) + bytes(bitmap)
+
+def decode_sack(data, limit):
+    """Return the next block expected and the set received past it"""
+    cum, = struct.unpack("!H", data[:2])
+    received = set()
+    for i, byte in enumerate(bytearray(data[2:])):
+        for bit in range(8):
+            if byte & (1 << bit):
+                received.add((cum + 1 + i * 8 + bit) % limit)
+
+    return cum, received
+
+class RTTEstimator(object):
+    """Smoothed round trip time and its variance (Jacobson/Karels),
+    and the retransmit timeout they give, with exponential backoff.
+
+    Here the round trip is from the end of our transmission to the
+    ACK arriving, so it covers the turnaround and the remote's reply,
+    but not our own air time.
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+
+    INITIAL_RTO = 8.0
+    MIN_RTO = 1.0
+    MAX_RTO = 60.0
+    MAX_BACKOFF = 64
+
+    def __init__(self, other=None):
+        self.srtt = self.rttvar = 0.0
+        self.backoff = 1
+
+        if other:
+            # Start from what another estimator has learned
+            self.srtt = other.srtt
+            self.rttvar = other.rttvar
+
+    def is_warm(self):
+        return self.srtt > 0
+
+    def sample(self, rtt):
+        if not self.is_warm():
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+
+        self.backoff = 1
+
+    def back_off(self):
+        self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+
+    def reset_backoff(self):
+        self.backoff = 1
+
+    def rto(self):
+        if self.is_warm():
+            rto = max(self.srtt + self.K * self.rttvar, self.MIN_RTO)
+        else:
+            rto = self.INITIAL_RTO
+
+        return min(rto * self.backoff, self.MAX_RTO)
+
 class StatefulSession(base.Session):
     stateless = False
     type = base.T_GENERAL
@@ -38,11 +143,21 @@ class StatefulSession(base.Session):
 
     IDLE_TIMEOUT = 90
 
+    # Most data we may have outstanding.  Peers with 8-bit block
+    # numbers get the original fixed window; with 16-bit ones the
+    # window covers WINDOW_GAIN times the bandwidth-delay product.
+    LEGACY_WINDOW = 1 << 12
+    MAX_WINDOW = 1 << 16
+    WINDOW_GAIN = 4
+
+    # Outbound queue class for data blocks
+    priority = transport.PRI_INTERACTIVE
+
     def __init__(self, name, **kwargs):
         base.Session.__init__(self, name)
         self.outq = transport.BlockQueue()
         self.oob_queue = {}
-        self.recv_list = []
+        self.recv_list = set()
         self.outstanding = []
         self.waiting_for_ack = []
 
@@ -54,16 +169,30 @@ class StatefulSession(base.Session):
         self.iseq = -1
         self.oseq = 0
 
-        self.data = transport.BlockQueue()
+        self._seq16 = None         # Our blocks are numbered in 16 bits
+        self._sack = None          # Remote answers our blocks with SACKs
+        self._nakd = False         # Remote is known to be missing blocks
+        self._peer_seq16 = False   # So are the remote's blocks
+
+        self.data = transport.ByteRing()
         self.data_waiting = threading.Condition()
+        self._read_want = 0 # Bytes a blocked reader is waiting for
 
         self.__attempts = 0
         self.__ack_timeout = 0
-        self.__full_acks = 0
 
         self._rtr = 0.0 # Round trip rate (bps)
         self._xmt = 0.0 # Transmit rate (bps)
         self._xms = 0.0 # Start of last transmit of self.outstanding[]
+        self._xme = 0.0 # End of last transmit of self.outstanding[]
+        self._retransmit = False # Last transmit ended with a resent block
+        self._sending = [] # Blocks of the last transmit still going out
+        self._written = 0 # Bytes given to write(), counted by the writer
+        self._acked = 0   # and the ACKs for them, by the session loop
+
+        self._rtt = None # RTTEstimator for this session
+        self._peer_rtt = None # and the one shared with the station
+        self._cc = None # CongestionControl shared with the station
 
         self._rtt_measure = {
             "bnum"  : -1,
@@ -73,12 +202,24 @@ class StatefulSession(base.Session):
             }
 
         self.event = threading.Event()
-        self.thread = threading.Thread(target=self.worker)
-        self.thread.setDaemon(True)
-        self.thread.start()
+        self.thread = None
+        self._driver = None
+
+    def start(self, driver=None):
+        # Without a driver, the session runs worker() in its own thread.
+        # A driver calls step() itself and gets wake() on notify().
+        self._driver = driver
+        if driver:
+            driver.add(self)
+        else:
+            self.thread = threading.Thread(target=self.worker)
+            self.thread.setDaemon(True)
+            self.thread.start()
 
     def notify(self):
         self.event.set()
+        if self._driver:
+            self._driver.wake(self)
 
     def close(self, force=False):
         print("Stateful  : Got close request, joining thread...")
@@ -95,11 +236,68 @@ class StatefulSession(base.Session):
         elif self.outstanding:
             b.sent_event.set()                
 
-        self.thread.join()
+        if self._driver:
+            self._driver.remove(self)
+        elif self.thread and self.thread != threading.current_thread():
+            self.thread.join()
         print("Stateful  : Thread is done, continuing with close")
 
+        if self._cc:
+            self._cc.leave(self)
+
         base.Session.close(self, force)
 
+    def use_seq16(self):
+        # Decided once, when the session first sends, so the remote
+        # sees one numbering for the whole session
+        if self._seq16 is None:
+            tport = self._sm.tport
+            self._seq16 = tport.peer_has_cap(self._st, transport.CAP_SEQ16)
+            if self._seq16:
+                print("Stateful  : Using 16-bit block numbers")
+        return self._seq16
+
+    def use_sack(self):
+        # Only with 16-bit numbering, which the SACK requests imply
+        if self._sack is None:
+            tport = self._sm.tport
+            self._sack = self.use_seq16() and \
+                tport.peer_has_cap(self._st, transport.CAP_SACK)
+        return self._sack
+
+    def _oseq_limit(self):
+        return self.use_seq16() and 65536 or 256
+
+    def _iseq_limit(self):
+        return self._peer_seq16 and 65536 or 256
+
+    def rtt_estimator(self):
+        # New sessions start from what we know about the station
+        if self._rtt is None:
+            self._peer_rtt = self._sm.get_rtt_estimator(self._st)
+            self._rtt = RTTEstimator(self._peer_rtt)
+        return self._rtt
+
+    def rtt_sample(self, rtt):
+        self.rtt_estimator().sample(rtt)
+        self._peer_rtt.sample(rtt)
+        print(("Stateful  : ## RTT %.2f sec, smoothed %.2f +/- %.2f, RTO %.1f" % (rtt, self._rtt.srtt, self._rtt.rttvar, self._rtt.rto())))
+
+    def congestion(self):
+        if self._cc is None:
+            self._cc = self._sm.get_congestion(self._st,
+                                               self.out_limit * self.bsize)
+        return self._cc
+
+    def window_size(self):
+        if not self.use_seq16():
+            return self.LEGACY_WINDOW
+
+        rate = self._xmt or self._rtr
+        window = rate * self.rtt_estimator().srtt * self.WINDOW_GAIN
+
+        return int(min(max(window, self.LEGACY_WINDOW), self.MAX_WINDOW))
+
     def queue_next(self):
         if self.outstanding is None:
             # This is a silly race condition because the worker thread is
@@ -107,22 +305,19 @@ class StatefulSession(base.Session):
             # after the superclass init
             return
 
-        limit = self.out_limit
-        if self.__full_acks > 0:
-            limit += self.__full_acks
-        elif self.__full_acks < 0:
-            limit -= abs(self.__full_acks)
-
-        # Hard limit of 4KB outstanding (should be per-path!)
-        hardlimit = (1 << 12) / self.bsize
+        # Only sessions with something to send take a share of the
+        # station's window
+        cc = self.congestion()
+        if self.outstanding or self.outq.peek():
+            cc.join(self)
+        else:
+            cc.leave(self)
 
-        if limit < 2:
-            limit = 2
-        elif limit > hardlimit:
-            limit = hardlimit
+        window = self.window_size()
+        limit = max(cc.window(self, window) // self.bsize, 2)
 
         count = limit - len(self.outstanding)
-        print(("Stateful  : New limit is %i (%i/%i), queueing %i" % (limit, self.out_limit, hardlimit,  count)))
+        print(("Stateful  : New limit is %i (%i/%i), queueing %i" % (limit, cc.cwnd, window, count)))
         if count < 0:
             # Need to requeue some blocks to shrink our window
             print(("Stateful  : Need to requeue %i blocks to shrink window" % abs(count)))
@@ -157,42 +352,97 @@ class StatefulSession(base.Session):
         if pending_size == 0:
             return True
 
-        if self._rtr != 0:
-            rate = self._rtr
-        else:
-            # No measured rate yet so assume the minimum rate
-            rate = 80
-
-        timeout = (pending_size / rate) * 1.5
-        if timeout < 12:
-            # Don't allow small outgoing buffers to fool us into thinking
-            # there is no turnaround delay
-            timeout = 12
-
-        print(("Stateful  : ## Timeout for %i bytes @ %i bps: %.1f sec" % (pending_size, rate, timeout)))
-        print(("Stateful  : ##  Remaining: %.1f sec" % (timeout - (time.time() - self._xms))))
-
         if self.__attempts:
             print(("Stateful  : ## Waiting for ACK, timeout in %i" % (self.__ack_timeout - time.time())))
             return (self.__ack_timeout - time.time()) <= 0
+
+        # Our request for an ACK can't go out until whatever the port
+        # has queued ahead of it does
+        backlog = self._sm.get_link_stats().get("drain_time", 0)
+
+        rtt = self.rtt_estimator()
+        if rtt.is_warm():
+            deadline = self._xme + rtt.rto() + backlog
+            print(("Stateful  : ## Timeout %.1f sec after sending" % (rtt.rto() + backlog)))
         else:
-            return (timeout - (time.time() - self._xms)) <= 0
+            # No round trip measured yet, so guess from the amount of
+            # data and the rate
+            if self._rtr != 0:
+                rate = self._rtr
+            else:
+                # No measured rate yet so assume the minimum rate
+                rate = 80
+
+            timeout = (pending_size / rate) * 1.5
+            if timeout < 12:
+                # Don't allow small outgoing buffers to fool us into
+                # thinking there is no turnaround delay
+                timeout = 12
+
+            deadline = self._xms + timeout + backlog
+            print(("Stateful  : ## Timeout for %i bytes @ %i bps: %.1f sec" % (pending_size, rate, timeout + backlog)))
+
+        print(("Stateful  : ##  Remaining: %.1f sec" % (deadline - time.time())))
+
+        return time.time() >= deadline
 
     def send_reqack(self, blocks):
         f = DDT2EncodedFrame()
         f.seq = 0
-        f.type = T_REQACK
-        # FIXME: This needs to support 16-bit block numbers!
-        f.data = "".join([chr(x) for x in blocks])
+        if self.use_sack():
+            # The SACK covers everything, so no need for the list
+            f.type = T_REQSACK
+        elif self.use_seq16():
+            f.type = T_REQACK16
+        else:
+            f.type = T_REQACK
+        # Queued with our data, so it can't overtake the blocks it asks
+        # about and have them NAK'd before they are sent
+        f.priority = self.priority
+        if not self.use_sack():
+            f.data = encode_blocks(blocks, self.use_seq16())
 
         print(("Stateful  : Requesting ack of blocks %s" % blocks))
         self._sm.outgoing(self, f)
 
+    def _block_sent(self, block):
+        # From the port's thread.  Step again once the round is all out
+        sending = self._sending
+        for b in sending:
+            if not b.sent_event.isSet():
+                return
+        if sending:
+            self.notify()
+
+    def check_sent(self):
+        """Account for the last transmit once all of it has gone out,
+        and return whether it has"""
+        for b in self._sending:
+            if not b.sent_event.isSet():
+                return False
+
+        for b in self._sending:
+            self.update_xmt(b)
+            self.stats["sent_wire"] += len(b.data)
+            self._xme = max(self._xme, b._xmit_e)
+        self._sending = []
+
+        return True
+
     def send_blocks(self):
-        if self.outstanding and not self.is_timeout():
+        if not self.check_sent():
+            # The port wakes us when it has sent them
+            print("Stateful  : Waiting for blocks to be sent")
+            return
+
+        if self.outstanding and not self._nakd and not self.is_timeout():
             # Not time to try again yet
             return
 
+        # An answer to our request means whatever it did not ack was
+        # lost, so there is no point waiting to resend it
+        self._nakd = False
+
         self.queue_next()
 
         if not self.outstanding:
@@ -206,17 +456,16 @@ class StatefulSession(base.Session):
             return
 
         # Short circuit to just an ack for outstanding blocks, if
-        # we're still waiting for an ack from remote.  Increase the timeout
-        # for the ack by four seconds each time to give some backoff
+        # we're still waiting for an ack from remote.  The timeout for
+        # the ack doubles each time, up to RTTEstimator.MAX_RTO
         if self.waiting_for_ack:
             print("Stateful  : Didn't get last ack, asking again")
             self.send_reqack(self.waiting_for_ack)
-            if self.__full_acks > 0:
-                self.__full_acks = 0
-            else:
-                self.__full_acks -= 1
+            self.congestion().on_timeout()
             self.__attempts += 1
-            self.__ack_timeout = time.time() + 4 + (self.__attempts * 4)
+            rtt = self.rtt_estimator()
+            rtt.back_off()
+            self.__ack_timeout = time.time() + rtt.rto()
             return
 
         toack = []
@@ -226,42 +475,62 @@ class StatefulSession(base.Session):
 
         self._xms = time.time()
 
-        last_block = None
+        sack = self.use_sack()
+        resent = False
+
         for b in self.outstanding:
-            if b.sent_event.isSet():
+            if sack and b is self.outstanding[-1]:
+                b.type = T_DATREQ
+            else:
+                b.type = T_DAT
+
+            resent = b.sent_event.isSet()
+            if resent:
                 self.stats["retries"] += 1
                 b.sent_event.clear()
+            b.on_sent = self._block_sent
 
+        # Set before any of them can be sent, so that _block_sent()
+        # sees the whole round
+        self._sending = list(self.outstanding)
+
+        for b in self.outstanding:
             print(("Stateful  : Sending %i" % b.seq))
             self._sm.outgoing(self, b)
             toack.append(b.seq)
-            t = time.time()
 
-            if last_block:
-                last_block.sent_event.wait()
-                self.update_xmt(last_block)
-                self.stats["sent_wire"] += len(last_block.data)
+        # The answer is to whatever asked for it: a fresh REQACK, or
+        # with SACKs the last block, which is only ambiguous if resent
+        self._retransmit = sack and resent
+        if not sack:
+            self.send_reqack(toack)
+        self.waiting_for_ack = toack
 
-            last_block = b
+    def send_ack(self, blocks, seq16=False):
+        f = DDT2EncodedFrame()
+        f.seq = 0
+        if seq16:
+            f.type = T_ACK16
+        else:
+            f.type = T_ACK
+        f.priority = transport.PRI_ACK
+        f.data = encode_blocks(blocks, seq16)
 
-        self.send_reqack(toack)
-        self.waiting_for_ack = toack
+        print(("Stateful  : Acking blocks %s (%s)" % (blocks, {"" : f.data})))
 
-        print("Stateful  : Waiting for block to be sent")
-        last_block.sent_event.wait()
-        self._xme = time.time()
-        self.update_xmt(last_block)
-        self.stats["sent_wire"] += len(last_block.data)
-        self.ts = time.time()
-        print(("Stateful  : Block sent after: %f" % (self.ts - t)))
+        self._sm.outgoing(self, f)
+
+    def send_sack(self):
+        limit = self._iseq_limit()
+        cum = (self.iseq + 1) % limit
 
-    def send_ack(self, blocks):
         f = DDT2EncodedFrame()
         f.seq = 0
-        f.type = T_ACK
-        f.data = "".join([chr(x) for x in blocks])
+        f.type = T_SACK
+        f.priority = transport.PRI_ACK
+        f.data = encode_sack(cum, self.oob_queue.keys(), limit)
 
-        print(("Stateful  : Acking blocks %s (%s)" % (blocks, {"" : f.data})))
+        print(("Stateful  : SACK at %i, also have %s" % (cum, list(self.oob_queue.keys()))))
 
         self._sm.outgoing(self, f)
 
@@ -270,69 +539,104 @@ class StatefulSession(base.Session):
         blocks.reverse()
 
         def next(i):
-            # FIXME: For 16 bit blocks
-            return (i + 1) % 256
+            return (i + 1) % self._iseq_limit()
 
         def enqueue(_block):
             self.data_waiting.acquire()
-            self.data.enqueue(_block.data)
+            self.data.write(_block.data)
             self.iseq = _block.seq
-            self.data_waiting.notify()
+            if self._read_want and len(self.data) >= self._read_want:
+                self.data_waiting.notify()
             self.data_waiting.release()
 
+        sack_due = False
+
         for b in blocks:
-            self._rtt_measure["size"] += len(b.get_packed())
-            if b.type == T_ACK:
+            self._rtt_measure["size"] += b._wire_z
+            if b.type in (T_ACK, T_ACK16, T_SACK):
+                # The first answer to our request, not a duplicate
+                answer = bool(self.waiting_for_ack)
+                if self.__attempts == 0 and self._xme and \
+                        not self._retransmit and answer:
+                    # Karn's rule: only time an ACK that can only be the
+                    # answer to the request we just sent
+                    self.rtt_sample(time.time() - self._xme)
+                elif answer:
+                    # Too ambiguous to time, but the remote is answering,
+                    # and on a radio link the losses that backed us off
+                    # are noise more often than congestion.  Carrying
+                    # the backoff into the next round would leave the
+                    # link idle for most of a lossy transfer
+                    self.rtt_estimator().reset_backoff()
                 self.__attempts = 0
                 self._rtt_measure["end"] = time.time()
                 self.waiting_for_ack = False
-                acked = [ord(x) for x in b.data]
+                if b.type == T_SACK:
+                    limit = self._oseq_limit()
+                    cum, acked = decode_sack(b.data, limit)
+                    for block in self.outstanding:
+                        if 0 < (cum - block.seq) % limit <= limit // 2:
+                            acked.add(block.seq)
+                else:
+                    acked = decode_blocks(b.data, b.type == T_ACK16)
                 print(("Stateful  : Acked blocks: %s (/%i)" % (acked, len(self.outstanding))))
+                acked_size = 0
                 for block in self.outstanding[:]:
                     self._rtt_measure["size"] += block._xmit_z
                     if block.seq in acked:
                         block.ackd_event.set()
                         self.stats["sent_size"] += len(block.data)
+                        self._acked += len(block.data)
+                        acked_size += len(block.data)
                         self.outstanding.remove(block)
                     else:
                         print(("Stateful  : Block %i outstanding, but not acked" % block.seq))
                 if len(self.outstanding) == 0:
                     print("Stateful  : This ACKed every block")
-                    if self.__full_acks >= 0:
-                        self.__full_acks += 1
-                    else:
-                        self.__full_acks = 0
-                else:
+                elif answer:
                     print("Stateful  : This was not a full ACK")
-                    if self.__full_acks > 0:
-                        self.__full_acks = 0
-                    else:
-                        self.__full_acks -= 1
-            elif b.type == T_DAT:
+                    self._nakd = True
+                else:
+                    # A duplicate, which may predate blocks we have
+                    # sent since, so it says nothing about their loss
+                    print("Stateful  : Stale ACK, not resending")
+                if answer:
+                    self.congestion().on_ack(acked_size,
+                                             bool(self.outstanding),
+                                             self.bsize,
+                                             time.time() - self._xms)
+            elif b.type in (T_DAT, T_DATREQ):
                 print(("Stateful  : Got block %i" % b.seq))
-                # FIXME: For 16-bit blocks
-                if b.seq == 0 and self.iseq == 255:
+                if b.type == T_DATREQ:
+                    sack_due = self._peer_seq16 = True
+                if b.seq > 255:
+                    self._peer_seq16 = True
+                if b.seq == 0 and self.iseq == self._iseq_limit() - 1:
                     # Reset received list, because remote will only send
-                    # a block 0 following a block 255 if it has received
-                    # our ack of the previous 0-255
-                    self.recv_list = []
+                    # a block 0 following the last block number if it
+                    # has received our ack of the previous ones
+                    self.recv_list = set()
 
                 if b.seq not in self.recv_list:
-                    self.recv_list.append(b.seq)
+                    self.recv_list.add(b.seq)
                     self.stats["recv_size"] += len(b.data)
                     self.oob_queue[b.seq] = b
-            elif b.type == T_REQACK:
+            elif b.type in (T_REQACK, T_REQACK16):
+                seq16 = b.type == T_REQACK16
+                if seq16:
+                    self._peer_seq16 = True
                 toack = []
 
-                # FIXME: This needs to support 16-bit block numbers!
-                for i in [ord(x) for x in b.data]:
+                for i in decode_blocks(b.data, seq16):
                     if i in self.recv_list:
                         print(("Stateful  : Acking block %i" % i))
                         toack.append(i)
                     else:
                         print(("Stateful  : Naking block %i" % i))
 
-                self.send_ack(toack)
+                self.send_ack(toack, seq16)
+            elif b.type == T_REQSACK:
+                sack_due = self._peer_seq16 = True
             else:
                 print(("Stateful  : Got unknown type: %i" % b.type))
 
@@ -345,6 +649,9 @@ class StatefulSession(base.Session):
             del self.oob_queue[next(self.iseq)]
             enqueue(block)            
 
+        if sack_due:
+            self.send_sack()
+
     def update_xmt(self, block):
         self._xmt = (self._xmt + block.get_xmit_bps()) / 2.0
         print(("Stateful  : Average transmit rate: %i bps" % self._xmt))
@@ -366,70 +673,153 @@ class StatefulSession(base.Session):
         self._rtt_measure["size"] = 0
         self._rtt_measure["bnum"] = -1
 
-    def worker(self):
-        while self.enabled:
-            self.send_blocks()
-            self.recv_blocks()
+    def step(self):
+        """Run one pass of the session loop.
 
-            if self._rtt_measure["end"]:
-                self.calculate_rtt()
+        Returns (timeout, idle): how long to wait for notify() before
+        the next pass, and whether that wait expiring means the session
+        has been idle for too long (see expire()).
+        """
+        self.send_blocks()
+        self.recv_blocks()
 
-            if not self.outstanding and self.outq.peek():
-                print("Stateful  : Short-circuit")
-                continue # Short circuit because we have things to send
+        if self._rtt_measure["end"]:
+            self.calculate_rtt()
 
-            print(("Stateful  : Session loop (%s:%s)" % (self._id, self.name)))
+        if self._sending:
+            print("Stateful  : Blocks going out, short sleep")
+            return 1, False
 
-            if self.outstanding:
-                print("Stateful  : Outstanding data, short sleep")
-                self.event.wait(1)
-            else:
-                print("Stateful  : Deep sleep")
-                self.event.wait(self.IDLE_TIMEOUT)
-                if not self.event.isSet():
-                    print("Stateful  : Session timed out!")
-                    self.set_state(base.ST_CLSD)
-                    self.enabled = False                    
-                else:
-                    print("Stateful  : Awoke from deep sleep to some data")
+        if not self.outstanding and self.outq.peek():
+            print("Stateful  : Short-circuit")
+            return 0, False # Short circuit because we have things to send
+
+        if self._nakd:
+            print("Stateful  : Resending what the remote missed")
+            return 0, False
+
+        print(("Stateful  : Session loop (%s:%s)" % (self._id, self.name)))
+
+        if self.outstanding:
+            print("Stateful  : Outstanding data, short sleep")
+            return 1, False
+        else:
+            print("Stateful  : Deep sleep")
+            return self.IDLE_TIMEOUT, True
+
+    def expire(self):
+        print("Stateful  : Session timed out!")
+        self.set_state(base.ST_CLSD)
+        self.enabled = False
+
+    def worker(self):
+        while self.enabled:
+            timeout, idle = self.step()
+            if timeout == 0:
+                continue
+
+            self.event.wait(timeout)
+            if idle and not self.event.isSet():
+                self.expire()
+            elif idle:
+                print("Stateful  : Awoke from deep sleep to some data")
                     
             self.event.clear()
             
-    def _block_read_for(self, count):
-        waiting = self.data.peek_all()
-
-        if not count and not waiting:
-            self.data_waiting.wait(1)
+    def _block_read_for(self, count, timeout=1):
+        # Called with data_waiting held.  The receiver only wakes us
+        # once count bytes are in, or we give up after timeout
+        want = count or 1
+        if len(self.data) >= want:
             return
 
-        if count > len("".join(waiting)):
-            self.data_waiting.wait(1)
-            return
+        self._read_want = want
+        self.data_waiting.wait(timeout)
+        self._read_want = 0
 
     def _read(self, count):
         self.data_waiting.acquire()
+        try:
+            self._block_read_for(count)
+            return self.data.read(count)
+        finally:
+            self.data_waiting.release()
 
-        self._block_read_for(count)
+    def readinto(self, buf):
+        """Read up to len(buf) bytes into buf, waiting briefly for the
+        first if there are none, and return the number read"""
+        while self.get_state() == base.ST_SYNC:
+            print("Stateful  : Waiting for session to open")
+            self.wait_for_state_change(5)
 
-        if count == None:
-            b = self.data.dequeue_all()
-            # BlockQueue.dequeue_all() returns the blocks in poppable order,
-            # which is newest first
-            b.reverse()
-            buf = "".join(b)
-        else:
-            buf = ""
-            i = 0
-            while True:
-                next = self.data.peek() or ''
-                if len(next) > 0 and (len(next) + i) < count:
-                    buf += self.data.dequeue()
-                else:
-                    break
+        if self.get_state() != base.ST_OPEN:
+            raise base.SessionClosedError("State is %i" % self.get_state())
 
-        self.data_waiting.release()
+        self.data_waiting.acquire()
+        try:
+            self._block_read_for(1)
+            count = self.data.readinto(buf)
+        finally:
+            self.data_waiting.release()
 
-        return buf
+        if not count and self.get_state() != base.ST_OPEN:
+            raise base.SessionClosedError()
+
+        return count
+
+    def peek(self, count=None):
+        """Return a view of up to count received bytes, waiting briefly
+        for the first if there are none, without copying or consuming
+        them.  It may be short when the data wraps in the ring, and
+        stays valid until the bytes are consume()d"""
+        while self.get_state() == base.ST_SYNC:
+            print("Stateful  : Waiting for session to open")
+            self.wait_for_state_change(5)
+
+        if self.get_state() != base.ST_OPEN:
+            raise base.SessionClosedError("State is %i" % self.get_state())
+
+        self.data_waiting.acquire()
+        try:
+            self._block_read_for(1)
+            view = self.data.peek(count)
+        finally:
+            self.data_waiting.release()
+
+        if not len(view) and self.get_state() != base.ST_OPEN:
+            raise base.SessionClosedError()
+
+        return view
+
+    def consume(self, count):
+        """Discard count bytes from the front of the received data,
+        once a view of them from peek() is done with"""
+        self.data_waiting.acquire()
+        try:
+            self.data.consume(count)
+        finally:
+            self.data_waiting.release()
+
+    def read_exactly(self, count, timeout=30):
+        """Return exactly count bytes, or raise SessionClosedError if
+        the session ends or they do not arrive within timeout"""
+        end = time.time() + timeout
+
+        self.data_waiting.acquire()
+        try:
+            while len(self.data) < count:
+                if self.get_state() not in [base.ST_SYNC, base.ST_OPEN]:
+                    raise base.SessionClosedError("State is %i" % \
+                                                      self.get_state())
+                left = end - time.time()
+                if left <= 0:
+                    raise base.SessionClosedError("Timed out waiting " + \
+                                                      "for %i bytes" % count)
+                self._block_read_for(count, min(left, 1))
+
+            return self.data.read(count)
+        finally:
+            self.data_waiting.release()
 
     def read(self, count=None):
         while self.get_state() == base.ST_SYNC:
@@ -463,16 +853,19 @@ class StatefulSession(base.Session):
             f = DDT2EncodedFrame()
             f.seq = self.oseq
             f.type = T_DAT
+            f.priority = self.priority
             f.data = chunk
+            f.compress_level = compress_level_for_rate(self._xmt)
             f.sent_event.clear()
 
             self.outq.enqueue(f)
             blocks.append(f)
+            self._written += len(chunk)
 
-            self.oseq = (self.oseq + 1) % 256
+            self.oseq = (self.oseq + 1) % self._oseq_limit()
 
         self.queue_next()
-        self.event.set()
+        self.notify()
 
         while timeout is not None and \
                 blocks and \
@@ -493,4 +886,35 @@ class StatefulSession(base.Session):
             else:
                 print(("Stateful  : Block %i not sent?" % block.seq))
 
+    def wait_for_backlog(self, limit=0, timeout=120):
+        """Wait until no more than limit bytes written to the session
+        are still unacknowledged.  Returns False if nothing is acked for
+        timeout seconds, or the session closes first."""
+        end = time.time() + timeout
+        last = None
+
+        while self.get_state() == base.ST_OPEN:
+            # Counted rather than summed from the queues, which blocks
+            # briefly leave while queue_next() moves them
+            size = self._written - self._acked
+            if size <= limit:
+                return True
+            elif size != last:
+                # Like write(), only give up when the ACKs stop coming
+                end = time.time() + timeout
+                last = size
+
+            left = end - time.time()
+            if left <= 0:
+                break
+
+            # The oldest block is the first to be acked
+            pending = self.outstanding[:1] or [self.outq.peek()]
+            if pending[0]:
+                pending[0].ackd_event.wait(min(left, 1))
+            else:
+                time.sleep(0.1)
+
+        return False
+
 
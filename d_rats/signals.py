@@ -165,6 +165,10 @@ FORM_SENT = \
      (gobject.TYPE_INT,          # Session ID
       gobject.TYPE_STRING))      # Filename
 
+GET_PORT_STATS = \
+    (gobject.SIGNAL_ACTION, gobject.TYPE_PYOBJECT,
+     (gobject.TYPE_STRING,))     # Port
+
 GET_CHAT_PORT = \
     (gobject.SIGNAL_ACTION, gobject.TYPE_STRING,
      ())
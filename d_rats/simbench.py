@@ -0,0 +1,305 @@
+#!/usr/bin/python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Protocol benchmarks over a simulated radio link.  Two
+# SessionManagers talk to each other through comm.simulated_pair(),
+# so chat, file, form and RPC traffic can be measured against a given
+# bit rate, turnaround time and error rate without any hardware, and
+# the same seed gives the same damaged transmissions on every run.
+#
+#   python -m d_rats.simbench --rate 1200 --ber 0.0001 --seed 1
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+#importing printlog() wrapper
+from .debug import printlog
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import threading
+
+try:
+    _
+except NameError:
+    # Run on its own, before the session modules need it
+    import gettext
+    gettext.install("D-RATS")
+
+import gobject
+
+from . import comm
+from . import debug
+from . import sessionmgr
+from .sessions import chat, file, form, rpc
+from .version import DRATS_VERSION
+
+SCENARIOS = ["chat", "file", "form", "rpc"]
+
+STATION_A = "SIMA"
+STATION_B = "SIMB"
+
+class BenchLink(object):
+    """Two SessionManagers joined by a simulated radio link"""
+
+    def __init__(self, engine="thread", **linkargs):
+        self.path_a, self.path_b = comm.simulated_pair(**linkargs)
+        self.link = self.path_a.link
+
+        self.sm_a = sessionmgr.SessionManager(self.path_a, STATION_A,
+                                              engine=engine)
+        self.sm_b = sessionmgr.SessionManager(self.path_b, STATION_B,
+                                              engine=engine)
+
+    def shutdown(self):
+        for sm in [self.sm_a, self.sm_b]:
+            sm.shutdown(True)
+        for path in [self.path_a, self.path_b]:
+            path.disconnect()
+
+class _BenchActions(object):
+    """Just enough of RPCActionSet to answer the jobs we send"""
+
+    def RPC_get_version(self, job):
+        return {"version" : DRATS_VERSION}
+
+def _payload(size, seed):
+    # Random data, so compression does not flatter the link
+    r = random.Random(seed)
+    return bytes(bytearray([r.randint(0, 255) for i in range(size)]))
+
+def _airtime(size, rate):
+    return size * 8.0 / rate
+
+def bench_chat(bl, count=20, size=100, **kwargs):
+    a = bl.sm_a.start_session("chat", dest="CQCQCQ", cls=chat.ChatSession)
+    b = bl.sm_b.start_session("chat", dest="CQCQCQ", cls=chat.ChatSession)
+
+    got = []
+    done = threading.Event()
+    handler = b.handler
+
+    def counter(frame):
+        handler(frame)
+        got.append(len(frame.data))
+        if len(got) >= count:
+            done.set()
+
+    b.handler = counter
+
+    start = time.time()
+    for i in range(count):
+        a.write("%04i:%s" % (i, "x" * (size - 5)))
+    done.wait(_airtime(count * (size + 100), bl.link.rate) * 4 + 10)
+
+    return {
+        "ok" : len(got) == count,
+        "elapsed" : time.time() - start,
+        "payload" : sum(got),
+        "retries" : 0,
+        "lost" : count - len(got),
+        }
+
+def _bench_transfer(bl, cls, filename, **kwargs):
+    recvdir = tempfile.mkdtemp()
+    received = {}
+    done = threading.Event()
+
+    def receive(session):
+        received["filename"] = session.recv_file(recvdir)
+        done.set()
+
+    def session_cb(data, reason, session):
+        if reason == "new,in" and isinstance(session, cls):
+            t = threading.Thread(target=receive, args=(session,))
+            t.setDaemon(True)
+            t.start()
+
+    bl.sm_b.register_session_cb(session_cb, None)
+
+    try:
+        start = time.time()
+        s = bl.sm_a.start_session(os.path.basename(filename),
+                                  dest=STATION_B,
+                                  cls=cls,
+                                  blocksize=kwargs.get("blocksize", 1024),
+                                  outlimit=kwargs.get("outlimit", 8))
+        sent = s.send_file(filename)
+        done.wait(_airtime(os.path.getsize(filename), bl.link.rate) * 8 + 60)
+        elapsed = time.time() - start
+
+        ok = False
+        if sent and received.get("filename"):
+            f = open(filename, "rb")
+            g = open(received["filename"], "rb")
+            ok = f.read() == g.read()
+            f.close()
+            g.close()
+
+        return {
+            "ok" : ok,
+            "elapsed" : elapsed,
+            "payload" : ok and os.path.getsize(filename) or 0,
+            "retries" : s.stats["retries"],
+            "lost" : 0,
+            }
+    finally:
+        shutil.rmtree(recvdir, True)
+
+def bench_file(bl, file_size=8192, seed=None, **kwargs):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.bin")
+        f = open(filename, "wb")
+        f.write(_payload(file_size, seed))
+        f.close()
+
+        return _bench_transfer(bl, file.FileTransferSession, filename,
+                               **kwargs)
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def bench_form(bl, formfile=None, **kwargs):
+    if not formfile:
+        formfile = os.path.join(os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))), "forms", "email.xml")
+
+    return _bench_transfer(bl, form.FormTransferSession, formfile, **kwargs)
+
+def bench_rpc(bl, count=5, **kwargs):
+    a = bl.sm_a.start_session("rpc", dest="CQCQCQ", cls=rpc.RPCSession,
+                              rpcactions=_BenchActions())
+    bl.sm_b.start_session("rpc", dest="CQCQCQ", cls=rpc.RPCSession,
+                          rpcactions=_BenchActions())
+
+    results = []
+    done = threading.Event()
+
+    def state_change(job, state, result):
+        results.append((state, result))
+        done.set()
+
+    start = time.time()
+    for i in range(count):
+        done.clear()
+        job = rpc.RPCGetVersion(STATION_B, "Benchmark %i" % i)
+        job.connect("state-change", state_change)
+        a.submit(job)
+        # RPCSession gives up on a job after 30 seconds
+        done.wait(35)
+
+    complete = [r for s, r in results if s == "complete"]
+
+    return {
+        "ok" : len(complete) == count,
+        "elapsed" : time.time() - start,
+        "payload" : sum([len(rpc.encode_dict(r)) for r in complete]),
+        "retries" : 0,
+        "lost" : count - len(complete),
+        }
+
+def run_benchmarks(scenarios=SCENARIOS, engine="thread", quiet=True,
+                   linkargs={}, **kwargs):
+    """Run each scenario over a fresh link and return the results"""
+
+    # RPC jobs and chat report through the gobject main loop
+    gobject.threads_init()
+    loop = gobject.MainLoop()
+    t = threading.Thread(target=loop.run)
+    t.setDaemon(True)
+    t.start()
+
+    results = []
+    for name in scenarios:
+        fn = globals()["bench_%s" % name]
+
+        with debug.quiet(quiet):
+            bl = BenchLink(engine, **linkargs)
+            try:
+                result = fn(bl, **kwargs)
+            finally:
+                bl.shutdown()
+
+        result["scenario"] = name
+        result["link"] = bl.link.get_stats()
+        results.append(result)
+
+    loop.quit()
+
+    return results
+
+def print_results(results):
+    printlog("Simbench","  : %-6s %-4s %8s %8s %9s %7s %5s %5s %5s" % \
+                 ("Test", "OK", "Payload", "Time", "Goodput", "Retries",
+                  "Lost", "TX", "Dmgd"))
+    for r in results:
+        link = r["link"]
+        elapsed = max(r["elapsed"], 0.000001)
+        printlog("Simbench","  : %-6s %-4s %8i %7.1fs %5.0f B/s %7i %5i %5i %5i" % \
+                     (r["scenario"],
+                      r["ok"] and "yes" or "NO",
+                      r["payload"],
+                      r["elapsed"],
+                      r["payload"] / elapsed,
+                      r["retries"],
+                      r["lost"],
+                      link["transmissions"],
+                      link["lost"] + link["corrupted"]))
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    o = OptionParser()
+    o.add_option("-r", "--rate", dest="rate", type="int", default=9600,
+                 help="Link bit rate")
+    o.add_option("-t", "--turnaround", dest="turnaround", type="float",
+                 default=0.1, help="Half-duplex turnaround time (sec)")
+    o.add_option("-k", "--keyup", dest="keyup", type="float", default=0.05,
+                 help="Key-up latency (sec)")
+    o.add_option("-b", "--ber", dest="ber", type="float", default=0.0,
+                 help="Bit error rate")
+    o.add_option("-l", "--loss", dest="loss", type="float", default=0.0,
+                 help="Probability of losing a whole transmission")
+    o.add_option("-s", "--seed", dest="seed", type="int", default=None,
+                 help="Seed for the error model")
+    o.add_option("-e", "--engine", dest="engine", default="thread",
+                 help="Transport engine (thread or asyncio)")
+    o.add_option("-S", "--size", dest="size", type="int", default=8192,
+                 help="File transfer size")
+    o.add_option("-T", "--tests", dest="tests", default=",".join(SCENARIOS),
+                 help="Scenarios to run (%s)" % ",".join(SCENARIOS))
+    o.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                 default=False, help="Show protocol logging")
+    (opts, args) = o.parse_args()
+
+    linkargs = {
+        "rate" : opts.rate,
+        "turnaround" : opts.turnaround,
+        "keyup" : opts.keyup,
+        "ber" : opts.ber,
+        "loss" : opts.loss,
+        "seed" : opts.seed,
+        }
+
+    results = run_benchmarks(opts.tests.split(","),
+                             engine=opts.engine,
+                             quiet=not opts.verbose,
+                             linkargs=linkargs,
+                             file_size=opts.size,
+                             seed=opts.seed)
+    print_results(results)
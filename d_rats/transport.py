@@ -23,35 +23,59 @@ from .debug import printlog
 
 import threading
 import re
+import os
+import select
 import time
 import random
 import traceback
+import struct
 import sys
+from collections import deque
 
+from . import debug
 from . import utils
 from . import ddt2
 from . import comm
 from six.moves import range
 
+# Optional protocol features, advertised to peers by the control session
+CAP_ZDICT = "zdict"
+CAP_AGGREGATE = "agg"
+CAP_SEQ16 = "seq16"
+CAP_SACK = "sack"
+CAP_FILESTREAM = "fstream"
+
+# Session 0 frame type carrying several packed frames (see send_frames)
+T_AGGREGATE = 252
+
+# Outbound frame classes, served in this order (see FrameQueue)
+PRI_CONTROL     = 0
+PRI_ACK         = 1
+PRI_INTERACTIVE = 2
+PRI_BULK        = 3
+
+# Framing added to a frame's payload on the wire ([SOB], header, [EOB])
+FRAME_OVERHEAD = 35
+
 class BlockQueue(object):
     def __init__(self):
         self._lock = threading.Lock()
-        self._queue = []
+        self._queue = deque()
 
     def enqueue(self, block):
         self._lock.acquire()
-        self._queue.insert(0, block)
+        self._queue.append(block)
         self._lock.release()
 
     def requeue(self, block):
         self._lock.acquire()
-        self._queue.append(block)
+        self._queue.appendleft(block)
         self._lock.release()
 
     def dequeue(self):
         self._lock.acquire()
         try:
-            b = self._queue.pop()
+            b = self._queue.popleft()
         except IndexError:
             b = None
         self._lock.release()
@@ -59,18 +83,20 @@ class BlockQueue(object):
         return b
 
     def dequeue_all(self):
+        # Returns the blocks newest first, like repeated pop()s would
         self._lock.acquire()
-        l = self._queue
-        self._queue = []
+        l = list(self._queue)
+        self._queue.clear()
         self._lock.release()
 
+        l.reverse()
         return l
 
     def peek(self):
         self._lock.acquire()
         try:
             el = self._queue[0]
-        except:
+        except IndexError:
             el = None
         self._lock.release()
         
@@ -78,11 +104,15 @@ class BlockQueue(object):
 
     def peek_all(self):
         self._lock.acquire()
-        q = self._queue
+        q = list(self._queue)
         self._lock.release()
 
+        q.reverse()
         return q
 
+    def __len__(self):
+        return len(self._queue)
+
     # BE CAREFUL WITH THESE!
 
     def lock(self):
@@ -91,12 +121,395 @@ class BlockQueue(object):
     def unlock(self):
         self._lock.release()
 
+class ByteRing(object):
+    """FIFO of bytes in a ring buffer that doubles when it fills.
+
+    Not locked: callers serialize access themselves.  A view from
+    peek() stays valid until those bytes are consume()d, because
+    writes only go into free space, and growing moves the data to a
+    new buffer rather than resizing the old one.
+    """
+
+    def __init__(self, size=4096):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _grow(self, need):
+        size = len(self._buf)
+        while size < need:
+            size *= 2
+
+        buf = bytearray(size)
+        count = self.readinto(memoryview(buf), consume=False)
+
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._start = 0
+        self._len = count
+
+    def write(self, data):
+        count = len(data)
+        if self._len + count > len(self._buf):
+            self._grow(self._len + count)
+
+        size = len(self._buf)
+        end = (self._start + self._len) % size
+        first = min(count, size - end)
+        self._view[end:end + first] = data[:first]
+        if first < count:
+            self._view[:count - first] = data[first:]
+        self._len += count
+
+    def peek(self, count=None):
+        """Return a view of up to count unread bytes, without
+        consuming them.  It may be short when the data wraps."""
+        if count is None or count > self._len:
+            count = self._len
+        count = min(count, len(self._buf) - self._start)
+
+        return self._view[self._start:self._start + count]
+
+    def consume(self, count):
+        count = min(count, self._len)
+        self._start = (self._start + count) % len(self._buf)
+        self._len -= count
+        if not self._len:
+            self._start = 0
+
+    def readinto(self, buf, consume=True):
+        """Copy up to len(buf) bytes into buf, returning the count"""
+        want = min(len(buf), self._len)
+        start = self._start
+        done = 0
+        while done < want:
+            count = min(want - done, len(self._buf) - start)
+            buf[done:done + count] = self._view[start:start + count]
+            done += count
+            start = (start + count) % len(self._buf)
+
+        if consume:
+            self.consume(done)
+
+        return done
+
+    def read(self, count=None):
+        """Return exactly min(count, len(self)) bytes"""
+        if count is None or count > self._len:
+            count = self._len
+
+        view = self.peek(count)
+        if len(view) == count:
+            data = view.tobytes()
+            self.consume(count)
+        else:
+            buf = bytearray(count)
+            self.readinto(buf)
+            data = bytes(buf)
+
+        return data
+
+class FrameQueue(object):
+    """Outbound queue with a FIFO per (class, session).
+
+    Classes are served strictly in PRI_* order, and sessions within a
+    class take turns, so a bulk transfer can not hold up ACKs or other
+    sessions' frames.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = [{} for i in range(PRI_BULK + 1)]
+        self._rings = [deque() for i in range(PRI_BULK + 1)]
+        self._count = 0
+        self._bytes = 0
+
+    def _class_of(self, frame):
+        if frame.session == 0:
+            return PRI_CONTROL
+        elif frame.priority is None:
+            return PRI_INTERACTIVE
+        return frame.priority
+
+    def _queue_for(self, frame):
+        pri = self._class_of(frame)
+        queue = self._queues[pri].get(frame.session)
+        if queue is None:
+            queue = self._queues[pri][frame.session] = deque()
+            if frame.session not in self._rings[pri]:
+                self._rings[pri].append(frame.session)
+
+        return pri, queue
+
+    def _size_of(self, frame):
+        # Remembered, so the frame changing in the queue can't skew
+        # the byte count
+        size = getattr(frame, "_q_size", None)
+        if size is None:
+            size = frame._q_size = len(frame.data or "") + FRAME_OVERHEAD
+        return size
+
+    def enqueue(self, frame):
+        self._lock.acquire()
+        pri, queue = self._queue_for(frame)
+        queue.append(frame)
+        self._count += 1
+        self._bytes += self._size_of(frame)
+        self._lock.release()
+
+    def requeue(self, frame):
+        # Put it back at the head of the line, ahead of its class
+        self._lock.acquire()
+        pri, queue = self._queue_for(frame)
+        queue.appendleft(frame)
+        ring = self._rings[pri]
+        ring.remove(frame.session)
+        ring.appendleft(frame.session)
+        self._count += 1
+        self._bytes += self._size_of(frame)
+        self._lock.release()
+
+    def dequeue(self):
+        self._lock.acquire()
+        try:
+            for pri, ring in enumerate(self._rings):
+                queues = self._queues[pri]
+                while ring:
+                    session = ring[0]
+                    queue = queues.get(session)
+                    if not queue:
+                        # Flushed since it was put in the ring
+                        ring.popleft()
+                        queues.pop(session, None)
+                        continue
+
+                    frame = queue.popleft()
+                    self._count -= 1
+                    self._bytes -= self._size_of(frame)
+                    if queue:
+                        ring.rotate(-1)
+                    else:
+                        ring.popleft()
+                        del queues[session]
+                    return frame
+
+            return None
+        finally:
+            self._lock.release()
+
+    def dequeue_all(self):
+        frames = []
+        while True:
+            f = self.dequeue()
+            if f is None:
+                break
+            frames.append(f)
+
+        return frames
+
+    def peek(self):
+        self._lock.acquire()
+        try:
+            for pri, ring in enumerate(self._rings):
+                for session in ring:
+                    queue = self._queues[pri].get(session)
+                    if queue:
+                        return queue[0]
+            return None
+        finally:
+            self._lock.release()
+
+    def flush(self, session):
+        self._lock.acquire()
+        count = 0
+        for queues in self._queues:
+            queue = queues.pop(session, None)
+            if queue:
+                count += len(queue)
+                self._bytes -= sum([self._size_of(f) for f in queue])
+        self._count -= count
+        self._lock.release()
+
+        return count
+
+    def get_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return self._count
+
+class TransmitScheduler(object):
+    """Decides when a port may key up, and for how much data.
+
+    Limits (zero, or a duty_cycle of 1.0, means unlimited):
+      rate        -- token bucket refill, in bytes per second
+      burst       -- token bucket depth, in bytes
+      max_keydown -- longest single transmission, in seconds
+      min_gap     -- quiet time between transmissions, in seconds
+      duty_cycle  -- fraction of duty_window we may spend transmitting
+    """
+
+    def __init__(self, rate=0, burst=0, max_keydown=0, min_gap=0,
+                 duty_cycle=1.0, duty_window=600):
+        self.rate = rate
+        self.burst = burst or max(rate * 4, 512)
+        self.max_keydown = max_keydown
+        self.min_gap = min_gap
+        self.duty_cycle = duty_cycle
+        self.duty_window = duty_window
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._filled = time.time()
+        self._keydowns = deque() # (start, end) of recent transmissions
+        self._last_end = 0
+        self.link_rate = 0       # Measured bytes per second while keyed
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._filled) * self.rate)
+        self._filled = now
+
+    def _airtime(self, size):
+        if self.link_rate:
+            return size / float(self.link_rate)
+        return 0
+
+    def _duty_used(self, now):
+        start = now - self.duty_window
+        while self._keydowns and self._keydowns[0][1] <= start:
+            self._keydowns.popleft()
+
+        return sum([e - max(s, start) for s, e in self._keydowns])
+
+    def _duty_wait(self, now, size):
+        if self.duty_cycle >= 1.0:
+            return 0
+
+        allowed = self.duty_cycle * self.duty_window
+        used = self._duty_used(now)
+        excess = used + self._airtime(size) - allowed
+        if excess <= 0:
+            return 0
+
+        # A transmission longer than the whole allowance can only go
+        # once the window is empty, rather than never
+        excess = min(excess, used)
+
+        # Find when enough of the oldest key-downs have aged out
+        start = now - self.duty_window
+        aged = 0
+        for s, e in self._keydowns:
+            s = max(s, start)
+            if aged + (e - s) >= excess:
+                return s + (excess - aged) + self.duty_window - now
+            aged += e - s
+
+        return 0
+
+    def wait_time(self, size):
+        """Return how long to hold off before sending @size bytes"""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+
+            waits = [self._last_end + self.min_gap - now,
+                     self._duty_wait(now, size)]
+            need = min(size, self.burst)
+            if self.rate and self._tokens < need:
+                waits.append((need - self._tokens) / float(self.rate))
+
+            return max(0, max(waits))
+        finally:
+            self._lock.release()
+
+    def budget(self):
+        """Return how many bytes one transmission may carry, or None"""
+        self._lock.acquire()
+        try:
+            limits = []
+            if self.rate:
+                self._refill(time.time())
+                limits.append(max(0, int(self._tokens)))
+            if self.max_keydown and self.link_rate:
+                limits.append(int(self.max_keydown * self.link_rate))
+
+            if limits:
+                return min(limits)
+            return None
+        finally:
+            self._lock.release()
+
+    def record(self, start, end, size):
+        """Account for a transmission of @size bytes"""
+        self._lock.acquire()
+        try:
+            self._refill(end)
+            self._tokens -= size # May go into debt for oversize frames
+            self._keydowns.append((start, end))
+            self._last_end = end
+
+            if (end - start) > 0.01:
+                rate = size / (end - start)
+                if self.link_rate:
+                    self.link_rate = (self.link_rate + rate) / 2.0
+                else:
+                    self.link_rate = rate
+        finally:
+            self._lock.release()
+
+    def drain_time(self, size, count):
+        """Estimate how long @size bytes in @count frames take to go out"""
+        if not count:
+            return 0
+
+        hold = self.wait_time(min(size, FRAME_OVERHEAD))
+
+        self._lock.acquire()
+        try:
+            times = [self._airtime(size)]
+            if self.rate:
+                times.append(max(0, size - self._tokens) / float(self.rate))
+            if self.duty_cycle < 1.0:
+                times.append(self._airtime(size) / self.duty_cycle)
+            gaps = self.min_gap * max(0, count - 1)
+        finally:
+            self._lock.release()
+
+        return hold + max(times) + gaps
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            return {
+                "tokens" : self._tokens if self.rate else None,
+                "link_rate" : self.link_rate,
+                "duty_used" : self._duty_used(now) / float(self.duty_window),
+                }
+        finally:
+            self._lock.release()
+
 class Transporter(object):
+    # Largest [SOB]...[EOB] block we wait for before giving up on a
+    # header, and how much unframed data we keep for GPS/compat parsing
+    MAX_BLOCK = 16384
+    MAX_GARBAGE = 16384
+
     def __init__(self, pipe, inhandler=None, authfn=None, **kwargs):
         self.inq = BlockQueue()
-        self.outq = BlockQueue()
+        self.outq = FrameQueue()
         self.pipe = pipe
-        self.inbuf = b""
+        self.inbuf = bytearray()
+        self._scan_pos = 0  # Where to resume looking for a header
+        self._trail_pos = 0 # Where to resume looking for its trailer
         self.enabled = True
         self.inhandler = inhandler
         self.compat = kwargs.get("compat", False)
@@ -107,14 +520,51 @@ class Transporter(object):
         self.msg_fn = kwargs.get("msg_fn", None)
         self.name = kwargs.get("port_name", "")
 
+        self.caps = set()
+        if kwargs.get("zdict", True) and ddt2.ZDICT_SUPPORTED:
+            self.caps.add(CAP_ZDICT)
+        if kwargs.get("aggregate", False):
+            self.caps.add(CAP_AGGREGATE)
+        if kwargs.get("seq16", True):
+            self.caps.add(CAP_SEQ16)
+        if kwargs.get("sack", True):
+            self.caps.add(CAP_SACK)
+        if kwargs.get("file_stream", True):
+            self.caps.add(CAP_FILESTREAM)
+        self.aggregate_window = kwargs.get("aggregate_window", 0.25)
+        self.aggregate_limit = kwargs.get("aggregate_limit", 2048)
+        self.peer_caps = {}
+
+        self.sched = TransmitScheduler(
+            rate=kwargs.get("tx_rate", 0),
+            burst=kwargs.get("tx_burst", 0),
+            max_keydown=kwargs.get("max_keydown", 0),
+            min_gap=kwargs.get("min_tx_gap", 0),
+            duty_cycle=kwargs.get("duty_cycle", 1.0),
+            duty_window=kwargs.get("duty_window", 600))
+        self._tx_hold = 0 # Don't try to transmit again before this
+
+        self.last_xmit = 0
+        self.last_recv = 0
+
+        self._start(authfn)
+
+    def _start(self, authfn):
+        self._wake_r = self._wake_w = None
+        if os.name == "posix":
+            # select() on a pipe lets send_frame() interrupt the wait for
+            # input.  Elsewhere we fall back to polling the data path.
+            import fcntl
+            self._wake_r, self._wake_w = os.pipe()
+            for fd in (self._wake_r, self._wake_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
         self.thread = threading.Thread(target=self.worker,
                                        args=(authfn,))
         self.thread.setDaemon(True)
         self.thread.start()
 
-        self.last_xmit = 0
-        self.last_recv = 0
-
     def __send(self, data):
         for i in range(0, 10):
             try:
@@ -162,38 +612,87 @@ class Transporter(object):
         else:
             self.inq.enqueue(frame)
 
+    def _consume(self, count):
+        # Deleting from the front of a bytearray does not reallocate
+        del self.inbuf[:count]
+        self._scan_pos = self._trail_pos = 0
+
+    def _next_block(self):
+        hlen = len(ddt2.ENCODED_HEADER)
+        tlen = len(ddt2.ENCODED_TRAILER)
+
+        while True:
+            s = self.inbuf.find(ddt2.ENCODED_HEADER, self._scan_pos)
+            if s < 0:
+                # Keep a possible partial header at the end
+                self._scan_pos = max(0, len(self.inbuf) - hlen + 1)
+                if len(self.inbuf) > self.MAX_GARBAGE:
+                    printlog("Transport"," : Dropping %i bytes of unframed data" % \
+                                 (len(self.inbuf) - self.MAX_GARBAGE))
+                    self._consume(len(self.inbuf) - self.MAX_GARBAGE)
+                return None
+
+            self._scan_pos = s
+            e = self.inbuf.find(ddt2.ENCODED_TRAILER,
+                                max(s + hlen, self._trail_pos))
+            if e < 0:
+                if (len(self.inbuf) - s) > self.MAX_BLOCK:
+                    printlog("Transport"," : Dropping header without trailer")
+                    self._consume(s + hlen)
+                    continue
+                self._trail_pos = max(s + hlen, len(self.inbuf) - tlen + 1)
+                return None
+
+            # If the trailer of an earlier block was lost, start from
+            # the last header before this trailer
+            s = self.inbuf.rfind(ddt2.ENCODED_HEADER, s, e)
+            e += tlen
+
+            block = bytes(self.inbuf[s:e])
+            self._consume(e)
+
+            return block
+
     def parse_blocks(self):
         # start processing data from the packet arrived 
-        while ddt2.ENCODED_HEADER in self.inbuf and \
-                ddt2.ENCODED_TRAILER in self.inbuf:
-            s = self.inbuf.index(ddt2.ENCODED_HEADER)
-            e = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
-                len(ddt2.ENCODED_TRAILER)
-
-            if e < s:
-                # Excise the extraneous end
-                _tmp = self.inbuf[:e-len(ddt2.ENCODED_TRAILER)] + \
-                    self.inbuf[e:]
-                self.inbuf = _tmp
-                continue
-
-            block = self.inbuf[s:e]
-            self.inbuf = self.inbuf[e:]
+        while True:
+            block = self._next_block()
+            if block is None:
+                break
 
             f = ddt2.DDT2EncodedFrame()
             try:
                 if f.unpack(block):
                     printlog("Transport"," : Got a block: %s" % f)
-                    self._handle_frame(f)
+                    if f.session == 0 and f.type == T_AGGREGATE:
+                        self._handle_aggregate(f)
+                    else:
+                        self._handle_frame(f)
                 elif self.compat:
                     self._send_text_block(block)
                 else:
-                    printlog("Transport"," : Found a broken block (S:%i E:%i len(buf):%i" % (s, e, len(self.inbuf)))
+                    printlog("Transport"," : Found a broken block (len:%i len(buf):%i)" % (len(block), len(self.inbuf)))
                     utils.hexprintlog(block)
             except Exception as e:
                 printlog("Transport"," : Failed to process block:")
                 utils.log_exception()
 
+    def _handle_aggregate(self, container):
+        data = container.data
+        pos = 0
+        while pos + 2 <= len(data):
+            length, = struct.unpack("!H", bytes(data[pos:pos+2]))
+            packed = data[pos+2:pos+2+length]
+            pos += 2 + length
+
+            f = ddt2.DDT2EncodedFrame()
+            if ddt2.DDT2Frame.unpack(f, packed):
+                printlog("Transport"," : Got an aggregated block: %s" % f)
+                self._handle_frame(f)
+            else:
+                printlog("Transport"," : Found a broken aggregated block")
+                utils.hexprintlog(packed)
+
     def _match_gps(self):
         # NMEA-style
         # Starts with $GP**[a-f0-9]{2}\r?\n?
@@ -226,6 +725,7 @@ class Transporter(object):
         result = self._match_gps()
         if result:
             self.inbuf = self.inbuf.replace(result, b"")
+            self._scan_pos = self._trail_pos = 0
             printlog("Transport"," : Found GPS string: %s" % repr(result))
             self._send_text_block(result)
         else:
@@ -235,6 +735,60 @@ class Transporter(object):
         while self._match_gps():
             self._parse_gps()
             
+    def _xmit_delay(self, f):
+        # How long to hold off before transmitting a round of frames
+        if self.force_delay < 0:
+            # If force_delay is negative, wait between 0.5 and
+            # abs(force_delay) seconds before transmitting
+            return random.randint(5, abs(self.force_delay)*10)/10.0
+        elif self.force_delay:
+            # If force_delay is positive, then wait exactly that
+            # long before transmitting
+            return self.force_delay
+        elif self._can_aggregate(f):
+            # Give back-to-back frames a chance to be queued
+            return self.aggregate_window
+        else:
+            return 0
+
+    def _tx_wait(self, f):
+        # How long the scheduler wants us to hold @f, or 0 to send now
+        return self.sched.wait_time(len(f.get_packed()))
+
+    def _send_batch(self, frames):
+        start = time.time()
+        size = 0
+
+        if ((start - self.last_xmit) > self.warmup_timeout) and \
+                (self.warmup_timeout > 0):
+            warmup_f = ddt2.DDT2EncodedFrame()
+            warmup_f.seq = 0
+            warmup_f.session = 0
+            warmup_f.type = 254
+            warmup_f.s_station = "!"
+            warmup_f.d_station = "!"
+            warmup_f.data = ("\x01" * self.warmup_length)
+            warmup_f.set_compress(False)
+            printlog(("Transport : Sending warm-up: %s" % warmup_f))
+            data = warmup_f.get_packed()
+            self.__send(data)
+            size += len(data)
+
+        if len(frames) > 1:
+            size += self._send_aggregate(frames)
+        else:
+            f = frames[0]
+            printlog("Transport"," : Sending block: %s" % f)
+            data = f.get_packed()
+            f._xmit_s = time.time()
+            self.__send(data)
+            f._xmit_e = time.time()
+            f.set_sent()
+            size += len(data)
+            self.last_xmit = time.time()
+
+        self.sched.record(start, self.last_xmit, size)
+
     def send_frames(self):
         delayed = False
 
@@ -243,44 +797,176 @@ class Transporter(object):
             if not f:
                 break
 
-            if self.force_delay and not delayed:
-                if self.force_delay < 0:
-                    # If force_delay is negative, wait between 0.5 and
-                    # abs(force_delay) seconds before transmitting
-                    delay = random.randint(5, abs(self.force_delay)*10)/10.0
-                else:
-                    # If force_delay is positive, then wait exactly that
-                    # long before transmitting
-                    delay = self.force_delay
+            self._apply_caps(f)
+
+            hold = self._tx_wait(f)
+            if hold:
+                # Leave it queued and come back for it later
+                self.outq.requeue(f)
+                self._tx_hold = time.time() + hold
+                printlog("Transport"," : Holding transmit for %.1f sec" % hold)
+                break
 
-                printlog("Transport"," : Waiting %.1f sec before transmitting" % delay)
-                time.sleep(delay)
+            if not delayed:
+                delay = self._xmit_delay(f)
+                if delay:
+                    printlog("Transport"," : Waiting %.1f sec before transmitting" % delay)
+                    time.sleep(delay)
                 delayed = True
 
-            if ((time.time() - self.last_xmit) > self.warmup_timeout) and \
-                    (self.warmup_timeout > 0):
-                warmup_f = ddt2.DDT2EncodedFrame()
-                warmup_f.seq = 0
-                warmup_f.session = 0
-                warmup_f.type = 254
-                warmup_f.s_station = "!"
-                warmup_f.d_station = "!"
-                warmup_f.data = ("\x01" * self.warmup_length)
-                warmup_f.set_compress(False)
-                printlog(("Transport : Sending warm-up: %s" % warmup_f))
-                self.__send(warmup_f.get_packed())
+            self._send_batch(self._gather_frames(f))
 
-            printlog("Transport"," : Sending block: %s" % f)
-            f._xmit_s = time.time()
-            self.__send(f.get_packed())
-            f._xmit_e = time.time()
-            f.sent_event.set()
-            self.last_xmit = time.time()
+    def _can_aggregate(self, f):
+        return isinstance(f, ddt2.DDT2EncodedFrame) and \
+            self.peer_has_cap(f.d_station, CAP_AGGREGATE)
+
+    def _gather_frames(self, first):
+        frames = [first]
+        if not self._can_aggregate(first):
+            return frames
+
+        size = len(ddt2.DDT2Frame.get_packed(first))
+        limit = self.aggregate_limit
+        budget = self.sched.budget()
+        if budget is not None:
+            limit = min(limit, budget)
+
+        while True:
+            f = self.outq.dequeue()
+            if not f:
+                break
+
+            self._apply_caps(f)
+            if self._can_aggregate(f):
+                length = len(ddt2.DDT2Frame.get_packed(f)) + 2
+            else:
+                length = None
+
+            if length is None or (size + length) > limit:
+                # Leave it at the head of the queue for the next round
+                self.outq.requeue(f)
+                break
+
+            frames.append(f)
+            size += length
+
+        return frames
+
+    def _send_aggregate(self, frames):
+        packed = [ddt2.DDT2Frame.get_packed(f) for f in frames]
+
+        container = ddt2.DDT2EncodedFrame()
+        container.seq = 0
+        container.session = 0
+        container.type = T_AGGREGATE
+        container.s_station = frames[0].s_station
+        if len(set([f.d_station for f in frames])) == 1:
+            container.d_station = frames[0].d_station
+        else:
+            container.d_station = "CQCQCQ"
+        container.data = b"".join([struct.pack("!H", len(p)) + p
+                                   for p in packed])
+
+        printlog("Transport"," : Sending %i blocks as %s" % (len(frames),
+                                                              container))
+        data = container.get_packed()
+        start = time.time()
+        self.__send(data)
+        end = time.time()
+
+        # Share the transmit time out by size, so rate estimates
+        # based on get_xmit_bps() still hold
+        total = float(sum([len(p) for p in packed]))
+        offset = 0
+        for f, p in zip(frames, packed):
+            f._xmit_s = start + (end - start) * (offset / total)
+            offset += len(p)
+            f._xmit_e = start + (end - start) * (offset / total)
+            f.set_sent()
+
+        self.last_xmit = time.time()
+
+        return len(data)
+
+    def get_stats(self):
+        """Return the state of the outbound queue and transmit limits"""
+        size = self.outq.get_bytes()
+        count = len(self.outq)
+
+        stats = self.sched.get_stats()
+        stats["queued_frames"] = count
+        stats["queued_bytes"] = size
+        stats["hold"] = max(0, self._tx_hold - time.time()) if count else 0
+        stats["drain_time"] = self.sched.drain_time(size, count)
+
+        return stats
+
+    def get_caps(self):
+        return set(self.caps)
+
+    def set_peer_caps(self, station, caps):
+        printlog("Transport"," : Station %s supports: %s" % (station, caps))
+        self.peer_caps[station] = set(caps)
+
+    def peer_has_cap(self, station, cap):
+        return cap in self.caps and cap in self.peer_caps.get(station, ())
+
+    def _apply_caps(self, f):
+        if f.compress and self.peer_has_cap(f.d_station, CAP_ZDICT):
+            f.zdict = True
 
     def compat_is_time(self):
         return (time.time() - self.last_recv) > self.compat_delay
 
-    def worker(self, authfn):
+    def _wakeup(self):
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, b"!")
+        except OSError:
+            pass # Pipe is full, so a wakeup is already pending
+
+    def _wait_for_input(self):
+        # Sleep until the data path is readable, send_frame() wakes us
+        # up, or unconverted data is due to be flushed.  Returns False
+        # if there is nothing to read.
+        try:
+            fd = getattr(self.pipe, "fileno", lambda: None)()
+        except Exception:
+            fd = None
+
+        if self._wake_r is None or fd is None or fd < 0:
+            # Not selectable, so let the data path block on its timeout
+            return True
+
+        if self.inbuf:
+            timeout = max(0.1, self.compat_delay -
+                          (time.time() - self.last_recv) + 0.1)
+        else:
+            timeout = None
+
+        if len(self.outq):
+            # Come back when the transmit hold is over
+            hold = max(0.01, self._tx_hold - time.time())
+            if timeout is None or hold < timeout:
+                timeout = hold
+
+        try:
+            r, w, x = select.select([fd, self._wake_r], [], [], timeout)
+        except Exception as e:
+            printlog("Transport"," : Unable to wait for input: %s" % e)
+            return True # Let the read report the actual error
+
+        if self._wake_r in r:
+            try:
+                while os.read(self._wake_r, 4096):
+                    pass
+            except OSError:
+                pass
+
+        return fd in r
+
+    def _connect(self, authfn):
         if not self.pipe.is_connected():
             if self.msg_fn:
                 self.msg_fn("Connecting")
@@ -291,7 +977,7 @@ class Transporter(object):
                 if self.msg_fn:
                     self.msg_fn("Unable to connect (%s)" % e)
                 printlog("Transport"," : Comm %s did not connect: %s" % (self.pipe, e))
-                return
+                return False
 
         if authfn and not authfn(self.pipe):
             if self.msg_fn:
@@ -300,24 +986,34 @@ class Transporter(object):
         elif self.msg_fn:
             self.msg_fn("Connected")
 
+        return True
+
+    def _process_input(self):
+        self.parse_blocks()
+        self.parse_gps()
+
+        if self.inbuf and self.compat_is_time():
+            if self.compat:
+                self._send_text_block(bytes(self.inbuf))
+            else:
+                printlog("Transport"," : ### Unconverted data: %s" % self.inbuf)
+            self._consume(len(self.inbuf))
+
+    def worker(self, authfn):
+        if not self._connect(authfn):
+            return
+
         while self.enabled:
             try:
-                self.get_input()
+                if self._wait_for_input() and self.enabled:
+                    self.get_input()
             except Exception as e:
                 printlog("Transport"," : Exception while getting input: %s" % e)
                 utils.log_exception()
                 self.enabled = False
                 break
 
-            self.parse_blocks()
-            self.parse_gps()
-
-            if self.inbuf and self.compat_is_time():
-                if self.compat:
-                    self._send_text_block(self.inbuf)
-                else:
-                    printlog("Transport"," : ### Unconverted data: %s" % self.inbuf)
-                self.inbuf = b""
+            self._process_input()
 
             try:
                 self.send_frames()
@@ -329,29 +1025,28 @@ class Transporter(object):
     def disable(self):
         self.inhandler = None
         self.enabled = False
+        self._wakeup()
         self.thread.join()
+
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
         
     def send_frame(self, frame):
         if not self.enabled:
             printlog("Transport"," : Refusing to queue block for dead transport")
             return
         self.outq.enqueue(frame)
+        self._wakeup()
 
     def recv_frame(self):
         return self.inq.dequeue()
 
     def flush_blocks(self, id):
-        # This should really call a flush method in the blockqueue with a
-        # test function
-        self.outq.lock()
-        for b in self.outq._queue[:]:
-            if b.session == id:
-                printlog(("Transport : Flushing block: %s" % b))
-                try:
-                    self.outq._queue.remove(b)
-                except ValueError:
-                    printlog("Transport"," : Block disappeared while flushing?")
-        self.outq.unlock()
+        count = self.outq.flush(id)
+        if count:
+            printlog("Transport"," : Flushed %i blocks for session %i" % (count, id))
 
     def __str__(self):
         return str(self.pipe)
@@ -426,5 +1121,63 @@ def test_simple():
 
     t.disable()
 
+def test_scheduler():
+    now = time.time()
+
+    s = TransmitScheduler(rate=1000, burst=500)
+    s.record(now, now, 400)
+    printlog("Transport"," : Token wait for 400 bytes: %.2f sec (expect 0.30)" % \
+                 s.wait_time(400))
+
+    s = TransmitScheduler(duty_cycle=0.5, duty_window=1)
+    s.link_rate = 1000
+    s.record(now - 0.5, now, 500)
+    printlog("Transport"," : Duty wait for 100 bytes: %.2f sec (expect 0.60)" % \
+                 s.wait_time(100))
+
+    s = TransmitScheduler(min_gap=2)
+    s.record(now - 1, now, 100)
+    printlog("Transport"," : Gap wait: %.2f sec (expect 2.00)" % \
+                 s.wait_time(100))
+
+def test_ring():
+    r = ByteRing(8)
+    r.write(b"abcdef")
+    assert r.read(4) == b"abcd"
+    r.write(b"ghijk")            # Wraps
+    assert len(r) == 7
+    assert r.peek().tobytes() == b"efgh"
+    buf = bytearray(5)
+    assert r.readinto(buf) == 5 and bytes(buf) == b"efghi"
+    r.write(b"0123456789")       # Grows
+    assert r.read() == b"jk0123456789"
+    printlog("Transport"," : Ring test passed")
+
+def bench_parse(count=500, chunk=4096):
+    p = TestPipe()
+    data = p.buf * count
+    p.buf = b""
+
+    t = Transporter(p)
+    t.disable()
+
+    frames = []
+    t.inhandler = frames.append
+
+    # Keep the per-block logging out of the measurement
+    with debug.quiet():
+        start = time.time()
+        for i in range(0, len(data), chunk):
+            t.inbuf += data[i:i+chunk]
+            t.parse_blocks()
+    elapsed = max(time.time() - start, 0.000001)
+
+    printlog("Transport"," : Parsed %i frames from %i KB in %.2f sec "
+             "(%.1f KB/sec)" % (len(frames), len(data) / 1024, elapsed,
+                                len(data) / 1024 / elapsed))
+
 if __name__ == "__main__":
     test_simple()
+    test_scheduler()
+    test_ring()
+    bench_parse()
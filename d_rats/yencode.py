@@ -16,11 +16,52 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
+import re
 import sys
 
 DEFAULT_BANNED = b"\x11\x13\x1A\00\xFD\xFE\xFF"
 OFFSET = 64
 
+def int_to_byte(data):
+    # python2 compatibility hack
+    if isinstance(data, str):
+        data = ord(data)
+    if sys.version_info[0] > 2:
+        result = chr(data).encode('ISO-8859-1')
+    else:
+        result = chr(data)
+    return result
+
+def to_bytes(buf):
+    # bytearray and memoryview are neither hashable nor matched by re
+    # on python2, so work on a plain copy
+    if isinstance(buf, bytes):
+        return buf
+    elif isinstance(buf, memoryview):
+        return buf.tobytes()
+    return bytes(buf)
+
+# Compiled (pattern, escapes) pairs, keyed by banned set
+_encoders = {}
+
+def _get_encoder(banned):
+    key = bytes(banned)
+    if key in _encoders:
+        return _encoders[key]
+
+    chars = []
+    escapes = {}
+    for char in bytearray(key + b"="):
+        byte = int_to_byte(char)
+        if byte not in escapes:
+            chars.append(re.escape(byte))
+            escapes[byte] = b"=" + int_to_byte((char + OFFSET) % 256)
+
+    pattern = re.compile(b"[" + b"".join(chars) + b"]")
+    _encoders[key] = (pattern, escapes)
+
+    return pattern, escapes
+
 def yencode_buffer(buf, banned=None):
     if not banned:
         banned = DEFAULT_BANNED
@@ -29,60 +70,50 @@ def yencode_buffer(buf, banned=None):
     if isinstance(banned, str):
         banned = bytearray(banned)
 
-    banned += b"="
-    out = b""
-    yesc = b"="
+    pattern, escapes = _get_encoder(banned)
 
-    if isinstance(out, str):
-        out = bytearray(out)
-    if isinstance(yesc, str):
-        yesc = bytearray(yesc)
+    return pattern.sub(lambda m: escapes[m.group(0)], to_bytes(buf))
 
-    for char in buf:
-        if char in banned:
-            if isinstance(char, str):
-                char = ord(char)
-            out += yesc + int_to_byte((char + OFFSET) % 256)
-        else:
-            out += int_to_byte(char)
+_YDECODE_RE = re.compile(b"=(.?)", re.DOTALL)
+_YDECODE = dict([(int_to_byte(i), int_to_byte((i - OFFSET) % 256))
+                 for i in range(0, 256)])
 
-    return out
+class YDecoder(object):
+    """Incremental decoder, for escapes that span buffer boundaries"""
 
-def ydecode_buffer(buf):
-    out = b""
-    
-    # Needed for python2 compatibility
-    if isinstance(out, str):
-        out = bytearray(out)
-    if isinstance(buf, str):
-        buf = bytearray(buf)
-
-    i = 0
-    yesc = ord("=")
-    while i < len(buf):
-        char = buf[i]
-        if char == yesc:
-            i += 1
-            v = buf[i] - OFFSET
-            if v < 0:
-                v += 256
-            out += int_to_byte(v)
-        else:
-            out += int_to_byte(char)
+    def __init__(self):
+        self._pending = False
 
-        i += 1
+    def _unescape(self, match):
+        char = match.group(1)
+        if not char:
+            # Escape character was the last byte of this buffer
+            self._pending = True
+            return b""
 
-    return out
+        return _YDECODE[char]
 
-def int_to_byte(data):
-    # python2 compatibility hack
-    if isinstance(data, str):
-        data = ord(data)
-    if sys.version_info[0] > 2:
-        result = chr(data).encode('ISO-8859-1')
-    else:
-        result = chr(data)
-    return result
+    def feed(self, buf):
+        buf = to_bytes(buf)
+        head = b""
+        if self._pending and len(buf):
+            self._pending = False
+            head = _YDECODE[buf[:1]]
+            buf = buf[1:]
+
+        return head + _YDECODE_RE.sub(self._unescape, buf)
+
+    def finish(self):
+        if self._pending:
+            self._pending = False
+            raise ValueError("Truncated escape at end of buffer")
+
+def ydecode_buffer(buf):
+    decoder = YDecoder()
+    out = decoder.feed(buf)
+    decoder.finish()
+
+    return out
 
 if __name__=="__main__":
     import sys
@@ -126,10 +157,24 @@ if __name__=="__main__":
     else:
         fail = 0
         outbuf = yencode_buffer(inbuf)
-        buffer = ydecode_buffer(outbuf)
+        buffer = bytearray(ydecode_buffer(outbuf))
         for i in range(0, len(buffer)):
             if buffer[i] != inbuf[i]:
                 fail += 1
+
+        # Decode again in small pieces, splitting escape sequences
+        decoder = YDecoder()
+        buffer = b""
+        for i in range(0, len(outbuf), 3):
+            buffer += decoder.feed(outbuf[i:i+3])
+        decoder.finish()
+        if buffer != bytes(inbuf):
+            fail += 1
+
+        # And from a memoryview, as the transport hands them over
+        if ydecode_buffer(memoryview(yencode_buffer(memoryview(outbuf)))) \
+                != bytes(outbuf):
+            fail += 1
         if fail > 0:
             print('[FAILED] %s bytes different' % fail)
         else: